@@ -0,0 +1,109 @@
+"""
+流式JSON解析微基准：比较旧的“拼接缓冲区+整体查找分隔符”解析方式与增量解析器
+
+旧实现每来一个增量都在整个缓冲区里查找分隔符，单个对象越大、或模型漏掉分隔符时，
+耗时随输出长度平方增长；增量解析器每块只扫描一次。对象很小且分隔符齐全时，
+旧实现的查找在C层完成反而更快，但两者都只有毫秒级，远小于模型生成耗时
+
+用法：python bench_stream_parser.py [题目数] [每块字符数]
+"""
+import json
+import sys
+import time
+from stream_json_parser import QUESTION_SEPARATOR, StreamingJSONParser, parse_json_stream
+
+
+def make_question(index: int, code_lines: int = 4) -> dict:
+    body = "\n".join(f"    total += a[{i} % 3] * {i};" for i in range(code_lines))
+    return {
+        "question_text": f"第{index}个题目：下面程序输出什么？注意 \"引号\"、{{花括号}} 和 --- 短横线",
+        "question_type": "code",
+        "question_code": "#include <iostream>\nint main() {\n    int a[3] = {1, 2, 3}, total = 0;\n" + body + "\n    std::cout << a[1] << \"\\n\";\n}",
+        "correct_answer": "B",
+        "explanation": "数组下标从0开始，a[1] 的值为 2。" * 3,
+        "level": 2,
+        "difficulty": "easy",
+        "options": [{"label": label, "value": label, "text": f"选项{label}"} for label in "ABCD"]
+    }
+
+
+def make_stream(question_count: int, chunk_size: int, code_lines: int = 4, separator: str = None) -> list:
+    """生成与模型输出格式一致的文本，并按固定大小切块模拟逐token到达"""
+    separator = f"\n{QUESTION_SEPARATOR}\n" if separator is None else separator
+    text = separator.join(
+        json.dumps(make_question(i, code_lines), ensure_ascii=False, indent=2) for i in range(question_count)
+    ) + separator
+    return [text[i:i + chunk_size] for i in range(0, len(text), chunk_size)]
+
+
+def legacy_parse(chunks):
+    """旧实现：每个增量都拼接到缓冲区并重新查找分隔符"""
+    buffer = ""
+    for chunk in chunks:
+        buffer += chunk
+        while QUESTION_SEPARATOR in buffer:
+            separator_pos = buffer.find(QUESTION_SEPARATOR)
+            question_json = buffer[:separator_pos].strip()
+            buffer = buffer[separator_pos + len(QUESTION_SEPARATOR):].strip()
+            if question_json:
+                try:
+                    yield json.loads(question_json)
+                except json.JSONDecodeError:
+                    continue
+    if buffer.strip():
+        buffer = buffer.strip()
+        try:
+            yield json.loads(buffer)
+        except json.JSONDecodeError:
+            last_open = buffer.rfind('{')
+            if last_open != -1:
+                for i in range(len(buffer), last_open, -1):
+                    try:
+                        yield json.loads(buffer[last_open:i])
+                        break
+                    except json.JSONDecodeError:
+                        continue
+
+
+def bench(name: str, parse, chunks, rounds: int = 3):
+    best = None
+    count = 0
+    for _ in range(rounds):
+        started = time.perf_counter()
+        count = sum(1 for _ in parse(iter(chunks)))
+        elapsed = time.perf_counter() - started
+        best = elapsed if best is None else min(best, elapsed)
+    print(f"  {name:<10} {count:>4} 个对象  {best * 1000:9.2f} ms")
+    return best
+
+
+def bench_truncated_tail(size: int = 20000):
+    """流结束时残缺对象的恢复：旧实现逐个前缀尝试json.loads，新实现只扫描一遍"""
+    tail = '{"question_text": "' + "截断" * size
+    started = time.perf_counter()
+    list(legacy_parse([tail]))
+    legacy = time.perf_counter() - started
+
+    started = time.perf_counter()
+    parser = StreamingJSONParser()
+    parser.feed(tail)
+    parser.finish()
+    incremental = time.perf_counter() - started
+    print(f"残缺尾部({len(tail)} 字符)恢复: 旧实现 {legacy * 1000:.2f} ms, 增量解析 {incremental * 1000:.2f} ms")
+
+
+def run_scenario(title: str, chunks: list):
+    print(f"{title}：{sum(map(len, chunks))} 字符，{len(chunks)} 块")
+    legacy = bench("旧实现", legacy_parse, chunks)
+    incremental = bench("增量解析", parse_json_stream, chunks)
+    print(f"  旧实现/增量解析 = {legacy / incremental:.2f}")
+
+
+if __name__ == "__main__":
+    question_count = int(sys.argv[1]) if len(sys.argv) > 1 else 100
+    chunk_size = int(sys.argv[2]) if len(sys.argv) > 2 else 4
+
+    run_scenario(f"{question_count} 个普通题目", make_stream(question_count, chunk_size))
+    run_scenario(f"{question_count} 个长代码题目（每题约10KB）", make_stream(question_count, chunk_size, code_lines=300))
+    run_scenario(f"{question_count} 个题目，模型漏掉分隔符", make_stream(question_count, chunk_size, separator="\n"))
+    bench_truncated_tail()
@@ -0,0 +1,175 @@
+import asyncio
+import os
+import sqlite3
+import threading
+import time
+import zlib
+from typing import Dict, Iterable, Optional
+
+
+class SQLiteCache:
+    """
+    基于SQLite的持久化键值缓存，值经zlib压缩后存储，
+    超过容量上限时按最近访问时间淘汰（LRU），可选TTL过期；
+    a 开头的方法是在线程池中执行的异步版本，供事件循环上的调用方使用
+    """
+
+    def __init__(self, path: str, max_bytes: int, ttl_seconds: float = None, name: str = "cache"):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.ttl_seconds = ttl_seconds
+        self.name = name
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+
+        self._conn = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.execute("""
+            CREATE TABLE IF NOT EXISTS entries (
+                key TEXT PRIMARY KEY,
+                value BLOB NOT NULL,
+                size INTEGER NOT NULL,
+                created_at REAL NOT NULL,
+                accessed_at REAL NOT NULL
+            )
+        """)
+        self._conn.execute("CREATE INDEX IF NOT EXISTS idx_entries_accessed ON entries(accessed_at)")
+
+    def _is_expired(self, created_at: float, now: float) -> bool:
+        return self.ttl_seconds is not None and now - created_at > self.ttl_seconds
+
+    def get(self, key: str) -> Optional[str]:
+        """读取单个键，未命中或已过期返回None"""
+        return self.get_many([key]).get(key)
+
+    def get_many(self, keys: Iterable[str]) -> Dict[str, str]:
+        """
+        批量读取
+
+        Args:
+            keys: 要读取的键
+
+        Returns:
+            Dict[str, str]: 命中的键值，未命中的键不出现在结果中
+        """
+        keys = list(keys)
+        if not keys:
+            return {}
+
+        now = time.time()
+        found = {}
+        expired = []
+        with self._lock:
+            # SQLite单条语句的参数个数有上限，分批查询
+            for start in range(0, len(keys), 500):
+                batch = keys[start:start + 500]
+                placeholders = ",".join("?" * len(batch))
+                rows = self._conn.execute(
+                    f"SELECT key, value, created_at FROM entries WHERE key IN ({placeholders})",
+                    batch
+                ).fetchall()
+                for key, value, created_at in rows:
+                    if self._is_expired(created_at, now):
+                        expired.append(key)
+                    else:
+                        found[key] = zlib.decompress(value).decode("utf-8")
+
+            if found:
+                self._conn.executemany(
+                    "UPDATE entries SET accessed_at = ? WHERE key = ?",
+                    [(now, key) for key in found]
+                )
+            if expired:
+                self._conn.executemany("DELETE FROM entries WHERE key = ?", [(key,) for key in expired])
+
+            self.hits += len(found)
+            self.misses += len(keys) - len(found)
+        return found
+
+    def set(self, key: str, value: str):
+        """写入单个键"""
+        self.set_many({key: value})
+
+    def set_many(self, items: Dict[str, str]):
+        """批量写入，写入后检查容量并按LRU淘汰"""
+        if not items:
+            return
+
+        now = time.time()
+        rows = []
+        for key, value in items.items():
+            blob = zlib.compress(value.encode("utf-8"))
+            rows.append((key, blob, len(blob), now, now))
+
+        with self._lock:
+            self._conn.executemany(
+                "INSERT OR REPLACE INTO entries (key, value, size, created_at, accessed_at) VALUES (?, ?, ?, ?, ?)",
+                rows
+            )
+            self._evict()
+
+    def delete(self, key: str):
+        """删除单个键"""
+        with self._lock:
+            self._conn.execute("DELETE FROM entries WHERE key = ?", (key,))
+
+    def _evict(self):
+        """总大小超过上限时，从最久未访问的条目开始删除（调用方需持有锁）"""
+        total_size = self._conn.execute("SELECT COALESCE(SUM(size), 0) FROM entries").fetchone()[0]
+        if total_size <= self.max_bytes:
+            return
+
+        to_free = total_size - self.max_bytes
+        victims = []
+        for key, size in self._conn.execute("SELECT key, size FROM entries ORDER BY accessed_at"):
+            victims.append((key,))
+            to_free -= size
+            if to_free <= 0:
+                break
+        self._conn.executemany("DELETE FROM entries WHERE key = ?", victims)
+        print(f"🧹 缓存 {self.name} 超出容量，淘汰 {len(victims)} 个条目")
+
+    def stats(self) -> Dict[str, object]:
+        """返回命中统计和容量信息"""
+        with self._lock:
+            entries, size = self._conn.execute(
+                "SELECT COUNT(*), COALESCE(SUM(size), 0) FROM entries"
+            ).fetchone()
+        lookups = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_ratio": round(self.hits / lookups, 4) if lookups else 0.0,
+            "entries": entries,
+            "size_bytes": size,
+            "max_bytes": self.max_bytes
+        }
+
+    async def _run(self, fn, *args):
+        """在默认线程池中执行SQLite读写，不阻塞事件循环"""
+        return await asyncio.get_event_loop().run_in_executor(None, fn, *args)
+
+    async def aget(self, key: str) -> Optional[str]:
+        return await self._run(self.get, key)
+
+    async def aget_many(self, keys: Iterable[str]) -> Dict[str, str]:
+        return await self._run(self.get_many, list(keys))
+
+    async def aset(self, key: str, value: str):
+        await self._run(self.set, key, value)
+
+    async def aset_many(self, items: Dict[str, str]):
+        await self._run(self.set_many, items)
+
+    async def astats(self) -> Dict[str, object]:
+        return await self._run(self.stats)
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
@@ -0,0 +1,13 @@
+import contextvars
+from concurrent.futures import Future, ThreadPoolExecutor
+
+
+class ContextThreadPoolExecutor(ThreadPoolExecutor):
+    """
+    提交任务时复制调用方的 contextvars 上下文，在工作线程中恢复，
+    使请求级的上下文（调用优先级等）跟随任务进入线程池
+    """
+
+    def submit(self, fn, *args, **kwargs) -> Future:
+        context = contextvars.copy_context()
+        return super().submit(context.run, fn, *args, **kwargs)
@@ -1,21 +1,46 @@
+import asyncio
+import hashlib
 import json
 import os
-import requests
-from typing import Dict, Any, List
+import re
+from llm_client import LLMClient, StreamEnd, get_llm_client
+from cache_store import SQLiteCache
+from hedging import LatencyTracker, hedged_call
+from typing import Dict, Any, List, AsyncGenerator, Generator, Tuple
+from concurrent.futures import as_completed
+from context_executor import ContextThreadPoolExecutor
+from metrics import PARSE_FAILURES
+from token_usage import UsageCollector, track_usage
+
+# 修改解析prompt或系统提示词时递增，使旧缓存失效
+EXPLANATION_PROMPT_VERSION = "v1"
 
 class ExplanationProcessor:
     """
     答案解析处理器，专门用于快速生成题目的详细解析
     """
     
-    def __init__(self, api_key: str = None, max_tokens: int = 400, model: str = None):
+    def __init__(self, api_key: str = None, max_tokens: int = 400, model: str = None, client: LLMClient = None, cache: SQLiteCache = None):
         self.api_key = api_key or os.getenv("DASHSCOPE_API_KEY")
-        self.api_url = "https://dashscope.aliyuncs.com/compatible-mode/v1/chat/completions"
+        # 共享连接池的DashScope客户端
+        self.client = client or get_llm_client()
         self.model = model or os.getenv("LLM_MODEL", "qwen-plus-latest")
         self.max_tokens = max_tokens  # 保证50-200字质量
+        # 批量生成时的最大并发数，避免瞬时请求过多触发上游限流
+        self.batch_workers = int(os.getenv("EXPLANATION_BATCH_WORKERS", "5"))
+        # 解析缓存，管理员反复为同一题目生成解析时直接返回
+        self.cache = cache
+        # 单题解析的默认时间预算和截止时间内的最大尝试次数
+        self.default_deadline = float(os.getenv("EXPLANATION_DEADLINE_MS", "8000")) / 1000
+        self.max_attempts = int(os.getenv("EXPLANATION_MAX_ATTEMPTS", "2"))
+        # 对冲请求的耗时统计
+        self.latency = LatencyTracker()
+        # 打包模式：一次请求中放入的题目数由token预算决定，并设上限
+        self.pack_token_budget = int(os.getenv("EXPLANATION_PACK_TOKEN_BUDGET", "8000"))
+        self.pack_max_questions = int(os.getenv("EXPLANATION_PACK_MAX_QUESTIONS", "10"))
     
-    def create_explanation_prompt(self, question_data: Dict[str, Any]) -> str:
-        """创建答案解析的prompt（优化版本，快速响应）"""
+    def format_question(self, question_data: Dict[str, Any]) -> str:
+        """把题目、选项和答案格式化为prompt中的题目段落"""
         
         # 构建题目信息
         question_text = question_data.get("question_text", "")
@@ -35,51 +60,351 @@ class ExplanationProcessor:
         
         return f"""题目：{full_question}
 选项：{options_text}
-答案：{correct_answer}
+答案：{correct_answer}"""
+    
+    def create_explanation_prompt(self, question_data: Dict[str, Any]) -> str:
+        """创建答案解析的prompt（优化版本，快速响应）"""
+        correct_answer = question_data.get("correct_answer", "")
+        return f"""{self.format_question(question_data)}
 
 请生成50-200字的解析，只解释为什么{correct_answer}是正确答案，不需要包含知识点。
 
 解析："""
+    
+    def create_packed_prompt(self, questions: List[Dict[str, Any]]) -> str:
+        """创建一次包含多道题目的解析prompt，要求按题号返回JSON数组"""
+        blocks = "\n\n".join(
+            f"【题目{number}】\n{self.format_question(question)}"
+            for number, question in enumerate(questions, 1)
+        )
+        return f"""下面有{len(questions)}道题目，请分别为每道题生成50-200字的解析，只解释为什么该题答案是正确答案，不需要包含知识点。
+
+{blocks}
+
+请只返回JSON数组，不要包含任何其他文字，每道题一个元素，index为题号：
+[{{"index": 1, "explanation": "解析内容"}}]"""
+
+    def make_cache_key(self, prompt: str) -> str:
+        """由规范化后的prompt、模型名和prompt版本生成缓存键"""
+        normalized_prompt = "\n".join(
+            re.sub(r'\s+', ' ', line).strip() for line in prompt.strip().splitlines()
+        )
+        raw_key = json.dumps({
+            "prompt": normalized_prompt,
+            "model": self.model,
+            "version": EXPLANATION_PROMPT_VERSION,
+            "max_tokens": self.max_tokens
+        }, ensure_ascii=False, sort_keys=True)
+        return "explanation:" + hashlib.sha256(raw_key.encode("utf-8")).hexdigest()
 
+    def make_packed_cache_keys(self, questions: List[Dict[str, Any]]) -> List[str]:
+        """
+        打包请求中每道题的缓存键：由打包prompt和题目在组内的位置生成。
+        打包输出与单题prompt的输出不同，不能记在单题的缓存键下
+        """
+        prompt = self.create_packed_prompt(questions)
+        return [self.make_cache_key(f"{prompt}\n\n【打包第{position}题】") for position in range(1, len(questions) + 1)]
+    
+    def build_request(self, prompt: str) -> Dict[str, Any]:
+        """构建解析请求体"""
+        return {
+            "model": self.model,
+            "messages": [
+                {"role": "system", "content": "你是编程教育专家，解释答案什么正确，和其他选项为啥错误"},
+                {"role": "user", "content": prompt}
+            ],
+            "temperature": 0.5,  # 稍微提高创造性，保证质量
+            "max_tokens": self.max_tokens,
+            "stream": False,
+            "top_p": 0.8
+        }
+    
     def call_api(self, prompt: str) -> str:
         """调用DashScope API"""
         try:
-            headers = {
-                "Content-Type": "application/json",
-                "Authorization": f"Bearer {self.api_key}"
-            }
-            
-            data = {
-                "model": self.model,
-                "messages": [
-                    {"role": "system", "content": "你是编程教育专家，解释答案什么正确，和其他选项为啥错误"},
-                    {"role": "user", "content": prompt}
-                ],
-                "temperature": 0.5,  # 稍微提高创造性，保证质量
-                "max_tokens": self.max_tokens,
-                "stream": False,
-                "top_p": 0.8
-            }
+            data = self.build_request(prompt)
+            result = self.client.post_json(data, api_key=self.api_key, timeout=5, processor="explanation_processor")
+            return result["choices"][0]["message"]["content"]
             
-            response = requests.post(self.api_url, headers=headers, json=data, timeout=5)
-            response.raise_for_status()
+        except Exception as e:
+            raise Exception(f"调用DashScope API失败: {str(e)}")
+    
+    async def acall_api(self, prompt: str, deadline: float = None) -> str:
+        """
+        异步调用DashScope API，带截止时间和对冲请求
+        
+        首个请求超过近期p95耗时仍未返回时发出一个相同的对冲请求，取先返回者并取消另一个；
+        失败后在截止时间内重试，最多 EXPLANATION_MAX_ATTEMPTS 次
+        
+        Args:
+            prompt: 解析prompt
+            deadline: 截止时间（事件循环时钟），默认为当前时间加 EXPLANATION_DEADLINE_MS
+        """
+        loop = asyncio.get_event_loop()
+        deadline = deadline or loop.time() + self.default_deadline
+        data = self.build_request(prompt)
+        
+        async def primary(remaining: float) -> Dict[str, Any]:
+            return await self.client.apost_json(data, api_key=self.api_key, timeout=remaining, processor="explanation_processor")
+        
+        async def hedge(remaining: float) -> Dict[str, Any]:
+            # 对冲请求不能与首个请求合并，否则等同于没有对冲
+            return await self.client.apost_json(data, api_key=self.api_key, timeout=remaining, coalesce=False,
+                                                 processor="explanation_processor")
+        
+        last_error = None
+        for attempt in range(self.max_attempts):
+            if loop.time() >= deadline:
+                break
+            try:
+                result = await hedged_call(primary, hedge, self.latency, deadline)
+                return result["choices"][0]["message"]["content"]
+            except asyncio.TimeoutError:
+                last_error = "超过截止时间"
+                break
+            except Exception as e:
+                last_error = str(e)
+                print(f"⚠️ 第 {attempt + 1} 次调用失败: {last_error}")
+        
+        raise Exception(f"调用DashScope API失败: {last_error or '超过截止时间'}")
+    
+    def call_packed_api(self, questions: List[Dict[str, Any]]) -> str:
+        """调用DashScope API为一组题目生成解析，输出上限按题目数放大"""
+        try:
+            data = self.build_request(self.create_packed_prompt(questions))
+            data["max_tokens"] = self.max_tokens * len(questions)
+            result = self.client.post_json(data, api_key=self.api_key, timeout=5 + 3 * len(questions),
+                                           processor="explanation_processor")
+            return result["choices"][0]["message"]["content"]
             
-            result = response.json()
+        except Exception as e:
+            raise Exception(f"调用DashScope API失败: {str(e)}")
+    
+    async def acall_packed_api(self, questions: List[Dict[str, Any]]) -> str:
+        """call_packed_api 的异步版本"""
+        try:
+            data = self.build_request(self.create_packed_prompt(questions))
+            data["max_tokens"] = self.max_tokens * len(questions)
+            result = await self.client.apost_json(data, api_key=self.api_key, timeout=5 + 3 * len(questions),
+                                                  processor="explanation_processor")
             return result["choices"][0]["message"]["content"]
             
         except Exception as e:
             raise Exception(f"调用DashScope API失败: {str(e)}")
     
-    def generate_explanation(self, question_data: Dict[str, Any]) -> Dict[str, Any]:
+    def parse_packed_response(self, content: str, count: int) -> Dict[int, str]:
+        """
+        把打包请求的响应拆回每道题
+        
+        Args:
+            content: 模型返回的文本，期望为JSON数组
+            count: 本组题目数
+            
+        Returns:
+            Dict[int, str]: 题号（从0开始）到解析的映射，解析失败的题目不出现在结果中
+        """
+        content = re.sub(r'^```(?:json)?\s*|\s*```$', '', content.strip())
+        try:
+            items = json.loads(content)
+        except json.JSONDecodeError:
+            # 数组前后夹带了其他文字时，截取最外层的方括号再试一次
+            start, end = content.find('['), content.rfind(']')
+            if start == -1 or end <= start:
+                PARSE_FAILURES.labels("packed_explanations").inc()
+                return {}
+            try:
+                items = json.loads(content[start:end + 1])
+            except json.JSONDecodeError:
+                PARSE_FAILURES.labels("packed_explanations").inc()
+                return {}
+        
+        if not isinstance(items, list):
+            PARSE_FAILURES.labels("packed_explanations").inc()
+            return {}
+        
+        explanations = {}
+        for position, item in enumerate(items):
+            if not isinstance(item, dict):
+                continue
+            explanation = item.get("explanation")
+            if not isinstance(explanation, str) or not explanation.strip():
+                continue
+            # 优先按模型给出的题号对应，缺失时按数组位置对应
+            index = item.get("index", position + 1)
+            if isinstance(index, int) and 1 <= index <= count:
+                explanations.setdefault(index - 1, explanation.strip())
+        return explanations
+    
+    def plan_packs(self, items: List[Tuple[int, Dict[str, Any], str]]) -> List[List[Tuple[int, Dict[str, Any], str]]]:
+        """
+        按token预算把待生成的题目分组：每组的输入字符数加预期输出不超过预算，且题目数不超过上限
+        
+        Args:
+            items: (下标, 题目数据, 单题prompt) 列表
+        """
+        packs, current, used = [], [], 0
+        for item in items:
+            cost = len(self.format_question(item[1])) + self.max_tokens
+            if current and (used + cost > self.pack_token_budget or len(current) >= self.pack_max_questions):
+                packs.append(current)
+                current, used = [], 0
+            current.append(item)
+            used += cost
+        if current:
+            packs.append(current)
+        return packs
+    
+    def _explain_pack(self, pack: List[Tuple[int, Dict[str, Any], str]], force_refresh: bool = False) -> List[Tuple[int, Dict[str, Any]]]:
+        """
+        为一组题目生成解析，拆分失败的题目单独重试。
+        打包得到的解析记在打包缓存键下，单独重试得到的解析记在单题缓存键下
+        
+        Returns:
+            List[Tuple[int, Dict]]: (题目下标, 解析结果)
+        """
+        packed_keys, cached = self._lookup_pack_cache(pack, force_refresh)
+        explanations = dict(cached)
+        if len(pack) > 1 and len(cached) < len(pack):
+            try:
+                content = self.call_packed_api([question for _, question, _ in pack])
+                parsed = self.parse_packed_response(content, len(pack))
+                print(f"📦 打包生成 {len(pack)} 个题目的解析，成功拆分 {len(parsed)} 个")
+                if self.cache:
+                    self.cache.set_many({packed_keys[position]: explanation for position, explanation in parsed.items()})
+                # 组内已有缓存的题目沿用缓存
+                explanations = {**parsed, **cached}
+            except Exception as e:
+                print(f"⚠️ 打包请求失败，逐题重试: {str(e)}")
+        
+        results = []
+        for position, (index, question, prompt) in enumerate(pack):
+            try:
+                explanation = explanations.get(position)
+                if explanation is None:
+                    # 只重试没有拆分出来的题目
+                    explanation = self.call_api(prompt)
+                    if self.cache:
+                        self.cache.set(self.make_cache_key(prompt), explanation)
+                results.append((index, self._success_result(question, explanation, cache_hit=position in cached)))
+            except Exception as e:
+                print(f"❌ 生成题目解析失败: {str(e)}")
+                results.append((index, self._error_result(question, e)))
+        return results
+    
+    async def _aexplain_pack(self, pack: List[Tuple[int, Dict[str, Any], str]], force_refresh: bool = False) -> List[Tuple[int, Dict[str, Any]]]:
+        """_explain_pack 的异步版本，拆分失败的题目并发重试"""
+        packed_keys, cached = await self._alookup_pack_cache(pack, force_refresh)
+        explanations = dict(cached)
+        if len(pack) > 1 and len(cached) < len(pack):
+            try:
+                content = await self.acall_packed_api([question for _, question, _ in pack])
+                parsed = self.parse_packed_response(content, len(pack))
+                print(f"📦 打包生成 {len(pack)} 个题目的解析，成功拆分 {len(parsed)} 个")
+                if self.cache:
+                    await self.cache.aset_many({packed_keys[position]: explanation for position, explanation in parsed.items()})
+                # 组内已有缓存的题目沿用缓存
+                explanations = {**parsed, **cached}
+            except Exception as e:
+                print(f"⚠️ 打包请求失败，逐题重试: {str(e)}")
+        
+        async def explain(position, index, question, prompt):
+            try:
+                explanation = explanations.get(position)
+                if explanation is None:
+                    # 只重试没有拆分出来的题目
+                    explanation = await self.acall_api(prompt)
+                    if self.cache:
+                        await self.cache.aset(self.make_cache_key(prompt), explanation)
+                return index, self._success_result(question, explanation, cache_hit=position in cached)
+            except Exception as e:
+                print(f"❌ 生成题目解析失败: {str(e)}")
+                return index, self._error_result(question, e)
+        
+        return list(await asyncio.gather(*[
+            explain(position, index, question, prompt)
+            for position, (index, question, prompt) in enumerate(pack)
+        ]))
+    
+    def _lookup_pack_cache(self, pack: List[Tuple[int, Dict[str, Any], str]], force_refresh: bool) -> Tuple[List[str], Dict[int, str]]:
+        """
+        查询一组题目的打包缓存
+
+        Returns:
+            (每道题的打包缓存键, 组内位置到已缓存解析的映射)；只有一道题的组不走打包请求，不查询
+        """
+        if not self.cache or len(pack) < 2:
+            return [], {}
+        keys = self.make_packed_cache_keys([question for _, question, _ in pack])
+        if force_refresh:
+            return keys, {}
+        found = self.cache.get_many(keys)
+        return keys, {position: found[key] for position, key in enumerate(keys) if key in found}
+
+    async def _alookup_pack_cache(self, pack: List[Tuple[int, Dict[str, Any], str]], force_refresh: bool) -> Tuple[List[str], Dict[int, str]]:
+        """_lookup_pack_cache 的异步版本，SQLite读取在线程池中执行"""
+        if not self.cache or len(pack) < 2:
+            return [], {}
+        keys = self.make_packed_cache_keys([question for _, question, _ in pack])
+        if force_refresh:
+            return keys, {}
+        found = await self.cache.aget_many(keys)
+        return keys, {position: found[key] for position, key in enumerate(keys) if key in found}
+
+    def _lookup_cache(self, prompt: str, force_refresh: bool) -> Tuple[str, str]:
+        """
+        查询解析缓存
+        
+        Returns:
+            Tuple[str, str]: (缓存键, 命中的解析)，未启用缓存时缓存键为None，未命中时解析为None
+        """
+        cache_key = self.make_cache_key(prompt) if self.cache else None
+        if cache_key and not force_refresh:
+            return cache_key, self.cache.get(cache_key)
+        return cache_key, None
+
+    async def _alookup_cache(self, prompt: str, force_refresh: bool) -> Tuple[str, str]:
+        """_lookup_cache 的异步版本，SQLite读取在线程池中执行，不阻塞事件循环"""
+        cache_key = self.make_cache_key(prompt) if self.cache else None
+        if cache_key and not force_refresh:
+            return cache_key, await self.cache.aget(cache_key)
+        return cache_key, None
+    
+    def _success_result(self, question_data: Dict[str, Any], explanation: str, cache_hit: bool) -> Dict[str, Any]:
+        return {
+            "original_question": question_data,
+            "explanation": explanation,
+            "status": "success",
+            "cache_hit": cache_hit,
+            "generated_at": self._get_current_time()
+        }
+    
+    def _error_result(self, question_data: Dict[str, Any], error: Exception) -> Dict[str, Any]:
+        return {
+            "original_question": question_data,
+            "explanation": "",
+            "status": "error",
+            "error": str(error),
+            "cache_hit": False,
+            "generated_at": self._get_current_time()
+        }
+    
+    def generate_explanation(self, question_data: Dict[str, Any], force_refresh: bool = False) -> Dict[str, Any]:
         """
         为单个题目生成答案解析（极速版本）
         
         Args:
             question_data: 题目数据，包含题目信息
+            force_refresh: 为True时跳过缓存，重新调用大模型并覆盖缓存
             
         Returns:
-            Dict: 包含原始题目和详细解析的结果
+            Dict: 包含原始题目和详细解析的结果，cache_hit 表示是否命中缓存，usage 为本题消耗的token
         """
+        with track_usage() as usage:
+            result = self._generate_explanation(question_data, force_refresh)
+        result["usage"] = usage.to_dict()
+        return result
+    
+    def _generate_explanation(self, question_data: Dict[str, Any], force_refresh: bool = False) -> Dict[str, Any]:
         try:
             print(f"🔍 开始生成题目解析...")
             
@@ -87,52 +412,297 @@ class ExplanationProcessor:
             if not question_data.get("question_text"):
                 raise ValueError("题目数据缺少question_text字段")
             
-            # 直接使用API解析
             prompt = self.create_explanation_prompt(question_data)
+            
+            # 优先读取缓存
+            cache_key, cached = self._lookup_cache(prompt, force_refresh)
+            if cached is not None:
+                print(f"⚡ 命中解析缓存")
+                return self._success_result(question_data, cached, cache_hit=True)
+            
+            # 使用API解析
             explanation = self.call_api(prompt)
+            if cache_key:
+                self.cache.set(cache_key, explanation)
             
-            # 构建返回结果
-            result = {
-                "original_question": question_data,
-                "explanation": explanation,
-                "status": "success",
-                "generated_at": self._get_current_time()
-            }
+            print(f"✅ 题目解析生成完成")
+            return self._success_result(question_data, explanation, cache_hit=False)
+            
+        except Exception as e:
+            print(f"❌ 生成题目解析失败: {str(e)}")
+            return self._error_result(question_data, e)
+    
+    async def agenerate_explanation(self, question_data: Dict[str, Any], force_refresh: bool = False, deadline: float = None) -> Dict[str, Any]:
+        """
+        异步为单个题目生成答案解析，在截止时间内使用对冲请求压低长尾耗时
+        
+        Args:
+            question_data: 题目数据
+            force_refresh: 为True时跳过缓存
+            deadline: 截止时间（事件循环时钟），为None时使用默认时间预算
+            
+        Returns:
+            Dict: 与 generate_explanation 相同结构的结果，usage 含对冲和重试请求的用量
+        """
+        with track_usage() as usage:
+            result = await self._agenerate_explanation(question_data, force_refresh, deadline)
+        result["usage"] = usage.to_dict()
+        return result
+    
+    async def _agenerate_explanation(self, question_data: Dict[str, Any], force_refresh: bool = False, deadline: float = None) -> Dict[str, Any]:
+        try:
+            print(f"🔍 开始生成题目解析...")
+            
+            if not question_data.get("question_text"):
+                raise ValueError("题目数据缺少question_text字段")
+            
+            prompt = self.create_explanation_prompt(question_data)
+            
+            cache_key, cached = await self._alookup_cache(prompt, force_refresh)
+            if cached is not None:
+                print(f"⚡ 命中解析缓存")
+                return self._success_result(question_data, cached, cache_hit=True)
+            
+            explanation = await self.acall_api(prompt, deadline)
+            if cache_key:
+                await self.cache.aset(cache_key, explanation)
             
             print(f"✅ 题目解析生成完成")
-            return result
+            return self._success_result(question_data, explanation, cache_hit=False)
             
         except Exception as e:
             print(f"❌ 生成题目解析失败: {str(e)}")
-            return {
-                "original_question": question_data,
-                "explanation": "",
-                "status": "error",
-                "error": str(e),
-                "generated_at": self._get_current_time()
-            }
+            return self._error_result(question_data, e)
     
+    async def astream_explanation(self, question_data: Dict[str, Any], force_refresh: bool = False, deadline: float = None) -> AsyncGenerator[Dict[str, Any], None]:
+        """
+        流式生成单个题目的解析，模型每输出一段文本就产出一个 delta 事件
+        
+        Args:
+            question_data: 题目数据
+            force_refresh: 为True时跳过缓存
+            deadline: 截止时间（事件循环时钟），为None时使用默认时间预算
+            
+        Yields:
+            Dict: {"type": "delta", "content": 增量文本}，
+                  最后一个事件为 {"type": "complete", "result": 与 generate_explanation 相同结构的结果}
+        """
+        # 用量取自流末尾的 StreamEnd，与合并进来的相同请求共享同一份
+        usage = UsageCollector()
+        try:
+            print(f"🔍 开始流式生成题目解析...")
+            
+            if not question_data.get("question_text"):
+                raise ValueError("题目数据缺少question_text字段")
+            
+            prompt = self.create_explanation_prompt(question_data)
+            
+            cache_key, cached = await self._alookup_cache(prompt, force_refresh)
+            if cached is not None:
+                print(f"⚡ 命中解析缓存")
+                yield {"type": "delta", "content": cached}
+                yield {"type": "complete", "result": {**self._success_result(question_data, cached, cache_hit=True),
+                                                      "usage": usage.to_dict()}}
+                return
+            
+            loop = asyncio.get_event_loop()
+            remaining = (deadline or loop.time() + self.default_deadline) - loop.time()
+            if remaining <= 0:
+                raise Exception("调用DashScope API失败: 超过截止时间")
+            
+            data = self.build_request(prompt)
+            data["stream"] = True
+            data["stream_options"] = {"include_usage": True}
+            
+            parts = []
+            stream = self.client.astream_chat(data, api_key=self.api_key, timeout=remaining, include_end=True,
+                                              processor="explanation_processor")
+            try:
+                async for content in stream:
+                    if isinstance(content, StreamEnd):
+                        if content.usage:
+                            usage.add(self.model, content.usage)
+                        continue
+                    parts.append(content)
+                    yield {"type": "delta", "content": content}
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                raise Exception(f"调用DashScope API失败: {str(e)}")
+            finally:
+                await stream.aclose()
+            
+            explanation = "".join(parts)
+            if cache_key:
+                await self.cache.aset(cache_key, explanation)
+            
+            print(f"✅ 题目解析流式生成完成")
+            yield {"type": "complete", "result": {**self._success_result(question_data, explanation, cache_hit=False),
+                                                  "usage": usage.to_dict()}}
+            
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            print(f"❌ 生成题目解析失败: {str(e)}")
+            yield {"type": "complete", "result": {**self._error_result(question_data, e), "usage": usage.to_dict()}}
     
-    def generate_batch_explanations(self, questions: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+    
+    def iter_batch_explanations(self, questions: List[Dict[str, Any]], max_workers: int = None, force_refresh: bool = False, packed: bool = False) -> Generator[Tuple[int, Dict[str, Any]], None, None]:
         """
-        批量生成多个题目的答案解析
+        以有界并发批量生成解析，哪个题目先完成就先产出
         
         Args:
             questions: 题目列表
+            max_workers: 并发数，默认使用 EXPLANATION_BATCH_WORKERS，且不超过该上限
+            force_refresh: 为True时跳过缓存
+            packed: 为True时把多道题目打包进一次请求
             
-        Returns:
-            List[Dict]: 包含解析结果的列表
+        Yields:
+            Tuple[int, Dict]: (题目在输入中的下标, 解析结果)
         """
-        results = []
+        workers = min(int(max_workers or self.batch_workers), self.batch_workers, len(questions))
+        if workers <= 0:
+            return
+        
+        if packed:
+            yield from self._iter_packed_explanations(questions, workers, force_refresh)
+            return
+        
+        print(f"📚 开始批量生成 {len(questions)} 个题目的解析，并发数 {workers}...")
+        
+        completed_count = 0
+        with ContextThreadPoolExecutor(max_workers=workers) as executor:
+            future_to_index = {
+                executor.submit(self.generate_explanation, question, force_refresh): i
+                for i, question in enumerate(questions)
+            }
+            
+            for future in as_completed(future_to_index):
+                index = future_to_index[future]
+                completed_count += 1
+                print(f"🔄 第 {index + 1} 个题目完成 ({completed_count}/{len(questions)})")
+                yield index, future.result()
+        
+        print(f"🎉 批量解析完成！成功处理 {completed_count} 个题目")
+    
+    def _iter_packed_explanations(self, questions: List[Dict[str, Any]], workers: int, force_refresh: bool) -> Generator[Tuple[int, Dict[str, Any]], None, None]:
+        """打包模式的批量生成：先查缓存，未命中的题目按token预算分组并发请求"""
+        pending = []
+        for index, question in enumerate(questions):
+            if not question.get("question_text"):
+                yield index, self._error_result(question, ValueError("题目数据缺少question_text字段"))
+                continue
+            prompt = self.create_explanation_prompt(question)
+            _, cached = self._lookup_cache(prompt, force_refresh)
+            if cached is not None:
+                yield index, self._success_result(question, cached, cache_hit=True)
+            else:
+                pending.append((index, question, prompt))
+        
+        packs = self.plan_packs(pending)
+        if not packs:
+            return
+        
+        print(f"📚 打包生成 {len(pending)} 个题目的解析，共 {len(packs)} 组，并发数 {min(workers, len(packs))}...")
+        
+        with ContextThreadPoolExecutor(max_workers=min(workers, len(packs))) as executor:
+            futures = [executor.submit(self._explain_pack, pack, force_refresh) for pack in packs]
+            for future in as_completed(futures):
+                yield from future.result()
+        
+        print(f"🎉 批量解析完成！")
+    
+    async def aiter_batch_explanations(self, questions: List[Dict[str, Any]], max_workers: int = None, force_refresh: bool = False, packed: bool = False) -> AsyncGenerator[Tuple[int, Dict[str, Any]], None]:
+        """
+        iter_batch_explanations 的异步版本：在事件循环上用异步客户端并发请求，
+        并发数限制与同步版本相同，不占用线程池
         
-        print(f"📚 开始批量生成 {len(questions)} 个题目的解析...")
+        Yields:
+            Tuple[int, Dict]: (题目在输入中的下标, 解析结果)
+        """
+        workers = min(int(max_workers or self.batch_workers), self.batch_workers, len(questions))
+        if workers <= 0:
+            return
+        
+        slots = asyncio.Semaphore(workers)
+        
+        if packed:
+            pending = []
+            for index, question in enumerate(questions):
+                if not question.get("question_text"):
+                    yield index, self._error_result(question, ValueError("题目数据缺少question_text字段"))
+                    continue
+                prompt = self.create_explanation_prompt(question)
+                _, cached = await self._alookup_cache(prompt, force_refresh)
+                if cached is not None:
+                    yield index, self._success_result(question, cached, cache_hit=True)
+                else:
+                    pending.append((index, question, prompt))
+            
+            packs = self.plan_packs(pending)
+            if not packs:
+                return
+            print(f"📚 打包生成 {len(pending)} 个题目的解析，共 {len(packs)} 组，并发数 {min(workers, len(packs))}...")
+            
+            async def run_pack(pack):
+                async with slots:
+                    return await self._aexplain_pack(pack, force_refresh)
+            
+            tasks = [asyncio.ensure_future(run_pack(pack)) for pack in packs]
+            try:
+                for future in asyncio.as_completed(tasks):
+                    for item in await future:
+                        yield item
+            finally:
+                for task in tasks:
+                    task.cancel()
+            print(f"🎉 批量解析完成！")
+            return
+        
+        print(f"📚 开始批量生成 {len(questions)} 个题目的解析，并发数 {workers}...")
+        
+        async def run_one(index, question):
+            async with slots:
+                return index, await self.agenerate_explanation(question, force_refresh)
+        
+        completed_count = 0
+        tasks = [asyncio.ensure_future(run_one(i, question)) for i, question in enumerate(questions)]
+        try:
+            for future in asyncio.as_completed(tasks):
+                index, result = await future
+                completed_count += 1
+                print(f"🔄 第 {index + 1} 个题目完成 ({completed_count}/{len(questions)})")
+                yield index, result
+        finally:
+            # 调用方提前停止（如客户端断开）时取消剩余请求
+            for task in tasks:
+                task.cancel()
         
-        for i, question in enumerate(questions):
-            print(f"🔄 处理第 {i+1}/{len(questions)} 个题目...")
-            result = self.generate_explanation(question)
-            results.append(result)
+        print(f"🎉 批量解析完成！成功处理 {completed_count} 个题目")
+    
+    async def agenerate_batch_explanations(self, questions: List[Dict[str, Any]], max_workers: int = None, force_refresh: bool = False, packed: bool = False) -> List[Dict[str, Any]]:
+        """generate_batch_explanations 的异步版本"""
+        results = [None] * len(questions)
+        async for index, result in self.aiter_batch_explanations(questions, max_workers, force_refresh, packed):
+            results[index] = result
+        return results
+    
+    def generate_batch_explanations(self, questions: List[Dict[str, Any]], max_workers: int = None, force_refresh: bool = False, packed: bool = False) -> List[Dict[str, Any]]:
+        """
+        批量生成多个题目的答案解析
         
-        print(f"🎉 批量解析完成！成功处理 {len(results)} 个题目")
+        Args:
+            questions: 题目列表
+            max_workers: 并发数
+            force_refresh: 为True时跳过缓存
+            packed: 为True时把多道题目打包进一次请求，适合大批量回填
+            
+        Returns:
+            List[Dict]: 包含解析结果的列表，顺序与输入一致
+        """
+        results = [None] * len(questions)
+        for index, result in self.iter_batch_explanations(questions, max_workers, force_refresh, packed):
+            results[index] = result
         return results
     
     def _get_current_time(self) -> str:
@@ -0,0 +1,132 @@
+import asyncio
+import os
+import threading
+from collections import deque
+from typing import Any, Awaitable, Callable, Dict, Optional
+
+
+class LatencyTracker:
+    """
+    记录最近若干次调用的耗时，用于推算对冲阈值：
+    首个请求超过 p95 仍未返回时才发出第二个请求，并限制对冲请求的比例，平均成本基本不变
+    """
+
+    def __init__(self, window: int = None, default_threshold: float = None, min_samples: int = 20,
+                 percentile: float = 0.95, max_hedge_ratio: float = None):
+        self.window = window or int(os.getenv("HEDGE_LATENCY_WINDOW", "200"))
+        self.default_threshold = default_threshold or float(os.getenv("HEDGE_DEFAULT_MS", "1500")) / 1000
+        self.min_samples = min_samples
+        self.percentile = percentile
+        self.max_hedge_ratio = max_hedge_ratio if max_hedge_ratio is not None else float(os.getenv("HEDGE_MAX_RATIO", "0.1"))
+        self._samples = deque(maxlen=self.window)
+        self._lock = threading.Lock()
+        self.calls = 0
+        self.hedged = 0
+        self.hedge_wins = 0
+
+    def record(self, seconds: float):
+        """
+        记录一次调用的耗时。失败的调用记实际耗时；被取消（对冲输掉或到达截止时间）的调用记到取消时为止的耗时，
+        作为真实耗时的下界——只记成功的胜者会让 p95 偏低并持续下漂，对冲越来越多
+        """
+        with self._lock:
+            self._samples.append(seconds)
+
+    def record_call(self):
+        """记录一次对冲调用（不论是否真的发出了对冲请求）"""
+        with self._lock:
+            self.calls += 1
+
+    def record_hedge_win(self):
+        """记录一次对冲请求先于首个请求成功返回"""
+        with self._lock:
+            self.hedge_wins += 1
+
+    def threshold(self) -> float:
+        """当前对冲阈值（秒），样本不足时使用默认值"""
+        with self._lock:
+            if len(self._samples) < self.min_samples:
+                return self.default_threshold
+            ordered = sorted(self._samples)
+        return ordered[min(len(ordered) - 1, int(len(ordered) * self.percentile))]
+
+    def allow_hedge(self) -> bool:
+        """对冲请求占比未超过上限时才允许对冲"""
+        with self._lock:
+            if self.hedged + 1 > self.max_hedge_ratio * max(self.calls, 1):
+                return False
+            self.hedged += 1
+            return True
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "calls": self.calls,
+            "hedged": self.hedged,
+            "hedge_wins": self.hedge_wins,
+            "threshold_ms": round(self.threshold() * 1000, 1)
+        }
+
+
+async def hedged_call(primary: Callable[[float], Awaitable[Any]], hedge: Callable[[float], Awaitable[Any]],
+                      tracker: LatencyTracker, deadline: float) -> Any:
+    """
+    发出一次调用，超过对冲阈值仍未返回时再发出一次相同调用，取先成功的结果并取消另一个
+
+    Args:
+        primary: 首个调用，参数为剩余时间（秒）
+        hedge: 对冲调用，参数为剩余时间（秒），不应与首个调用合并
+        tracker: 耗时统计
+        deadline: 截止时间（事件循环时钟）
+
+    Returns:
+        先成功返回的结果；两个调用都失败时抛出最后一个异常，到达截止时间抛出 asyncio.TimeoutError
+    """
+    loop = asyncio.get_event_loop()
+    tracker.record_call()
+
+    started = {}
+
+    def launch(factory):
+        remaining = deadline - loop.time()
+        task = asyncio.ensure_future(factory(remaining))
+        started[task] = loop.time()
+        return task
+
+    first = launch(primary)
+    pending = {first}
+    error: Optional[BaseException] = None
+    try:
+        hedge_at = loop.time() + tracker.threshold()
+        while pending:
+            now = loop.time()
+            can_hedge = len(started) == 1 and hedge_at < deadline
+            wait_until = hedge_at if can_hedge else deadline
+            done, pending = await asyncio.wait(
+                pending, timeout=max(wait_until - now, 0), return_when=asyncio.FIRST_COMPLETED
+            )
+
+            for task in done:
+                tracker.record(loop.time() - started[task])
+                if task.exception() is None:
+                    if task is not first:
+                        tracker.record_hedge_win()
+                    return task.result()
+                error = task.exception()
+
+            if done:
+                continue
+            if loop.time() >= deadline:
+                raise asyncio.TimeoutError()
+            if can_hedge:
+                hedge_at = deadline
+                if tracker.allow_hedge():
+                    pending.add(launch(hedge))
+        raise error
+    finally:
+        cancelled_at = loop.time()
+        for task in pending:
+            # 未完成的调用真实耗时至少为已等待的时间
+            tracker.record(cancelled_at - started[task])
+            task.cancel()
+            # 被取消的调用可能已经以异常结束，取走异常避免事件循环告警
+            task.add_done_callback(lambda t: t.cancelled() or t.exception())
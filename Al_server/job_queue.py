@@ -0,0 +1,395 @@
+import asyncio
+import os
+import threading
+import time
+import uuid
+from collections import OrderedDict, deque
+from typing import Any, AsyncGenerator, Awaitable, Callable, Dict, List, Optional
+from context_executor import ContextThreadPoolExecutor
+from progress_store import MemoryProgressStore, ProgressStore
+
+# 任务状态
+JOB_QUEUED = "queued"
+JOB_RUNNING = "running"
+JOB_SUCCEEDED = "succeeded"
+JOB_FAILED = "failed"
+JOB_CANCELLED = "cancelled"
+FINISHED_STATES = {JOB_SUCCEEDED, JOB_FAILED, JOB_CANCELLED}
+# 表示任务结束的事件类型
+FINAL_EVENTS = {"job_complete", "job_failed", "job_cancelled"}
+# 跨进程取消任务的频道
+CANCEL_CHANNEL = "jobs:cancel"
+
+
+def job_key(job_id: str) -> str:
+    return f"job:{job_id}"
+
+
+def job_result_key(job_id: str) -> str:
+    return f"job:{job_id}:result"
+
+
+class QueueFullError(Exception):
+    """排队任务数已达上限"""
+
+
+class JobCancelled(Exception):
+    """任务在执行过程中被取消"""
+
+
+class Job:
+    """
+    一个后台任务：保存状态、最近的进度事件和最终结果。
+    cancel_event 在执行线程中检查，用于中途停止
+    """
+
+    def __init__(self, payload: Any, meta: Dict[str, Any] = None, cleanup: Callable[[], None] = None, history: int = 200,
+                 job_id: str = None):
+        self.id = job_id or uuid.uuid4().hex
+        self.payload = payload
+        self.meta = meta or {}
+        self.status = JOB_QUEUED
+        self.created_at = time.time()
+        self.started_at: Optional[float] = None
+        self.finished_at: Optional[float] = None
+        self.result: Any = None
+        self.error: Optional[str] = None
+        self.progress: Optional[Dict[str, Any]] = None
+        self.events = deque(maxlen=history)
+        self.cancel_event = threading.Event()
+        self._cleanup = cleanup
+        self._subscribers: List[asyncio.Queue] = []
+        self._seq = 0
+
+    @property
+    def finished(self) -> bool:
+        return self.status in FINISHED_STATES
+
+    def snapshot(self) -> Dict[str, Any]:
+        """任务状态（不含结果）"""
+        now = self.finished_at or time.time()
+        return {
+            "job_id": self.id,
+            "status": self.status,
+            "created_at": self.created_at,
+            "started_at": self.started_at,
+            "finished_at": self.finished_at,
+            "elapsed_seconds": round(now - (self.started_at or self.created_at), 2),
+            "progress": self.progress,
+            "error": self.error,
+            **self.meta
+        }
+
+
+class JobQueue:
+    """
+    有界后台任务队列：提交后立即返回任务ID，固定数量的worker按提交顺序执行；
+    排队数超过上限时拒绝提交，服务以排队而不是超时的方式降级。
+    进度事件可以轮询（最新一条），也可以订阅（先补发历史事件，再实时推送）。
+
+    任务状态、进度事件和结果同时写入 store，配置共享存储时，
+    其他worker进程也能查询、订阅和取消本进程执行的任务。
+    共享存储的读写是阻塞的网络调用，都放到线程中执行：写入交给单线程按顺序执行，不等待结果；
+    读取在线程池中执行并等待
+    """
+
+    def __init__(self, runner: Callable[[Job], Awaitable[Any]], concurrency: int = None, max_queued: int = None,
+                 max_finished: int = None, store: ProgressStore = None):
+        self.runner = runner
+        self.store = store or MemoryProgressStore()
+        self.concurrency = concurrency or int(os.getenv("JOB_WORKERS", "2"))
+        self.max_queued = max_queued or int(os.getenv("JOB_QUEUE_MAX", "20"))
+        # 已结束的任务最多保留多少个，超出后淘汰最早结束的
+        self.max_finished = max_finished or int(os.getenv("JOB_HISTORY_MAX", "200"))
+        self.jobs: "OrderedDict[str, Job]" = OrderedDict()
+        self._pending: deque = deque()
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        self._loop_thread: Optional[int] = None
+        self._wakeup: Optional[asyncio.Event] = None
+        self._workers: List[asyncio.Task] = []
+        self._listener: Optional[asyncio.Task] = None
+        # 单线程保证写入顺序（先写结果再发布结束事件）
+        self._store_writer = ContextThreadPoolExecutor(max_workers=1, thread_name_prefix="job-store")
+
+        # 统计
+        self.submitted = 0
+        self.rejected = 0
+        self.completed = 0
+        self.failed = 0
+        self.cancelled = 0
+
+    def start(self):
+        """在当前事件循环中启动worker"""
+        if self._workers:
+            return
+        self._loop = asyncio.get_event_loop()
+        self._loop_thread = threading.get_ident()
+        self._wakeup = asyncio.Event()
+        self._workers = [asyncio.ensure_future(self._worker()) for _ in range(self.concurrency)]
+        self._listener = asyncio.ensure_future(self._listen_cancel())
+
+    async def stop(self):
+        """停止worker，取消正在执行和排队中的任务"""
+        for job in list(self.jobs.values()):
+            if not job.finished:
+                self.cancel(job.id)
+        tasks = self._workers + ([self._listener] if self._listener else [])
+        for task in tasks:
+            task.cancel()
+        if tasks:
+            await asyncio.wait(tasks)
+        self._workers = []
+        self._listener = None
+        # 等待已提交的存储写入完成，结束事件写入后才关闭存储
+        await asyncio.wrap_future(self._store_writer.submit(lambda: None))
+
+    def submit(self, payload: Any, meta: Dict[str, Any] = None, cleanup: Callable[[], None] = None, job_id: str = None) -> Job:
+        """
+        提交任务
+
+        Args:
+            payload: 交给 runner 的任务数据
+            meta: 随状态一起返回的附加信息（如文件名）
+            cleanup: 任务结束（含排队中被取消）时调用，用于释放上传缓冲区等资源
+            job_id: 沿用已有任务ID（恢复任务时使用），默认生成新ID
+
+        Raises:
+            QueueFullError: 排队任务数已达上限
+        """
+        if len(self._pending) >= self.max_queued:
+            self.rejected += 1
+            raise QueueFullError(f"任务队列已满（{self.max_queued} 个排队中），请稍后重试")
+        job = Job(payload, meta, cleanup, job_id=job_id)
+        if job_id:
+            # 沿用旧ID时清掉上一次的结果，避免其他进程读到旧结果
+            self.jobs.pop(job_id, None)
+            self._write_store(self.store.delete, job_result_key(job_id))
+        self.jobs[job.id] = job
+        self._pending.append(job)
+        self.submitted += 1
+        self._publish(job, {"type": "job_queued", "message": "任务已提交，等待处理", "queue_position": len(self._pending)})
+        self._wakeup.set()
+        return job
+
+    def get(self, job_id: str) -> Optional[Job]:
+        return self.jobs.get(job_id)
+
+    def queue_position(self, job: Job) -> Optional[int]:
+        """排队中的任务前面还有几个任务（从1开始），不在排队时返回None"""
+        for position, pending in enumerate(self._pending, 1):
+            if pending is job:
+                return position
+        return None
+
+    def cancel(self, job_id: str) -> Optional[Job]:
+        """
+        取消任务：排队中的任务立即结束；执行中的任务在下一个检查点停止
+        """
+        job = self.jobs.get(job_id)
+        if job is None or job.finished:
+            return job
+        job.cancel_event.set()
+        if job.status == JOB_QUEUED:
+            self._pending.remove(job)
+            self._finish(job, JOB_CANCELLED, {"type": "job_cancelled", "message": "任务已取消"})
+        else:
+            self._publish(job, {"type": "job_cancelling", "message": "正在取消任务"})
+        return job
+
+    def publish(self, job: Job, event: Dict[str, Any]):
+        """发布进度事件，可以在执行线程中调用"""
+        if self._loop is not None and threading.get_ident() != self._loop_thread:
+            self._loop.call_soon_threadsafe(self._publish, job, event)
+        else:
+            self._publish(job, event)
+
+    def _publish(self, job: Job, event: Dict[str, Any]):
+        job._seq += 1
+        event = dict(event, seq=job._seq, job_id=job.id)
+        job.progress = event
+        job.events.append(event)
+        for subscriber in job._subscribers:
+            subscriber.put_nowait(event)
+        self._write_store(self._sync_job, job.id, job.snapshot(), event)
+
+    def _sync_job(self, job_id: str, snapshot: Dict[str, Any], event: Dict[str, Any]):
+        self.store.set(job_key(job_id), snapshot)
+        self.store.publish(job_key(job_id), event)
+
+    def _write_store(self, fn: Callable[..., None], *args):
+        """在写入线程中按提交顺序执行存储写入，共享存储不可用时不影响本进程内的任务"""
+        def write():
+            try:
+                fn(*args)
+            except Exception as e:
+                print(f"⚠️ 同步任务状态失败: {str(e)}")
+        self._store_writer.submit(write)
+
+    async def _read_store(self, fn: Callable[..., Any], *args) -> Any:
+        """在线程池中执行存储读取"""
+        return await asyncio.get_event_loop().run_in_executor(None, fn, *args)
+
+    async def subscribe(self, job: Job) -> AsyncGenerator[Dict[str, Any], None]:
+        """先补发已有事件，再实时推送，任务结束后停止"""
+        subscriber = asyncio.Queue()
+        history = list(job.events)
+        job._subscribers.append(subscriber)
+        try:
+            for event in history:
+                yield event
+            if job.finished:
+                return
+            last_seq = history[-1]["seq"] if history else 0
+            while True:
+                event = await subscriber.get()
+                if event["seq"] <= last_seq:
+                    continue
+                yield event
+                if event["type"] in FINAL_EVENTS:
+                    return
+        finally:
+            job._subscribers.remove(subscriber)
+
+    async def status(self, job_id: str) -> Optional[Dict[str, Any]]:
+        """任务状态：本进程的任务直接读取，其他进程的任务从存储中读取"""
+        job = self.jobs.get(job_id)
+        if job is not None:
+            return {**job.snapshot(), "queue_position": self.queue_position(job)}
+        return await self._read_store(self.store.get, job_key(job_id))
+
+    async def result(self, job_id: str) -> Optional[Dict[str, Any]]:
+        """已结束任务的结果 {"status", "result", "error"}，未结束或不存在时返回None"""
+        job = self.jobs.get(job_id)
+        if job is not None:
+            return {"status": job.status, "result": job.result, "error": job.error} if job.finished else None
+        return await self._read_store(self.store.get, job_result_key(job_id))
+
+    async def request_cancel(self, job_id: str) -> Optional[Dict[str, Any]]:
+        """取消任务，任务在其他进程中执行时通过存储通知该进程"""
+        job = self.jobs.get(job_id)
+        if job is not None:
+            self.cancel(job_id)
+            return job.snapshot()
+        snapshot = await self._read_store(self.store.get, job_key(job_id))
+        if snapshot is not None and snapshot["status"] not in FINISHED_STATES:
+            self._write_store(self.store.publish, CANCEL_CHANNEL, {"job_id": job_id})
+        return snapshot
+
+    async def events(self, job_id: str, poll_interval: float = 15) -> Optional[AsyncGenerator[Dict[str, Any], None]]:
+        """
+        订阅任务进度，任务不存在时返回None。
+        其他进程的任务先产出最新一条事件，再转发存储中的实时事件；
+        每隔 poll_interval 秒核对一次状态，避免错过结束事件后一直等待
+        """
+        job = self.jobs.get(job_id)
+        if job is not None:
+            return self.subscribe(job)
+        snapshot = await self._read_store(self.store.get, job_key(job_id))
+        if snapshot is None:
+            return None
+        return self._remote_events(job_id, snapshot, poll_interval)
+
+    async def _remote_events(self, job_id: str, snapshot: Dict[str, Any], poll_interval: float) -> AsyncGenerator[Dict[str, Any], None]:
+        received = asyncio.Queue()
+
+        async def pump():
+            async for message in self.store.subscribe(job_key(job_id)):
+                received.put_nowait(message)
+
+        pump_task = asyncio.ensure_future(pump())
+        try:
+            last_seq = 0
+            while True:
+                progress = snapshot.get("progress") if snapshot else None
+                if progress and progress["seq"] > last_seq:
+                    last_seq = progress["seq"]
+                    yield progress
+                    if progress["type"] in FINAL_EVENTS:
+                        return
+                if snapshot is None or snapshot["status"] in FINISHED_STATES:
+                    return
+                try:
+                    snapshot = {"status": JOB_RUNNING, "progress": await asyncio.wait_for(received.get(), poll_interval)}
+                except asyncio.TimeoutError:
+                    snapshot = await self._read_store(self.store.get, job_key(job_id))
+        finally:
+            pump_task.cancel()
+            await asyncio.wait([pump_task])
+
+    async def _listen_cancel(self):
+        """接收其他进程发来的取消请求，共享存储断开时稍后重连"""
+        while True:
+            try:
+                async for message in self.store.subscribe(CANCEL_CHANNEL):
+                    if message.get("job_id") in self.jobs:
+                        self.cancel(message["job_id"])
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                print(f"⚠️ 任务取消频道订阅失败，5秒后重试: {str(e)}")
+                await asyncio.sleep(5)
+
+    def _finish(self, job: Job, status: str, event: Dict[str, Any]):
+        job.status = status
+        job.finished_at = time.time()
+        if status == JOB_SUCCEEDED:
+            self.completed += 1
+        elif status == JOB_FAILED:
+            self.failed += 1
+        else:
+            self.cancelled += 1
+        # 先写结果再发布结束事件，订阅者收到结束事件时结果已可读取
+        self._write_store(self.store.set, job_result_key(job.id), {"status": job.status, "result": job.result, "error": job.error})
+        self._publish(job, event)
+        if job._cleanup is not None:
+            try:
+                job._cleanup()
+            except Exception as e:
+                print(f"⚠️ 任务 {job.id} 清理失败: {str(e)}")
+            job._cleanup = None
+        job.payload = None
+        if job.id in self.jobs:
+            # 已结束的任务按结束顺序排列，淘汰时从最早结束的开始
+            self.jobs.move_to_end(job.id)
+        self._evict_finished()
+
+    def _evict_finished(self):
+        finished = [job_id for job_id, job in self.jobs.items() if job.finished]
+        for job_id in finished[:max(len(finished) - self.max_finished, 0)]:
+            del self.jobs[job_id]
+
+    async def _worker(self):
+        while True:
+            while not self._pending:
+                self._wakeup.clear()
+                await self._wakeup.wait()
+            job = self._pending.popleft()
+            job.status = JOB_RUNNING
+            job.started_at = time.time()
+            self._publish(job, {"type": "job_started", "message": "任务开始处理"})
+            try:
+                job.result = await self.runner(job)
+            except asyncio.CancelledError:
+                self._finish(job, JOB_CANCELLED, {"type": "job_cancelled", "message": "任务已取消"})
+                raise
+            except JobCancelled:
+                self._finish(job, JOB_CANCELLED, {"type": "job_cancelled", "message": "任务已取消"})
+            except Exception as e:
+                job.error = str(e)
+                print(f"❌ 任务 {job.id} 失败: {str(e)}")
+                self._finish(job, JOB_FAILED, {"type": "job_failed", "message": f"任务失败: {str(e)}", "error": str(e)})
+            else:
+                self._finish(job, JOB_SUCCEEDED, {"type": "job_complete", "message": "任务完成"})
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "concurrency": self.concurrency,
+            "max_queued": self.max_queued,
+            "queued": len(self._pending),
+            "running": sum(1 for job in self.jobs.values() if job.status == JOB_RUNNING),
+            "submitted": self.submitted,
+            "rejected": self.rejected,
+            "completed": self.completed,
+            "failed": self.failed,
+            "cancelled": self.cancelled
+        }
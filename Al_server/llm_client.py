@@ -0,0 +1,485 @@
+import asyncio
+import hashlib
+import json
+import os
+import threading
+import time
+import requests
+from concurrent.futures import ThreadPoolExecutor
+from requests.adapters import HTTPAdapter
+from typing import Any, AsyncGenerator, AsyncIterator, Dict, Generator, Iterator, Optional
+from metrics import STREAM_TOKENS_PER_SECOND, UPSTREAM_LATENCY_SECONDS, UPSTREAM_TTFB_SECONDS
+from rate_governor import RateGovernor, estimate_request_tokens
+from tracing import SPAN_CANCELLED, span, start_span
+from singleflight import AsyncSingleFlight, AsyncStreamGroup, SingleFlight, StreamGroup
+from token_usage import current_usage, normalize_usage, record_usage
+
+DASHSCOPE_API_URL = "https://dashscope.aliyuncs.com/compatible-mode/v1/chat/completions"
+DASHSCOPE_BASE_URL = "https://dashscope.aliyuncs.com"
+
+# SSE流结束标记
+SSE_DONE = object()
+
+
+def parse_sse_line(line_str: str) -> Optional[Any]:
+    """
+    解析一行SSE数据
+
+    Returns:
+        解析后的JSON对象；流结束返回 SSE_DONE；非数据行或无法解析返回 None
+    """
+    if not line_str.startswith('data: '):
+        return None
+    data_str = line_str[6:]  # 移除 'data: ' 前缀
+    if data_str.strip() == '[DONE]':
+        return SSE_DONE
+    try:
+        return json.loads(data_str)
+    except json.JSONDecodeError:
+        return None
+
+
+def extract_finish_reason(chunk_data: Dict[str, Any]) -> Optional[str]:
+    """从流式响应块中取出结束原因（stop / length 等），未结束时为None"""
+    if 'choices' in chunk_data and len(chunk_data['choices']) > 0:
+        return chunk_data['choices'][0].get('finish_reason')
+    return None
+
+
+class StreamEnd:
+    """
+    流式响应结束标记，携带结束原因和token用量；finish_reason 为 "length" 表示输出达到 max_tokens 被截断，
+    usage 为规整后的用量（请求需带 stream_options.include_usage），上游没有返回时为None
+    """
+
+    def __init__(self, finish_reason: Optional[str] = None, usage: Optional[Dict[str, int]] = None):
+        self.finish_reason = finish_reason
+        self.usage = usage
+
+
+def _text_only(stream: Iterator[Any]) -> Generator[str, None, None]:
+    """过滤掉 StreamEnd，只保留增量文本"""
+    try:
+        for item in stream:
+            if not isinstance(item, StreamEnd):
+                yield item
+    finally:
+        stream.close()
+
+
+async def _atext_only(stream: AsyncIterator[Any]) -> AsyncGenerator[str, None]:
+    try:
+        async for item in stream:
+            if not isinstance(item, StreamEnd):
+                yield item
+    finally:
+        await stream.aclose()
+
+
+def extract_delta_content(chunk_data: Dict[str, Any]) -> Optional[str]:
+    """从流式响应块中取出增量文本"""
+    if 'choices' in chunk_data and len(chunk_data['choices']) > 0:
+        delta = chunk_data['choices'][0].get('delta', {})
+        if 'content' in delta:
+            return delta['content']
+    return None
+
+
+class _StreamTiming:
+    """
+    记录一次上游流式调用的指标：首段文本耗时、总耗时和生成速度，结束时记录token用量。
+    响应带 usage 时按其中的 completion_tokens 计算速度，否则按增量块数近似（每块约一个token）
+    """
+
+    __slots__ = ("processor", "model", "started", "first_chunk", "last_chunk", "chunks", "usage", "outcome", "_finished",
+                 "span", "_collector")
+
+    def __init__(self, processor: str, model: str = None):
+        self.processor = processor
+        self.model = model
+        # 结束时可能在关闭生成器的其他上下文中，用量记入发起请求时的统计范围
+        self._collector = current_usage.get()
+        # 跨越 yield，不能设为当前span
+        self.span = start_span("llm.upstream", processor=processor, mode="stream", model=model)
+        self.started = time.perf_counter()
+        self.first_chunk = None
+        self.last_chunk = None
+        self.chunks = 0
+        self.usage = None
+        # 流被下游提前关闭时记为 cancelled
+        self.outcome = "cancelled"
+        self._finished = False
+
+    def chunk(self, chunk_data: Dict[str, Any]):
+        now = time.perf_counter()
+        if chunk_data.get("usage"):
+            # include_usage 时用量在最后一个块中（choices 为空）
+            self.usage = normalize_usage(chunk_data["usage"])
+        if extract_delta_content(chunk_data) is None:
+            return
+        if self.first_chunk is None:
+            self.first_chunk = now
+            UPSTREAM_TTFB_SECONDS.labels(self.processor, "stream").observe(now - self.started)
+            self.span.set_attribute("ttfb_ms", round((now - self.started) * 1000, 2))
+        self.last_chunk = now
+        self.chunks += 1
+
+    def finish(self, outcome: str = None, error: Exception = None):
+        if self._finished:
+            return
+        self._finished = True
+        outcome = outcome or self.outcome
+        UPSTREAM_LATENCY_SECONDS.labels(self.processor, "stream", outcome).observe(time.perf_counter() - self.started)
+        self.span.set_attributes(outcome=outcome, chunks=self.chunks)
+        if self.usage is not None:
+            record_usage(self.usage, self.model, self.processor, self._collector)
+            self.span.set_attributes(prompt_tokens=self.usage["prompt_tokens"], completion_tokens=self.usage["completion_tokens"])
+        elif self.chunks:
+            # 已经生成了输出却没有用量（被提前关闭或上游未返回 usage），计入 unreported
+            record_usage(None, self.model, self.processor)
+        if error is not None:
+            self.span.record_error(error)
+        elif outcome == "cancelled":
+            self.span.status = SPAN_CANCELLED
+        self.span.end()
+        if outcome == "ok" and self.chunks > 1:
+            tokens = self.usage["completion_tokens"] if self.usage is not None else self.chunks
+            generating = self.last_chunk - self.first_chunk
+            if generating > 0:
+                STREAM_TOKENS_PER_SECOND.labels(self.processor).observe(tokens / generating)
+
+
+class LLMClient:
+    """
+    DashScope共享客户端，所有处理器共用同一组长连接：
+    同步调用走 requests.Session 连接池，异步调用走 aiohttp 连接池。
+    参数完全相同的并发请求会合并为一次上游调用（流式请求对后加入者回放已收到的内容）；
+    实际发出的上游请求统一经过 RateGovernor 限速、限并发并在429/503时退避重试
+    """
+
+    def __init__(self, api_key: str = None, api_url: str = None, pool_size: int = None, connect_timeout: float = None,
+                 governor: RateGovernor = None):
+        self.api_key = api_key or os.getenv("DASHSCOPE_API_KEY")
+        self.api_url = api_url or DASHSCOPE_API_URL
+        self.pool_size = pool_size or int(os.getenv("LLM_POOL_SIZE", "20"))
+        self.connect_timeout = connect_timeout or float(os.getenv("LLM_CONNECT_TIMEOUT", "5"))
+        self.prewarm_connections = int(os.getenv("LLM_PREWARM_CONNECTIONS", "2"))
+
+        self._session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=self.pool_size)
+        self._session.mount("https://", adapter)
+        self._session.mount("http://", adapter)
+
+        self._async_session = None
+        self._async_loop = None
+
+        # 相同请求合并
+        self.coalesce = os.getenv("LLM_COALESCE", "1") != "0"
+        self._flights = SingleFlight()
+        self._async_flights = AsyncSingleFlight()
+        self._streams = StreamGroup()
+        self._async_streams = AsyncStreamGroup()
+
+        # 全局限速
+        self.governor = governor or RateGovernor()
+
+    def _headers(self, api_key: str = None) -> Dict[str, str]:
+        return {
+            "Content-Type": "application/json",
+            "Authorization": f"Bearer {api_key or self.api_key}"
+        }
+
+    def _request_key(self, payload: Dict[str, Any], api_key: str = None) -> str:
+        """相同API密钥和请求体的请求视为同一请求"""
+        raw_key = json.dumps({
+            "url": self.api_url,
+            "api_key": api_key or self.api_key,
+            "payload": payload
+        }, ensure_ascii=False, sort_keys=True)
+        return hashlib.sha256(raw_key.encode("utf-8")).hexdigest()
+
+    def _get_async_session(self):
+        """懒加载aiohttp会话，会话与创建它的事件循环绑定"""
+        import aiohttp
+
+        loop = asyncio.get_event_loop()
+        if self._async_session is None or self._async_session.closed or self._async_loop is not loop:
+            connector = aiohttp.TCPConnector(limit=self.pool_size, keepalive_timeout=60)
+            self._async_session = aiohttp.ClientSession(connector=connector)
+            self._async_loop = loop
+        return self._async_session
+
+    def _async_timeout(self, timeout: float):
+        import aiohttp
+        return aiohttp.ClientTimeout(total=timeout, sock_connect=self.connect_timeout)
+
+    def post_json(self, payload: Dict[str, Any], api_key: str = None, timeout: float = 120, coalesce: bool = True,
+                  processor: str = "default") -> Dict[str, Any]:
+        """
+        同步发送非流式请求
+
+        Args:
+            payload: 请求体
+            api_key: 覆盖默认API密钥
+            timeout: 读取超时（秒），连接超时由 LLM_CONNECT_TIMEOUT 控制
+            coalesce: 是否与进行中的相同请求合并
+            processor: 调用方处理器名称，作为上游耗时指标的标签
+
+        Returns:
+            Dict: 响应JSON
+        """
+        if not (self.coalesce and coalesce):
+            return self._post_json(payload, api_key, timeout, processor)
+        return self._flights.do(
+            self._request_key(payload, api_key),
+            lambda: self._post_json(payload, api_key, timeout, processor)
+        )
+
+    def _post_json(self, payload: Dict[str, Any], api_key: str, timeout: float, processor: str) -> Dict[str, Any]:
+        return self.governor.call(
+            lambda: self._send_json(payload, api_key, timeout, processor),
+            estimate_request_tokens(payload)
+        )
+
+    def _send_json(self, payload: Dict[str, Any], api_key: str, timeout: float, processor: str) -> Dict[str, Any]:
+        started = time.perf_counter()
+        outcome = "error"
+        try:
+            with span("llm.upstream", processor=processor, mode="json", model=payload.get("model")) as upstream:
+                response = self._session.post(
+                    self.api_url,
+                    headers=self._headers(api_key),
+                    json=payload,
+                    timeout=(self.connect_timeout, timeout)
+                )
+                # elapsed 为发出请求到解析完响应头的时间
+                ttfb = response.elapsed.total_seconds()
+                UPSTREAM_TTFB_SECONDS.labels(processor, "json").observe(ttfb)
+                upstream.set_attributes(**{"http.status_code": response.status_code, "ttfb_ms": round(ttfb * 1000, 2)})
+                response.raise_for_status()
+                result = response.json()
+                outcome = "ok"
+                self._record_usage(result, payload, processor, upstream)
+                return result
+        finally:
+            UPSTREAM_LATENCY_SECONDS.labels(processor, "json", outcome).observe(time.perf_counter() - started)
+
+    def _record_usage(self, result: Dict[str, Any], payload: Dict[str, Any], processor: str, upstream):
+        """记录非流式响应中的token用量，写入上游span"""
+        usage = record_usage(result.get("usage"), payload.get("model"), processor)
+        if usage is not None:
+            upstream.set_attributes(prompt_tokens=usage["prompt_tokens"], completion_tokens=usage["completion_tokens"])
+
+    def stream_chat(self, payload: Dict[str, Any], api_key: str = None, timeout: float = 120, coalesce: bool = True,
+                    include_end: bool = False, processor: str = "default") -> Generator[Any, None, None]:
+        """
+        同步发送流式请求，逐块产出增量文本；生成器被关闭时立即释放上游连接
+
+        Args:
+            payload: 请求体（需包含 "stream": True）
+            api_key: 覆盖默认API密钥
+            timeout: 读取超时（秒）
+            coalesce: 是否与进行中的相同流合并
+            include_end: 为True时在流末尾额外产出一个 StreamEnd，用于判断输出是否被截断
+            processor: 调用方处理器名称，作为上游耗时指标的标签
+        """
+        if not (self.coalesce and coalesce):
+            stream = self._stream_chat(payload, api_key, timeout, processor)
+        else:
+            stream = self._streams.subscribe(
+                self._request_key(payload, api_key),
+                lambda: self._stream_chat(payload, api_key, timeout, processor)
+            )
+        return stream if include_end else _text_only(stream)
+
+    def _stream_chat(self, payload: Dict[str, Any], api_key: str, timeout: float, processor: str) -> Generator[str, None, None]:
+        return self.governor.stream(
+            lambda: self._send_stream(payload, api_key, timeout, processor),
+            estimate_request_tokens(payload)
+        )
+
+    def _send_stream(self, payload: Dict[str, Any], api_key: str, timeout: float, processor: str) -> Generator[str, None, None]:
+        timing = _StreamTiming(processor, payload.get("model"))
+        try:
+            response = self._session.post(
+                self.api_url,
+                headers=self._headers(api_key),
+                json=payload,
+                timeout=(self.connect_timeout, timeout),
+                stream=True
+            )
+        except Exception as e:
+            timing.finish("error", e)
+            raise
+        try:
+            timing.span.set_attribute("http.status_code", response.status_code)
+            response.raise_for_status()
+            finish_reason = None
+            for line in response.iter_lines():
+                if not line:
+                    continue
+                chunk_data = parse_sse_line(line.decode('utf-8'))
+                if chunk_data is SSE_DONE:
+                    break
+                if chunk_data is None:
+                    continue
+                timing.chunk(chunk_data)
+                content = extract_delta_content(chunk_data)
+                if content is not None:
+                    yield content
+                finish_reason = extract_finish_reason(chunk_data) or finish_reason
+            timing.outcome = "ok"
+            yield StreamEnd(finish_reason, timing.usage)
+        except Exception as e:
+            timing.outcome = "error"
+            timing.span.record_error(e)
+            raise
+        finally:
+            response.close()
+            timing.finish()
+
+    async def apost_json(self, payload: Dict[str, Any], api_key: str = None, timeout: float = 120, coalesce: bool = True,
+                         processor: str = "default") -> Dict[str, Any]:
+        """异步发送非流式请求，参数同 post_json"""
+        if not (self.coalesce and coalesce):
+            return await self._apost_json(payload, api_key, timeout, processor)
+        return await self._async_flights.do(
+            self._request_key(payload, api_key),
+            lambda: self._apost_json(payload, api_key, timeout, processor)
+        )
+
+    async def _apost_json(self, payload: Dict[str, Any], api_key: str, timeout: float, processor: str) -> Dict[str, Any]:
+        return await self.governor.acall(
+            lambda: self._asend_json(payload, api_key, timeout, processor),
+            estimate_request_tokens(payload)
+        )
+
+    async def _asend_json(self, payload: Dict[str, Any], api_key: str, timeout: float, processor: str) -> Dict[str, Any]:
+        session = self._get_async_session()
+        started = time.perf_counter()
+        outcome = "error"
+        try:
+            with span("llm.upstream", processor=processor, mode="json", model=payload.get("model")) as upstream:
+                async with session.post(
+                    self.api_url,
+                    headers=self._headers(api_key),
+                    json=payload,
+                    timeout=self._async_timeout(timeout)
+                ) as response:
+                    ttfb = time.perf_counter() - started
+                    UPSTREAM_TTFB_SECONDS.labels(processor, "json").observe(ttfb)
+                    upstream.set_attributes(**{"http.status_code": response.status, "ttfb_ms": round(ttfb * 1000, 2)})
+                    response.raise_for_status()
+                    result = await response.json()
+                    outcome = "ok"
+                    self._record_usage(result, payload, processor, upstream)
+                    return result
+        finally:
+            UPSTREAM_LATENCY_SECONDS.labels(processor, "json", outcome).observe(time.perf_counter() - started)
+
+    def astream_chat(self, payload: Dict[str, Any], api_key: str = None, timeout: float = 120, coalesce: bool = True,
+                     include_end: bool = False, processor: str = "default") -> AsyncGenerator[Any, None]:
+        """异步发送流式请求，参数同 stream_chat"""
+        if not (self.coalesce and coalesce):
+            stream = self._astream_chat(payload, api_key, timeout, processor)
+        else:
+            stream = self._async_streams.subscribe(
+                self._request_key(payload, api_key),
+                lambda: self._astream_chat(payload, api_key, timeout, processor)
+            )
+        return stream if include_end else _atext_only(stream)
+
+    def _astream_chat(self, payload: Dict[str, Any], api_key: str, timeout: float, processor: str) -> AsyncGenerator[str, None]:
+        return self.governor.astream(
+            lambda: self._asend_stream(payload, api_key, timeout, processor),
+            estimate_request_tokens(payload)
+        )
+
+    async def _asend_stream(self, payload: Dict[str, Any], api_key: str, timeout: float, processor: str) -> AsyncGenerator[str, None]:
+        session = self._get_async_session()
+        timing = _StreamTiming(processor, payload.get("model"))
+        try:
+            async with session.post(
+                self.api_url,
+                headers=self._headers(api_key),
+                json=payload,
+                timeout=self._async_timeout(timeout)
+            ) as response:
+                timing.span.set_attribute("http.status_code", response.status)
+                response.raise_for_status()
+                finish_reason = None
+                async for line in response.content:
+                    chunk_data = parse_sse_line(line.decode('utf-8'))
+                    if chunk_data is SSE_DONE:
+                        break
+                    if chunk_data is None:
+                        continue
+                    timing.chunk(chunk_data)
+                    content = extract_delta_content(chunk_data)
+                    if content is not None:
+                        yield content
+                    finish_reason = extract_finish_reason(chunk_data) or finish_reason
+                timing.outcome = "ok"
+                yield StreamEnd(finish_reason, timing.usage)
+        except Exception as e:
+            timing.outcome = "error"
+            timing.span.record_error(e)
+            raise
+        finally:
+            timing.finish()
+
+    def coalescing_stats(self) -> Dict[str, int]:
+        """请求合并统计：executed 为实际发出的上游请求数，shared 为被合并掉的请求数"""
+        groups = [self._flights, self._async_flights, self._streams, self._async_streams]
+        return {
+            "executed": sum(group.executed for group in groups),
+            "shared": sum(group.shared for group in groups)
+        }
+
+    def prewarm(self):
+        """预先建立若干条长连接，完成TCP+TLS握手，避免首个请求承担握手延迟"""
+        def touch():
+            try:
+                self._session.head(DASHSCOPE_BASE_URL, timeout=self.connect_timeout)
+            except Exception as e:
+                print(f"⚠️ 预热连接失败: {str(e)}")
+
+        with ThreadPoolExecutor(max_workers=self.prewarm_connections) as executor:
+            for _ in range(self.prewarm_connections):
+                executor.submit(touch)
+
+    async def aprewarm(self):
+        """预热异步连接池"""
+        session = self._get_async_session()
+
+        async def touch():
+            try:
+                async with session.head(DASHSCOPE_BASE_URL, timeout=self._async_timeout(self.connect_timeout)):
+                    pass
+            except Exception as e:
+                print(f"⚠️ 预热异步连接失败: {str(e)}")
+
+        await asyncio.gather(*(touch() for _ in range(self.prewarm_connections)))
+
+    def close(self):
+        """关闭同步连接池"""
+        self._session.close()
+
+    async def aclose(self):
+        """关闭异步连接池"""
+        if self._async_session is not None and not self._async_session.closed:
+            await self._async_session.close()
+        self._async_session = None
+
+
+_client = None
+_client_lock = threading.Lock()
+
+
+def get_llm_client() -> LLMClient:
+    """获取进程内共享的LLM客户端"""
+    global _client
+    with _client_lock:
+        if _client is None:
+            _client = LLMClient()
+        return _client
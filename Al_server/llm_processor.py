@@ -1,21 +1,43 @@
+import hashlib
 import json
 import os
-import requests
-from typing import Dict, Any, List
-from concurrent.futures import ThreadPoolExecutor, as_completed
+from llm_client import LLMClient, get_llm_client
+from typing import Callable, Dict, Any, List, Iterable
+from concurrent.futures import as_completed
+from context_executor import ContextThreadPoolExecutor
 import threading
+import time
+from text_segmenter import QuestionSegmenter
+from cache_store import SQLiteCache
+from progress_store import MemoryProgressStore, ProgressStore, progress_key
+from segment_checkpoint import SegmentCheckpoint
+from pdf_extractor import join_page_texts
+from metrics import PARSE_FAILURES, SPLIT_SECONDS
+from tracing import SPAN_ERROR, span
+
+# 修改题目提取prompt时递增，使旧的片段缓存失效
+SEGMENT_PROMPT_VERSION = "v1"
 
 class LLMProcessor:
     """
     大模型处理器，支持智能分割和实时进度显示
     """
     
-    def __init__(self, api_key: str = None, max_tokens: int = 8000, model: str = None):
+    def __init__(self, api_key: str = None, max_tokens: int = 8000, model: str = None, client: LLMClient = None, cache: SQLiteCache = None,
+                 progress_store: ProgressStore = None):
         self.api_key = api_key or os.getenv("DASHSCOPE_API_KEY")
-        self.api_url = "https://dashscope.aliyuncs.com/compatible-mode/v1/chat/completions"
+        # 共享连接池的DashScope客户端
+        self.client = client or get_llm_client()
         self.model = model or os.getenv("LLM_MODEL", "qwen-plus-latest")
         self.max_tokens = max_tokens
         self.max_input_length = 3000
+        # 片段解析结果缓存，重新处理同一份试卷时只为内容变化的片段付费
+        self.cache = cache
+        # 带 progress_id 处理时写入进度的存储
+        self.progress_store = progress_store or MemoryProgressStore()
+        # 片段调用失败或返回无法解析时的自动重试：最大尝试次数和重试间隔（按尝试次数递增）
+        self.segment_max_attempts = int(os.getenv("SEGMENT_MAX_ATTEMPTS", "3"))
+        self.segment_retry_delay = float(os.getenv("SEGMENT_RETRY_DELAY", "1"))
     
     def create_split_prompt(self, pdf_text: str) -> str:
         """创建分割题目的prompt"""
@@ -80,11 +102,6 @@ PDF文本：
     def call_api(self, prompt: str) -> str:
         """调用DashScope API"""
         try:
-            headers = {
-                "Content-Type": "application/json",
-                "Authorization": f"Bearer {self.api_key}"
-            }
-            
             data = {
                 "model": self.model,
                 "messages": [
@@ -94,10 +111,7 @@ PDF文本：
                 "temperature": 0,
             }
             
-            response = requests.post(self.api_url, headers=headers, json=data, timeout=120)
-            response.raise_for_status()
-            
-            result = response.json()
+            result = self.client.post_json(data, api_key=self.api_key, timeout=120, processor="llm_processor")
             return result["choices"][0]["message"]["content"]
             
         except Exception as e:
@@ -128,10 +142,13 @@ PDF文本：
                     raise ValueError("无法找到有效的JSON格式")
                 
         except json.JSONDecodeError as e:
+            PARSE_FAILURES.labels("segment_json").inc()
             raise ValueError(f"JSON解析失败: {str(e)}")
         except Exception as e:
+            PARSE_FAILURES.labels("segment_json").inc()
             raise ValueError(f"解析响应失败: {str(e)}")
     
+    @SPLIT_SECONDS.labels("heuristic").time()
     def split_text_intelligently(self, pdf_text: str) -> List[Dict[str, Any]]:
         """快速启发式分割文本"""
         try:
@@ -283,21 +300,59 @@ PDF文本：
     
 
     
+    def make_segment_cache_key(self, content: str, expected_questions: int = None) -> str:
+        """由片段内容、预期题目数、模型和prompt版本生成缓存键"""
+        raw_key = json.dumps({
+            "content": content,
+            "expected_questions": expected_questions,
+            "model": self.model,
+            "version": SEGMENT_PROMPT_VERSION
+        }, ensure_ascii=False, sort_keys=True)
+        return "segment:" + hashlib.sha256(raw_key.encode("utf-8")).hexdigest()
+    
     def process_segment(self, segment: Dict[str, Any], segment_index: int, expected_questions: int = None) -> Dict[str, Any]:
         """处理单个片段"""
+        with span("process_segment", segment_index=segment_index) as attempt_span:
+            result = self._process_segment(segment, segment_index, expected_questions)
+            attempt_span.set_attributes(success=result["success"], cache_hit=result.get("cache_hit", False))
+            if result.get("error"):
+                attempt_span.status = SPAN_ERROR
+                attempt_span.error = result["error"]
+            return result
+
+    def _process_segment(self, segment: Dict[str, Any], segment_index: int, expected_questions: int = None) -> Dict[str, Any]:
         try:
+            cache_key = self.make_segment_cache_key(segment['content'], expected_questions) if self.cache else None
+            if cache_key:
+                cached = self.cache.get(cache_key)
+                if cached is not None:
+                    questions = json.loads(cached)
+                    print(f"⚡ 第 {segment_index + 1} 个片段命中缓存，{len(questions)} 个题目")
+                    return {
+                        "segment_index": segment_index,
+                        "segment_id": segment.get("id", segment_index + 1),
+                        "questions": questions,
+                        "success": True,
+                        "cache_hit": True
+                    }
+            
             print(f"🔄 开始处理第 {segment_index + 1} 个片段...")
             prompt = self.create_question_prompt(segment['content'], expected_questions)
             response = self.call_api(prompt)
-            questions = self.parse_json_response(response)
+            with span("segment.parse", chars=len(response)):
+                questions = self.parse_json_response(response)
             
             if isinstance(questions, list):
                 print(f"✅ 第 {segment_index + 1} 个片段完成，提取到 {len(questions)} 个题目")
+                # 只缓存解析成功的结果
+                if cache_key:
+                    self.cache.set(cache_key, json.dumps(questions, ensure_ascii=False))
                 return {
                     "segment_index": segment_index,
                     "segment_id": segment.get("id", segment_index + 1),
                     "questions": questions,
-                    "success": True
+                    "success": True,
+                    "cache_hit": False
                 }
             else:
                 print(f"⚠️ 第 {segment_index + 1} 个片段解析失败")
@@ -318,6 +373,36 @@ PDF文本：
                 "error": str(e)
             }
 
+    def process_segment_with_retry(self, segment: Dict[str, Any], segment_index: int, expected_questions: int = None,
+                                   cancel_event: threading.Event = None) -> Dict[str, Any]:
+        """
+        处理单个片段，调用失败或返回无法解析时自动重试，最多 segment_max_attempts 次；
+        结果中的 attempts 为实际尝试次数
+        """
+        with span("segment", segment_index=segment_index, chars=len(segment["content"])) as segment_span:
+            attempts = 0
+            while True:
+                attempts += 1
+                result = self.process_segment(segment, segment_index, expected_questions)
+                result["attempts"] = attempts
+                if result["success"] or attempts >= self.segment_max_attempts:
+                    break
+                delay = self.segment_retry_delay * attempts
+                if cancel_event is None:
+                    time.sleep(delay)
+                elif cancel_event.wait(delay):
+                    break
+                print(f"🔁 第 {segment_index + 1} 个片段第 {attempts + 1} 次尝试")
+            segment_span.set_attributes(attempts=attempts, success=result["success"], questions=len(result["questions"]))
+            return result
+
+    def _report_progress(self, progress_id: str, event: Dict[str, Any], on_progress: Callable[[Dict[str, Any]], None] = None):
+        """写入进度存储，并通知进度回调"""
+        if progress_id:
+            self.progress_store.set(progress_key(progress_id), event)
+        if on_progress:
+            on_progress(event)
+
     def process_pdf_text_with_progress(self, pdf_text: str, max_workers: int = 3, progress_id: str = None, expected_questions: int = None) -> List[Dict[str, Any]]:
         """处理PDF文本（带进度版本）"""
         try:
@@ -325,14 +410,12 @@ PDF文本：
             self.last_segments = segments  # 保存分割结果
             
             # 发送分割完成消息
-            if progress_id:
-                from main import progress_storage
-                progress_storage[progress_id] = {
-                    "type": "split_complete",
-                    "message": f"分割完成，共 {len(segments)} 个片段",
-                    "segment_count": len(segments),
-                    "parallel_workers": max_workers
-                }
+            self._report_progress(progress_id, {
+                "type": "split_complete",
+                "message": f"分割完成，共 {len(segments)} 个片段",
+                "segment_count": len(segments),
+                "parallel_workers": max_workers
+            })
             
             print(f"📊 分割为 {len(segments)} 个片段，使用 {max_workers} 个并行线程")
             
@@ -341,10 +424,10 @@ PDF文本：
             completed_count = 0
             
             # 使用线程池进行并行处理
-            with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            with ContextThreadPoolExecutor(max_workers=max_workers) as executor:
                 # 提交所有任务
                 future_to_segment = {
-                    executor.submit(self.process_segment, segment, i, expected_questions): (i, segment)
+                    executor.submit(self.process_segment_with_retry, segment, i, expected_questions): (i, segment)
                     for i, segment in enumerate(segments)
                 }
                 
@@ -358,16 +441,14 @@ PDF文本：
                         completed_count += 1
                         
                         # 发送进度更新
-                        if progress_id:
-                            from main import progress_storage
-                            progress_storage[progress_id] = {
-                                "type": "progress",
-                                "message": f"处理第 {completed_count}/{len(segments)} 个片段",
-                                "completed": completed_count,
-                                "total": len(segments),
-                                "questions_found": len(result.get("questions", [])),
-                                "total_questions": sum(len(r.get("questions", [])) for r in segment_results if r is not None)
-                            }
+                        self._report_progress(progress_id, {
+                            "type": "progress",
+                            "message": f"处理第 {completed_count}/{len(segments)} 个片段",
+                            "completed": completed_count,
+                            "total": len(segments),
+                            "questions_found": len(result.get("questions", [])),
+                            "total_questions": sum(len(r.get("questions", [])) for r in segment_results if r is not None)
+                        })
                         
                         print(f"📈 进度: {completed_count}/{len(segments)} 个片段已完成")
                     except Exception as e:
@@ -393,6 +474,169 @@ PDF文本：
         except Exception as e:
             raise Exception(f"处理PDF文本失败: {str(e)}")
     
+    def process_pdf_pages_with_progress(self, pages: Iterable[str], max_workers: int = 3, progress_id: str = None, expected_questions: int = None,
+                                        on_progress: Callable[[Dict[str, Any]], None] = None, cancel_event: threading.Event = None,
+                                        checkpoint: SegmentCheckpoint = None) -> List[Dict[str, Any]]:
+        """
+        流水线处理PDF（带进度版本）：页面边提取边按题目边界切分，
+        每切出一个由完整题目组成的片段就立即提交给线程池调用大模型
+
+        Args:
+            pages: 按页码顺序产出页面文本的迭代器
+            max_workers: 并行线程数
+            progress_id: 进度ID
+            expected_questions: 预期题目数量
+            on_progress: 进度回调，收到与进度存储相同的事件
+            cancel_event: 被设置后不再提取新页面，尚未开始的片段直接跳过，返回已完成片段的题目
+            checkpoint: 片段检查点，记录每个片段的状态和题目，用于之后只重试失败的片段
+        """
+        segmenter = QuestionSegmenter(max_chunk_size=self.max_input_length)
+        segments = []
+        future_to_segment = {}
+        page_texts = []
+
+        with span("llm_processor.pipeline", max_workers=max_workers) as pipeline, \
+                ContextThreadPoolExecutor(max_workers=max_workers) as executor:
+            def dispatch(contents: List[str]):
+                for content in contents:
+                    segment_index = len(segments)
+                    segment = {
+                        "id": segment_index + 1,
+                        "content": content,
+                        "estimated_questions": self._estimate_questions(content)
+                    }
+                    segments.append(segment)
+                    if checkpoint is not None:
+                        checkpoint.add_segment(segment_index, content)
+                    future = executor.submit(self.process_segment_with_retry, segment, segment_index, expected_questions, cancel_event)
+                    future_to_segment[future] = (segment_index, segment)
+
+                    self._report_progress(progress_id, {
+                        "type": "segment_dispatched",
+                        "message": f"已提交第 {segment_index + 1} 个片段",
+                        "dispatched": len(segments),
+                        "parallel_workers": max_workers
+                    }, on_progress)
+
+            # 页面提取失败时直接抛出，已提交的片段随线程池退出而结束
+            for page_text in pages:
+                if cancel_event is not None and cancel_event.is_set():
+                    break
+                page_texts.append(page_text)
+                with span("segment.split", page=len(page_texts) - 1) as split:
+                    contents = segmenter.feed(page_text)
+                    split.set_attribute("segments", len(contents))
+                dispatch(contents)
+            else:
+                dispatch(segmenter.flush())
+                if checkpoint is not None:
+                    checkpoint.complete_extraction(join_page_texts(page_texts))
+
+            self.last_segments = segments  # 保存分割结果
+            pipeline.set_attributes(pages=len(page_texts), segments=len(segments))
+
+            self._report_progress(progress_id, {
+                "type": "split_complete",
+                "message": f"分割完成，共 {len(segments)} 个片段",
+                "segment_count": len(segments),
+                "parallel_workers": max_workers
+            }, on_progress)
+
+            print(f"📊 流水线分割为 {len(segments)} 个片段，使用 {max_workers} 个并行线程")
+
+            segment_results = [None] * len(segments)
+            completed_count = 0
+
+            for future in as_completed(future_to_segment):
+                if cancel_event is not None and cancel_event.is_set():
+                    # 取消尚未开始的片段，正在调用的片段等待其结束
+                    for pending in future_to_segment:
+                        pending.cancel()
+                if future.cancelled():
+                    continue
+                segment_index, segment = future_to_segment[future]
+                try:
+                    result = future.result()
+                except Exception as e:
+                    print(f"❌ 片段 {segment_index + 1} 处理异常: {str(e)}")
+                    result = {
+                        "segment_index": segment_index,
+                        "segment_id": segment.get("id", segment_index + 1),
+                        "questions": [],
+                        "success": False,
+                        "error": str(e)
+                    }
+                segment_results[segment_index] = result
+                completed_count += 1
+                if checkpoint is not None:
+                    checkpoint.record_result(result)
+
+                self._report_progress(progress_id, {
+                    "type": "progress",
+                    "message": f"处理第 {completed_count}/{len(segments)} 个片段",
+                    "completed": completed_count,
+                    "total": len(segments),
+                    "questions_found": len(result.get("questions", [])),
+                    "total_questions": sum(len(r.get("questions", [])) for r in segment_results if r is not None)
+                }, on_progress)
+
+                print(f"📈 进度: {completed_count}/{len(segments)} 个片段已完成")
+
+        # 按原始顺序合并所有题目
+        all_questions = []
+        for result in segment_results:
+            if result and result.get("success"):
+                all_questions.extend(result["questions"])
+
+        print(f"🎉 所有片段处理完成！总共提取到 {len(all_questions)} 个题目")
+        return all_questions
+
+    def resume_segments(self, checkpoint: SegmentCheckpoint, max_workers: int = 3, progress_id: str = None,
+                        on_progress: Callable[[Dict[str, Any]], None] = None, cancel_event: threading.Event = None) -> List[Dict[str, Any]]:
+        """
+        从检查点恢复：只重新处理失败和未完成的片段，成功片段的题目直接沿用
+
+        Returns:
+            List[Dict]: 按片段顺序合并的全部题目
+        """
+        unfinished = checkpoint.unfinished()
+        expected_questions = checkpoint.expected_questions
+        print(f"♻️ 从检查点恢复，重新处理 {len(unfinished)}/{len(checkpoint.segments)} 个片段")
+
+        with span("llm_processor.resume", segments=len(unfinished), max_workers=max_workers), \
+                ContextThreadPoolExecutor(max_workers=max_workers) as executor:
+            future_to_index = {}
+            for entry in unfinished:
+                segment = {
+                    "id": entry["segment_index"] + 1,
+                    "content": entry["content"],
+                    "estimated_questions": self._estimate_questions(entry["content"])
+                }
+                future = executor.submit(self.process_segment_with_retry, segment, entry["segment_index"], expected_questions, cancel_event)
+                future_to_index[future] = entry["segment_index"]
+
+            completed_count = 0
+            for future in as_completed(future_to_index):
+                if cancel_event is not None and cancel_event.is_set():
+                    for pending in future_to_index:
+                        pending.cancel()
+                if future.cancelled():
+                    continue
+                result = future.result()
+                checkpoint.record_result(result)
+                completed_count += 1
+
+                self._report_progress(progress_id, {
+                    "type": "progress",
+                    "message": f"重试第 {completed_count}/{len(unfinished)} 个片段",
+                    "completed": completed_count,
+                    "total": len(unfinished),
+                    "questions_found": len(result.get("questions", [])),
+                    "total_questions": len(checkpoint.questions())
+                }, on_progress)
+
+        return checkpoint.questions()
+
     def process_pdf_text(self, pdf_text: str, max_workers: int = 3, expected_questions: int = None) -> List[Dict[str, Any]]:
         """处理PDF文本（并行版本）"""
         try:
@@ -405,10 +649,10 @@ PDF文本：
             completed_count = 0
             
             # 使用线程池进行并行处理
-            with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            with ContextThreadPoolExecutor(max_workers=max_workers) as executor:
                 # 提交所有任务
                 future_to_segment = {
-                    executor.submit(self.process_segment, segment, i, expected_questions): (i, segment)
+                    executor.submit(self.process_segment_with_retry, segment, i, expected_questions): (i, segment)
                     for i, segment in enumerate(segments)
                 }
                 
@@ -0,0 +1,228 @@
+import asyncio
+import contextvars
+import os
+import threading
+import time
+from contextlib import contextmanager
+from typing import Any, Dict, Generator, List, Optional
+
+# 优先级类别，数值越小越优先
+PRIORITY_INTERACTIVE = "interactive"
+PRIORITY_STREAMING = "streaming"
+PRIORITY_BULK = "bulk"
+PRIORITY_RANKS = {PRIORITY_INTERACTIVE: 0, PRIORITY_STREAMING: 1, PRIORITY_BULK: 2}
+
+# 当前请求的调用优先级和调用方，随请求上下文传递到异步任务和（通过 ContextThreadPoolExecutor）线程池
+current_priority: contextvars.ContextVar = contextvars.ContextVar("llm_priority", default=PRIORITY_BULK)
+current_caller: contextvars.ContextVar = contextvars.ContextVar("llm_caller", default="default")
+
+
+@contextmanager
+def llm_priority(priority: str, caller: str = None) -> Generator[None, None, None]:
+    """在代码块内设置上游调用的优先级（和调用方）"""
+    if priority not in PRIORITY_RANKS:
+        raise ValueError(f"未知的优先级: {priority}")
+    priority_token = current_priority.set(priority)
+    caller_token = current_caller.set(caller) if caller else None
+    try:
+        yield
+    finally:
+        current_priority.reset(priority_token)
+        if caller_token is not None:
+            current_caller.reset(caller_token)
+
+
+def parse_weights(value: str) -> Dict[str, float]:
+    """把 "editor:4,backfill:1" 解析为调用方权重"""
+    weights = {}
+    for item in filter(None, (part.strip() for part in value.split(","))):
+        caller, _, weight = item.rpartition(":")
+        weights[caller] = float(weight)
+    return weights
+
+
+class _Waiter:
+    __slots__ = ("priority", "caller", "tag", "enqueued", "event", "loop", "future", "granted")
+
+    def __init__(self, priority: str, caller: str, tag: float, loop: asyncio.AbstractEventLoop = None):
+        self.priority = priority
+        self.caller = caller
+        self.tag = tag
+        self.enqueued = time.monotonic()
+        self.granted = False
+        self.loop = loop
+        self.event = None if loop else threading.Event()
+        self.future = loop.create_future() if loop else None
+
+
+class PriorityScheduler:
+    """
+    上游并发名额的优先级调度器：
+    - 名额空出时先按类别挑选（interactive > streaming > bulk），
+      等待时间每超过 aging 秒，有效优先级提升一级，bulk 请求不会被一直饿死
+    - 同一类别内按调用方做加权公平排队：每个请求按预估token数/调用方权重计算虚拟完成时间，
+      取最小者，单个调用方的大批量请求不会挤占其他调用方
+    - 保留若干名额只给 interactive 使用，后台批量任务占满其余名额时单题请求仍能立即开始
+    同步线程和异步协程都可以在这里排队
+    """
+
+    def __init__(self, max_slots: int, reserved_interactive: int = None, aging: float = None, weights: Dict[str, float] = None):
+        self.max_slots = max_slots
+        reserved = reserved_interactive if reserved_interactive is not None else int(os.getenv("LLM_SCHED_RESERVED_INTERACTIVE", "2"))
+        # 至少留一个名额给非交互请求
+        self.reserved_interactive = min(reserved, max_slots - 1)
+        self.aging = aging or float(os.getenv("LLM_SCHED_AGING_MS", "5000")) / 1000
+        self.weights = weights if weights is not None else parse_weights(os.getenv("LLM_SCHED_CALLER_WEIGHTS", ""))
+        self._lock = threading.Lock()
+        self._waiters: List[_Waiter] = []
+        self._caller_tags: Dict[str, float] = {}
+        self._virtual_time = 0.0
+        self.in_flight = 0
+        self._in_flight_by_priority = {priority: 0 for priority in PRIORITY_RANKS}
+
+        # 统计
+        self.granted = {priority: 0 for priority in PRIORITY_RANKS}
+        self.wait_total = {priority: 0.0 for priority in PRIORITY_RANKS}
+        self.wait_max = {priority: 0.0 for priority in PRIORITY_RANKS}
+        self.aged = 0
+
+    def _enqueue(self, tokens: int, loop: asyncio.AbstractEventLoop = None) -> _Waiter:
+        """登记一个等待者并尝试立即分配（调用方需持有锁）"""
+        priority = current_priority.get()
+        caller = current_caller.get()
+        start = max(self._caller_tags.get(caller, 0.0), self._virtual_time)
+        tag = start + max(tokens, 1) / self.weights.get(caller, 1.0)
+        self._caller_tags[caller] = tag
+        if len(self._caller_tags) > 1000:
+            # 虚拟完成时间已落后的调用方与新调用方等价，不必保留
+            self._caller_tags = {c: t for c, t in self._caller_tags.items() if t > self._virtual_time}
+        waiter = _Waiter(priority, caller, tag, loop)
+        self._waiters.append(waiter)
+        self._dispatch()
+        return waiter
+
+    def _can_start(self, priority: str) -> bool:
+        limit = self.max_slots if priority == PRIORITY_INTERACTIVE else self.max_slots - self.reserved_interactive
+        return self.in_flight < limit
+
+    def _dispatch(self):
+        """把空出的名额分配给等待者（调用方需持有锁）"""
+        while self._waiters and self.in_flight < self.max_slots:
+            now = time.monotonic()
+            best = None
+            best_key = None
+            for waiter in self._waiters:
+                if not self._can_start(waiter.priority):
+                    continue
+                rank = PRIORITY_RANKS[waiter.priority] - int((now - waiter.enqueued) / self.aging)
+                key = (rank, waiter.tag, waiter.enqueued)
+                if best_key is None or key < best_key:
+                    best, best_key = waiter, key
+            if best is None:
+                return
+
+            self._waiters.remove(best)
+            if best_key[0] < PRIORITY_RANKS[best.priority] and any(
+                PRIORITY_RANKS[w.priority] < PRIORITY_RANKS[best.priority] for w in self._waiters
+            ):
+                # 靠等待时间提升后越过了更高类别的请求
+                self.aged += 1
+            self._virtual_time = max(self._virtual_time, best.tag)
+            self.in_flight += 1
+            self._in_flight_by_priority[best.priority] += 1
+            waited = now - best.enqueued
+            self.granted[best.priority] += 1
+            self.wait_total[best.priority] += waited
+            self.wait_max[best.priority] = max(self.wait_max[best.priority], waited)
+            best.granted = True
+            if best.loop is not None:
+                best.loop.call_soon_threadsafe(_resolve, best.future)
+            else:
+                best.event.set()
+
+    def acquire(self, tokens: int = 1) -> str:
+        """
+        同步等待一个名额
+
+        Returns:
+            str: 本次占用名额的优先级，释放时传回 release
+        """
+        with self._lock:
+            waiter = self._enqueue(tokens)
+        waiter.event.wait()
+        return waiter.priority
+
+    async def aacquire(self, tokens: int = 1) -> str:
+        """异步等待一个名额，等待期间被取消时退出排队"""
+        with self._lock:
+            waiter = self._enqueue(tokens, asyncio.get_event_loop())
+        try:
+            await waiter.future
+        except asyncio.CancelledError:
+            with self._lock:
+                if not waiter.granted:
+                    self._waiters.remove(waiter)
+                    raise
+            # 名额已分配但调用方不再需要，直接归还
+            self.release(waiter.priority)
+            raise
+        return waiter.priority
+
+    def release(self, priority: str):
+        with self._lock:
+            self.in_flight -= 1
+            self._in_flight_by_priority[priority] -= 1
+            self._dispatch()
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            waiting = {priority: 0 for priority in PRIORITY_RANKS}
+            for waiter in self._waiters:
+                waiting[waiter.priority] += 1
+            return {
+                "max_slots": self.max_slots,
+                "reserved_interactive": self.reserved_interactive,
+                "aging_ms": round(self.aging * 1000, 1),
+                "aged_promotions": self.aged,
+                "classes": {
+                    priority: {
+                        "in_flight": self._in_flight_by_priority[priority],
+                        "waiting": waiting[priority],
+                        "granted": self.granted[priority],
+                        "wait_avg_ms": round(self.wait_total[priority] / self.granted[priority] * 1000, 2) if self.granted[priority] else 0.0,
+                        "wait_max_ms": round(self.wait_max[priority] * 1000, 2)
+                    }
+                    for priority in PRIORITY_RANKS
+                }
+            }
+
+
+def _resolve(future: asyncio.Future):
+    if not future.done():
+        future.set_result(None)
+
+
+class LLMPriorityMiddleware:
+    """
+    按请求路径设置上游调用优先级，调用方取 X-Caller-Id 请求头，没有时取客户端地址。
+    routes 为 {路径前缀: 优先级}，按路径段做最长前缀匹配（/api/extract 不匹配 /api/extract-raw）
+    """
+
+    def __init__(self, app, routes: Dict[str, str]):
+        self.app = app
+        self.routes = sorted(routes.items(), key=lambda item: len(item[0]), reverse=True)
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+        path = scope.get("path", "")
+        priority = next((priority for prefix, priority in self.routes if path == prefix or path.startswith(prefix + "/")), None)
+        if priority is None:
+            await self.app(scope, receive, send)
+            return
+        caller = dict(scope.get("headers") or []).get(b"x-caller-id", b"").decode("latin-1")
+        if not caller and scope.get("client"):
+            caller = scope["client"][0]
+        with llm_priority(priority, caller or None):
+            await self.app(scope, receive, send)
@@ -1,21 +1,52 @@
 import json
 import os
-import requests
-from typing import Dict, Any, List, Generator, AsyncGenerator
+from llm_client import LLMClient, StreamEnd, get_llm_client
+from typing import Dict, Any, List, Generator, AsyncGenerator, Iterable, Tuple
 import re
 import asyncio
+import contextvars
+import threading
+from metrics import SPLIT_SECONDS
+from tracing import SPAN_CANCELLED, SPAN_OK, span, start_span, use_span
+from text_segmenter import QUESTION_PATTERN, QuestionSegmenter, is_question_boundary
+from stream_json_parser import StreamingJSONParser, aparse_json_stream, parse_json_stream
+
+async def join_through_cancel(aws) -> None:
+    """
+    等待所有任务结束；等待期间当前任务再次被取消也继续等待，全部结束后再抛出 CancelledError。
+    流水线收尾时使用：页面线程还在读取上传文件时，调用方不能提前关闭上传缓冲区
+    """
+    waiter = asyncio.ensure_future(asyncio.wait(aws))
+    cancelled = False
+    while not waiter.done():
+        try:
+            await asyncio.shield(waiter)
+        except asyncio.CancelledError:
+            cancelled = True
+    if cancelled:
+        raise asyncio.CancelledError()
 
 class LLMStreamProcessor:
     """
     真正的流式LLM处理器，支持实时流式输出题目
     """
     
-    def __init__(self, api_key: str = None, max_tokens: int = 16000, model: str = None):
+    def __init__(self, api_key: str = None, max_tokens: int = 16000, model: str = None, client: LLMClient = None):
         self.api_key = api_key or os.getenv("DASHSCOPE_API_KEY")
-        self.api_url = "https://dashscope.aliyuncs.com/compatible-mode/v1/chat/completions"
+        # 共享连接池的DashScope客户端
+        self.client = client or get_llm_client()
         self.model = model or os.getenv("LLM_MODEL", "qwen-plus-latest")
         # 增加默认max_tokens，确保长文本也能完整输出
         self.max_tokens = max_tokens if max_tokens else 32000
+        # 流水线模式下每个片段的最大字符数，片段越大上下文越完整
+        self.segment_max_chars = int(os.getenv("STREAM_SEGMENT_MAX_CHARS", "6000"))
+        # 同时进行的片段流式调用数
+        self.parallel_streams = int(os.getenv("STREAM_PARALLEL_STREAMS", "3"))
+        # 输出被截断时，针对剩余原文的续写调用次数上限
+        self.max_continuations = int(os.getenv("STREAM_MAX_CONTINUATIONS", "2"))
+        # 客户端断开导致提前取消的流数量，以及由此省下的输出token估算
+        self.cancelled_streams = 0
+        self.tokens_saved = 0
     
     def create_question_prompt(self, pdf_text: str, expected_questions: int = None) -> str:
         """创建提取题目的prompt"""
@@ -96,14 +127,15 @@ PDF文本：
 }}
 ---QUESTION_SEPARATOR---"""
     
-    def call_api_stream(self, prompt: str) -> Generator[str, None, None]:
-        """调用DashScope API并返回流式响应"""
+    def call_api_stream(self, prompt: str, stream_state: Dict[str, Any] = None) -> Generator[str, None, None]:
+        """
+        调用DashScope API并返回流式响应
+        
+        Args:
+            prompt: 提取prompt
+            stream_state: 传入时，流结束后写入 finish_reason、usage（token用量）和本次请求的 max_tokens
+        """
         try:
-            headers = {
-                "Content-Type": "application/json",
-                "Authorization": f"Bearer {self.api_key}"
-            }
-            
             # 根据prompt长度动态调整max_tokens，确保有足够的输出空间
             # 估算：每个题目大约需要500-1000 tokens，加上prompt本身
             estimated_output_tokens = len(prompt) // 2  # 粗略估算输出token数
@@ -117,47 +149,29 @@ PDF文本：
                 ],
                 "temperature": 0,
                 "max_tokens": min(dynamic_max_tokens, 32000),  # 设置最大输出token数，但不超过模型限制
-                "stream": True  # 启用流式输出
+                "stream": True,  # 启用流式输出
+                "stream_options": {"include_usage": True}  # 最后一个块返回token用量
             }
             
-            response = requests.post(
-                self.api_url, 
-                headers=headers, 
-                json=data, 
-                timeout=120,
-                stream=True
-            )
-            response.raise_for_status()
-            
-            for line in response.iter_lines():
-                if line:
-                    line_str = line.decode('utf-8')
-                    if line_str.startswith('data: '):
-                        data_str = line_str[6:]  # 移除 'data: ' 前缀
-                        if data_str.strip() == '[DONE]':
-                            break
-                        try:
-                            chunk_data = json.loads(data_str)
-                            if 'choices' in chunk_data and len(chunk_data['choices']) > 0:
-                                delta = chunk_data['choices'][0].get('delta', {})
-                                if 'content' in delta:
-                                    yield delta['content']
-                        except json.JSONDecodeError:
-                            continue
+            include_end = stream_state is not None
+            stream = self.client.stream_chat(data, api_key=self.api_key, timeout=120, include_end=include_end,
+                                             processor="llm_stream_processor")
+            try:
+                for content in stream:
+                    if isinstance(content, StreamEnd):
+                        stream_state.update(finish_reason=content.finish_reason, usage=content.usage,
+                                            max_tokens=data["max_tokens"])
+                        continue
+                    yield content
+            finally:
+                stream.close()
             
         except Exception as e:
             raise Exception(f"调用DashScope API失败: {str(e)}")
     
-    async def call_api_stream_async(self, prompt: str) -> AsyncGenerator[str, None]:
-        """异步调用DashScope API并返回流式响应"""
+    async def call_api_stream_async(self, prompt: str, stream_state: Dict[str, Any] = None) -> AsyncGenerator[str, None]:
+        """异步调用DashScope API并返回流式响应，参数同 call_api_stream"""
         try:
-            import aiohttp
-            
-            headers = {
-                "Content-Type": "application/json",
-                "Authorization": f"Bearer {self.api_key}"
-            }
-            
             # 根据prompt长度动态调整max_tokens，确保有足够的输出空间
             # 估算：每个题目大约需要500-1000 tokens，加上prompt本身
             estimated_output_tokens = len(prompt) // 2  # 粗略估算输出token数
@@ -171,153 +185,195 @@ PDF文本：
                 ],
                 "temperature": 0,
                 "max_tokens": min(dynamic_max_tokens, 32000),  # 设置最大输出token数，但不超过模型限制
-                "stream": True  # 启用流式输出
+                "stream": True,  # 启用流式输出
+                "stream_options": {"include_usage": True}  # 最后一个块返回token用量
             }
             
-            async with aiohttp.ClientSession() as session:
-                async with session.post(
-                    self.api_url, 
-                    headers=headers, 
-                    json=data, 
-                    timeout=120
-                ) as response:
-                    response.raise_for_status()
-                    
-                    async for line in response.content:
-                        line_str = line.decode('utf-8')
-                        if line_str.startswith('data: '):
-                            data_str = line_str[6:]  # 移除 'data: ' 前缀
-                            if data_str.strip() == '[DONE]':
-                                break
-                            try:
-                                chunk_data = json.loads(data_str)
-                                if 'choices' in chunk_data and len(chunk_data['choices']) > 0:
-                                    delta = chunk_data['choices'][0].get('delta', {})
-                                    if 'content' in delta:
-                                        yield delta['content']
-                            except json.JSONDecodeError:
-                                continue
+            include_end = stream_state is not None
+            stream = self.client.astream_chat(data, api_key=self.api_key, timeout=120, include_end=include_end,
+                                              processor="llm_stream_processor")
+            try:
+                async for content in stream:
+                    if isinstance(content, StreamEnd):
+                        stream_state.update(finish_reason=content.finish_reason, usage=content.usage,
+                                            max_tokens=data["max_tokens"])
+                        continue
+                    yield content
+            finally:
+                await stream.aclose()
             
         except Exception as e:
             raise Exception(f"调用DashScope API失败: {str(e)}")
     
     def parse_streaming_json(self, stream_generator: Generator[str, None, None]) -> Generator[Dict[str, Any], None, None]:
-        """解析流式JSON响应，使用分割符实时提取完整题目"""
-        buffer = ""
-        separator = "---QUESTION_SEPARATOR---"
+        """解析流式JSON响应，每个题目对象的右括号到达即产出（增量解析，线性时间）"""
+        for question_obj in parse_json_stream(stream_generator):
+            if self.is_valid_question(question_obj):
+                yield question_obj
+    
+    async def parse_streaming_json_async(self, stream_generator: AsyncGenerator[str, None]) -> AsyncGenerator[Dict[str, Any], None]:
+        """异步解析流式JSON响应，每个题目对象的右括号到达即产出"""
+        async for question_obj in aparse_json_stream(stream_generator):
+            if self.is_valid_question(question_obj):
+                yield question_obj
+    
+    def find_continuation_text(self, source_text: str, questions: List[Dict[str, Any]]) -> str:
+        """
+        找出最后一个已提取题目之后的原文，用于续写
         
-        for chunk in stream_generator:
-            buffer += chunk
-            
-            # 查找分割符，提取完整的题目
-            while separator in buffer:
-                # 找到分割符的位置
-                separator_pos = buffer.find(separator)
-                
-                # 提取分割符之前的内容作为题目JSON
-                question_json = buffer[:separator_pos].strip()
-                
-                # 移除已处理的部分
-                buffer = buffer[separator_pos + len(separator):].strip()
-                
-                # 尝试解析题目JSON
-                if question_json:
-                    try:
-                        question_obj = json.loads(question_json)
-                        if self.is_valid_question(question_obj):
-                            yield question_obj
-                    except json.JSONDecodeError as e:
-                        print(f"JSON解析错误: {e}")
-                        print(f"问题JSON: {question_json[:200]}...")
-                        continue
+        按提取顺序在原文中依次向后定位每个题目的题干（试卷中常有"下面程序输出什么？"这类相同的题干，
+        不能直接找最后一次出现的位置），取最后一个题目之后的下一个题目边界；
+        有题目定位不到时按已提取题目数跳过相应数量的题目编号
         
-        # 流结束后，处理buffer中剩余的最后一个题目（可能没有分隔符）
-        if buffer.strip():
-            # 尝试提取可能的JSON对象
-            buffer = buffer.strip()
-            # 尝试找到最后一个完整的JSON对象
-            try:
-                # 尝试直接解析整个buffer
-                question_obj = json.loads(buffer)
-                if self.is_valid_question(question_obj):
-                    yield question_obj
-            except json.JSONDecodeError:
-                # 如果直接解析失败，尝试找到最后一个完整的JSON对象
-                # 查找最后一个 { 和对应的 }
-                last_open = buffer.rfind('{')
-                if last_open != -1:
-                    # 尝试从最后一个 { 开始解析
-                    for i in range(len(buffer), last_open, -1):
-                        try:
-                            potential_json = buffer[last_open:i]
-                            question_obj = json.loads(potential_json)
-                            if self.is_valid_question(question_obj):
-                                yield question_obj
-                                break
-                        except json.JSONDecodeError:
-                            continue
+        Returns:
+            剩余原文；没有剩余题目时返回空字符串
+        """
+        boundaries = [match.start() for match in QUESTION_PATTERN.finditer(source_text)]
+        if not questions:
+            return source_text
+        
+        search_from = 0
+        position = -1
+        for question in questions:
+            snippet = str(question.get("question_text", "")).strip()[:12]
+            position = source_text.find(snippet, search_from) if snippet else -1
+            if position == -1:
+                break
+            search_from = position + len(snippet)
+        if position != -1:
+            following = [boundary for boundary in boundaries if boundary > position]
+            return source_text[following[0]:].strip() if following else ""
+        
+        if len(boundaries) > len(questions):
+            return source_text[boundaries[len(questions)]:].strip()
+        return ""
     
-    async def parse_streaming_json_async(self, stream_generator: AsyncGenerator[str, None]) -> AsyncGenerator[Dict[str, Any], None]:
-        """异步解析流式JSON响应，使用分割符实时提取完整题目"""
-        buffer = ""
-        separator = "---QUESTION_SEPARATOR---"
+    def _truncation_reason(self, stream_state: Dict[str, Any], parser: StreamingJSONParser) -> str:
+        """判断一次流式输出是否被截断，返回原因；完整时返回空字符串"""
+        if stream_state.get("finish_reason") == "length":
+            return "输出达到max_tokens上限"
+        if parser.partial is not None:
+            return "末尾题目不完整"
+        return ""
+
+    def _plan_continuation(self, chunk_text: str, questions: List[Dict[str, Any]], stream_state: Dict[str, Any],
+                           parser: StreamingJSONParser, expected: int, round_index: int, round_questions: int) -> Tuple[str, str]:
+        """
+        一轮流式调用结束后决定是否续写
+
+        输出被截断时续写剩余原文；题目数少于预期时，只有原文在最后一个已提取题目之后确实还有题目才续写，
+        预期题目数只是估算，估多了不应多花一次调用。续写一轮没有提取到新题目时不再继续
+
+        Returns:
+            (续写原因, 续写的原文)，不续写时均为空字符串
+        """
+        if round_index == self.max_continuations or (round_index and not round_questions):
+            return "", ""
+        reason = self._truncation_reason(stream_state, parser)
+        if not reason and not (expected and len(questions) < expected):
+            return "", ""
+        remaining = self.find_continuation_text(chunk_text, questions)
+        if not remaining:
+            return "", ""
+        return reason or f"题目数少于预期({len(questions)}/{expected})", remaining
+    
+    def _continuation_event(self, chunk_index: int, round_index: int, reason: str, tail: str) -> Dict[str, Any]:
+        return {
+            "type": "continuation",
+            "chunk_index": chunk_index,
+            "round": round_index,
+            "reason": reason,
+            "tail_size": len(tail),
+            "message": f"🔁 输出不完整（{reason}），继续提取剩余 {len(tail)} 字符的原文"
+        }
+    
+    def _end_round_span(self, round_span, stream_state: Dict[str, Any], parser: StreamingJSONParser, questions: int):
+        """一轮流式调用（含增量解析）结束，记录结束原因、解析错误数、累计题目数和输出token数（对照 max_tokens）"""
+        round_span.set_attributes(
+            finish_reason=stream_state.get("finish_reason"),
+            parse_errors=parser.errors,
+            truncated=parser.partial is not None,
+            questions=questions
+        )
+        if stream_state.get("usage"):
+            round_span.set_attributes(completion_tokens=stream_state["usage"]["completion_tokens"],
+                                      max_tokens=stream_state.get("max_tokens"))
+        round_span.end()
+
+    def iter_chunk_questions(self, chunk_text: str, expected: int = None, chunk_index: int = 0) -> Generator[Dict[str, Any], None, None]:
+        """
+        流式提取一个片段中的题目，输出被截断时只针对剩余原文发起续写，结果接在同一个流中
         
-        async for chunk in stream_generator:
-            buffer += chunk
+        Args:
+            chunk_text: 片段原文
+            expected: 预期题目数，默认按原文估算
+            chunk_index: 片段序号，写入续写事件
             
-            # 查找分割符，提取完整的题目
-            while separator in buffer:
-                # 找到分割符的位置
-                separator_pos = buffer.find(separator)
-                
-                # 提取分割符之前的内容作为题目JSON
-                question_json = buffer[:separator_pos].strip()
-                
-                # 移除已处理的部分
-                buffer = buffer[separator_pos + len(separator):].strip()
-                
-                # 尝试解析题目JSON
-                if question_json:
-                    try:
-                        question_obj = json.loads(question_json)
-                        if self.is_valid_question(question_obj):
-                            yield question_obj
-                    except json.JSONDecodeError as e:
-                        print(f"JSON解析错误: {e}")
-                        print(f"问题JSON: {question_json[:200]}...")
-                        continue
+        Yields:
+            {"type": "question", "question": 题目} 或 {"type": "continuation", ...}
+        """
+        questions = []
+        source_text = chunk_text
+        expected = expected or self.estimate_questions_in_text(chunk_text)
+        
+        for round_index in range(self.max_continuations + 1):
+            stream_state = {}
+            parser = StreamingJSONParser()
+            prompt = self.create_question_prompt(source_text, expected - len(questions) if round_index else expected)
+            
+            round_span = start_span("stream.round", chunk_index=chunk_index, round=round_index)
+            stream = parse_json_stream(self.call_api_stream(prompt, stream_state), parser)
+            round_start = len(questions)
+            try:
+                for question in stream:
+                    if self.is_valid_question(question):
+                        questions.append(question)
+                        yield {"type": "question", "question": question}
+            finally:
+                stream.close()
+                self._end_round_span(round_span, stream_state, parser, len(questions))
+            
+            reason, source_text = self._plan_continuation(chunk_text, questions, stream_state, parser, expected,
+                                                          round_index, len(questions) - round_start)
+            if not source_text:
+                return
+            yield self._continuation_event(chunk_index, round_index + 1, reason, source_text)
+    
+    async def aiter_chunk_questions(self, chunk_text: str, expected: int = None, chunk_index: int = 0) -> AsyncGenerator[Dict[str, Any], None]:
+        """iter_chunk_questions 的异步版本"""
+        questions = []
+        source_text = chunk_text
+        expected = expected or self.estimate_questions_in_text(chunk_text)
         
-        # 流结束后，处理buffer中剩余的最后一个题目（可能没有分隔符）
-        if buffer.strip():
-            # 尝试提取可能的JSON对象
-            buffer = buffer.strip()
-            # 尝试找到最后一个完整的JSON对象
+        for round_index in range(self.max_continuations + 1):
+            stream_state = {}
+            parser = StreamingJSONParser()
+            prompt = self.create_question_prompt(source_text, expected - len(questions) if round_index else expected)
+            
+            round_span = start_span("stream.round", chunk_index=chunk_index, round=round_index)
+            stream = aparse_json_stream(self.call_api_stream_async(prompt, stream_state), parser)
+            round_start = len(questions)
             try:
-                # 尝试直接解析整个buffer
-                question_obj = json.loads(buffer)
-                if self.is_valid_question(question_obj):
-                    yield question_obj
-            except json.JSONDecodeError:
-                # 如果直接解析失败，尝试找到最后一个完整的JSON对象
-                # 查找最后一个 { 和对应的 }
-                last_open = buffer.rfind('{')
-                if last_open != -1:
-                    # 尝试从最后一个 { 开始解析
-                    for i in range(len(buffer), last_open, -1):
-                        try:
-                            potential_json = buffer[last_open:i]
-                            question_obj = json.loads(potential_json)
-                            if self.is_valid_question(question_obj):
-                                yield question_obj
-                                break
-                        except json.JSONDecodeError:
-                            continue
+                async for question in stream:
+                    if self.is_valid_question(question):
+                        questions.append(question)
+                        yield {"type": "question", "question": question}
+            finally:
+                await stream.aclose()
+                self._end_round_span(round_span, stream_state, parser, len(questions))
+            
+            reason, source_text = self._plan_continuation(chunk_text, questions, stream_state, parser, expected,
+                                                          round_index, len(questions) - round_start)
+            if not source_text:
+                return
+            yield self._continuation_event(chunk_index, round_index + 1, reason, source_text)
     
     def is_valid_question(self, obj: Dict[str, Any]) -> bool:
         """检查是否是有效的题目对象"""
         required_fields = ['question_text', 'question_type', 'correct_answer', 'options']
         return all(field in obj for field in required_fields)
     
+    @SPLIT_SECONDS.labels("stream").time()
     def split_pdf_text_intelligently(self, pdf_text: str, max_chunk_size: int = 3000) -> List[str]:
         """
         智能分割PDF文本，保持题目完整性
@@ -339,11 +395,8 @@ PDF文本：
         # 识别题目边界
         question_boundaries = []
         for i, line in enumerate(lines):
-            # 匹配题目编号模式
-            if re.match(r'第\s*\d+\s*题', line.strip()):
-                question_boundaries.append(i)
-            # 匹配章节分隔
-            elif re.match(r'\d+\s*(单选题|判断题|编程题)', line.strip()):
+            # 匹配题目编号或章节分隔
+            if is_question_boundary(line):
                 question_boundaries.append(i)
         
         # 如果没有找到题目边界，使用原来的方法
@@ -533,20 +586,13 @@ PDF文本：
                 "chunk_size": len(pdf_text)
             }
             
-            # 估算题目数量
-            chunk_expected = self.estimate_questions_in_text(pdf_text)
-            if expected_questions:
-                chunk_expected = expected_questions
-            
-            # 创建prompt
-            prompt = self.create_question_prompt(pdf_text, chunk_expected)
-            
-            # 调用流式API
-            stream_generator = self.call_api_stream(prompt)
-            
-            # 解析流式JSON响应
+            # 流式提取题目，输出被截断时自动续写剩余原文
             chunk_question_count = 0
-            for question in self.parse_streaming_json(stream_generator):
+            for event in self.iter_chunk_questions(pdf_text, expected_questions):
+                if event["type"] == "continuation":
+                    yield event
+                    continue
+                question = event["question"]
                 chunk_question_count += 1
                 total_questions += 1
                 all_questions.append(question)
@@ -599,6 +645,249 @@ PDF文本：
                 "message": f"❌ 处理PDF文本失败: {str(e)}"
             }
     
+    def _split_page(self, segmenter: QuestionSegmenter, page_index: int, page_text: str) -> List[str]:
+        """把一页文本交给切分器，返回新切出的片段"""
+        with span("segment.split", page=page_index) as split:
+            segments = segmenter.feed(page_text)
+            split.set_attribute("segments", len(segments))
+            return segments
+
+    async def _astream_chunk(self, chunk_index: int, chunk_text: str, emit, progress: Dict[int, List[int]]):
+        """
+        对单个片段发起流式调用，把片段事件和题目交给 emit，题目事件中的 chunk_question_index 为题目在片段内的序号；
+        progress 记录每个进行中片段的 [预期题目数, 已提取题目数]，用于估算取消时省下的token
+        """
+        with span("stream.chunk", chunk_index=chunk_index, chars=len(chunk_text)) as chunk_span:
+            emit({
+                "type": "chunk_start",
+                "message": f"开始处理第 {chunk_index + 1} 个片段",
+                "chunk_index": chunk_index,
+                "chunk_size": len(chunk_text)
+            })
+
+            expected = progress[chunk_index][0]
+            chunk_question_count = 0
+            events = self.aiter_chunk_questions(chunk_text, expected, chunk_index=chunk_index)
+            try:
+                async for event in events:
+                    if event["type"] == "continuation":
+                        emit(event)
+                        continue
+                    emit({
+                        "type": "question",
+                        "question": event["question"],
+                        "chunk_index": chunk_index,
+                        "chunk_question_index": chunk_question_count
+                    })
+                    chunk_question_count += 1
+                    progress[chunk_index][1] = chunk_question_count
+            finally:
+                await events.aclose()
+                chunk_span.set_attribute("questions", chunk_question_count)
+
+            del progress[chunk_index]
+            emit({
+                "type": "chunk_complete",
+                "message": f"第 {chunk_index + 1} 个片段处理完成，提取到 {chunk_question_count} 个题目",
+                "chunk_index": chunk_index,
+                "chunk_questions": chunk_question_count
+            })
+
+    async def process_pdf_pages_stream_async(self, pages: Iterable[str], expected_questions: int = None, parallel_streams: int = None) -> AsyncGenerator[Dict[str, Any], None]:
+        """
+        流水线流式处理PDF：页面在线程中边提取边按题目边界切分，每凑够一个片段就交给
+        并发的流式调用（异步客户端）处理
+
+        题目按原文顺序输出，question_index 即题目在原文中的位置：最前面未完成的片段的题目实时输出，
+        后面片段的题目先暂存，前面的片段全部完成后再依次输出；片段的开始/完成等事件不等待
+
+        调用方停止迭代或所在任务被取消（如SSE客户端断开）时，立即关闭所有上游流，
+        并累计取消次数和省下的输出token估算；生成器结束前总会等页面线程退出，之后 pages 的数据源可以安全释放
+
+        Args:
+            pages: 按页码顺序产出页面文本的迭代器
+            expected_questions: 预期题目数量，分配到各片段作为该片段的预期题目数（见 _chunk_expected）
+            parallel_streams: 并发流式调用数，默认使用 STREAM_PARALLEL_STREAMS，为1时逐个片段处理
+
+        Yields:
+            与 process_pdf_text_stream 相同格式的事件
+        """
+        workers = max(1, int(parallel_streams or self.parallel_streams))
+
+        yield {
+            "type": "process_start",
+            "message": f"开始处理PDF文本（边提取边处理，并发 {workers} 路）"
+        }
+
+        pipeline = start_span("llm_stream_processor.pipeline", parallel_streams=workers)
+        loop = asyncio.get_event_loop()
+        event_queue = asyncio.Queue()
+        stopped = threading.Event()
+        slots = asyncio.Semaphore(workers)
+        progress: Dict[int, List[int]] = {}
+        chunk_tasks = []
+        dispatch_done = object()
+
+        def produce():
+            """在线程中提取页面并切分，每个片段交回事件循环"""
+            try:
+                segmenter = QuestionSegmenter(max_chunk_size=self.segment_max_chars)
+                for page_index, page_text in enumerate(pages):
+                    if stopped.is_set():
+                        return
+                    for segment in self._split_page(segmenter, page_index, page_text):
+                        loop.call_soon_threadsafe(event_queue.put_nowait, ("segment", segment))
+                # flush 切出的是原文最后一个片段
+                for segment in segmenter.flush():
+                    loop.call_soon_threadsafe(event_queue.put_nowait, ("last_segment", segment))
+            except Exception as e:
+                loop.call_soon_threadsafe(event_queue.put_nowait, e)
+            finally:
+                loop.call_soon_threadsafe(event_queue.put_nowait, dispatch_done)
+
+        async def run_chunk(chunk_index, chunk_text):
+            async with slots:
+                try:
+                    await self._astream_chunk(chunk_index, chunk_text, event_queue.put_nowait, progress)
+                except Exception as e:
+                    event_queue.put_nowait({"type": "chunk_failed", "chunk_index": chunk_index, "error": e})
+
+        with use_span(pipeline):
+            producer = loop.run_in_executor(None, contextvars.copy_context().run, produce)
+
+        total_questions = 0
+        received_questions = 0
+        output_chars = 0
+        # 按原文顺序输出：release_chunk 之前的片段已全部完成，其他片段的题目暂存在 held 中
+        release_chunk = 0
+        held: Dict[int, List[Dict[str, Any]]] = {}
+        completed_chunks = set()
+        chunk_count = 0
+        assigned_expected = 0
+        extraction_done = False
+        finished_chunks = 0
+        completed = False
+        try:
+            while not extraction_done or finished_chunks < chunk_count:
+                event = await event_queue.get()
+
+                if event is dispatch_done:
+                    extraction_done = True
+                    continue
+                if isinstance(event, Exception):
+                    # 页面提取失败直接向上抛出，由调用方按提取错误处理
+                    raise event
+                if isinstance(event, tuple):
+                    kind, chunk_text = event
+                    expected = self._chunk_expected(chunk_text, expected_questions, assigned_expected, kind == "last_segment")
+                    assigned_expected += expected
+                    # 进行中和排队中的片段：[预期题目数, 已提取题目数]
+                    progress[chunk_count] = [expected, 0]
+                    with use_span(pipeline):
+                        chunk_tasks.append(asyncio.ensure_future(run_chunk(chunk_count, chunk_text)))
+                    chunk_count += 1
+                    continue
+
+                if event["type"] == "chunk_failed":
+                    error = event["error"]
+                    pipeline.record_error(error)
+                    yield {
+                        "type": "process_error",
+                        "error": str(error),
+                        "message": f"❌ 处理PDF文本失败: {str(error)}"
+                    }
+                    completed = True
+                    return
+
+                outgoing = [event]
+                if event["type"] == "question":
+                    received_questions += 1
+                    output_chars += len(json.dumps(event["question"], ensure_ascii=False))
+                    if event["chunk_index"] != release_chunk:
+                        held.setdefault(event["chunk_index"], []).append(event)
+                        continue
+                elif event["type"] == "chunk_complete":
+                    finished_chunks += 1
+                    completed_chunks.add(event["chunk_index"])
+                    while release_chunk in completed_chunks:
+                        release_chunk += 1
+                        outgoing.extend(held.pop(release_chunk, []))
+
+                for outgoing_event in outgoing:
+                    if outgoing_event["type"] == "question":
+                        outgoing_event["question_index"] = total_questions
+                        total_questions += 1
+                        outgoing_event["message"] = f"✅ 第 {total_questions} 个题目提取完成"
+                    yield outgoing_event
+            completed = True
+        finally:
+            stopped.set()
+            pending = [task for task in chunk_tasks if not task.done()]
+            if not completed and pending:
+                # 提前结束：按已输出题目的平均长度估算未生成部分的token数
+                remaining = sum(max(expected - produced, 0) for expected, produced in progress.values())
+                per_question = output_chars / received_questions if received_questions else 500
+                self.cancelled_streams += 1
+                self.tokens_saved += int(remaining * per_question)
+                print(f"🛑 流式提取提前结束，取消 {len(pending)} 个未完成的片段")
+            for task in pending:
+                task.cancel()
+            try:
+                # 再次被取消也要等页面线程结束，返回后调用方才能关闭上传文件
+                await join_through_cancel(pending + [producer])
+            finally:
+                self._end_pipeline_span(pipeline, completed, chunk_count, total_questions)
+
+        # 检查题目数量是否达到预期
+        warning_message = ""
+        if expected_questions and total_questions < expected_questions:
+            missing_count = expected_questions - total_questions
+            warning_message = f"⚠️ 警告：预期生成 {expected_questions} 个题目，但只提取到 {total_questions} 个，缺少 {missing_count} 个题目。可能的原因：1) PDF文本中实际题目数量不足；2) LLM输出被截断；3) 部分题目格式识别困难。"
+            yield {
+                "type": "warning",
+                "message": warning_message,
+                "expected": expected_questions,
+                "actual": total_questions,
+                "missing": missing_count
+            }
+
+        complete_message = f"🎉 处理完成！总共提取到 {total_questions} 个题目"
+        if warning_message:
+            complete_message += f"\n{warning_message}"
+
+        yield {
+            "type": "process_complete",
+            "message": complete_message,
+            "total_questions": total_questions,
+            "chunk_count": chunk_count,
+            "expected_questions": expected_questions
+        }
+
+    def _chunk_expected(self, chunk_text: str, expected_questions: int, assigned: int, last: bool) -> int:
+        """
+        片段的预期题目数，决定续写判断和prompt中要求的题目数。默认按原文估算；
+        客户端给出总数时把总数分到各片段：前面的片段取估算值但累计不超过总数，
+        最后一个片段分到剩余的差额。片段在整份PDF提取完之前就已发出，无法预先按比例分配
+        """
+        estimate = self.estimate_questions_in_text(chunk_text)
+        if not expected_questions:
+            return estimate
+        remaining = max(expected_questions - assigned, 0)
+        return max(remaining if last else min(estimate, remaining), 1)
+
+    def _end_pipeline_span(self, pipeline, completed: bool, chunk_count: int, total_questions: int):
+        pipeline.set_attributes(chunks=chunk_count or 0, questions=total_questions)
+        if not completed and pipeline.status == SPAN_OK:
+            pipeline.status = SPAN_CANCELLED
+        pipeline.end()
+
+    def cancellation_stats(self) -> Dict[str, int]:
+        """客户端断开导致的流取消统计"""
+        return {
+            "cancelled_streams": self.cancelled_streams,
+            "tokens_saved_estimate": self.tokens_saved
+        }
+
     async def process_pdf_text_stream_async(self, pdf_text: str, expected_questions: int = None) -> AsyncGenerator[Dict[str, Any], None]:
         """异步流式处理PDF文本，直接处理整个文本（跳过智能分割）"""
         try:
@@ -626,20 +915,13 @@ PDF文本：
                 "chunk_size": len(pdf_text)
             }
             
-            # 估算题目数量
-            chunk_expected = self.estimate_questions_in_text(pdf_text)
-            if expected_questions:
-                chunk_expected = expected_questions
-            
-            # 创建prompt
-            prompt = self.create_question_prompt(pdf_text, chunk_expected)
-            
-            # 调用异步流式API
-            stream_generator = self.call_api_stream_async(prompt)
-            
-            # 解析流式JSON响应
+            # 流式提取题目，输出被截断时自动续写剩余原文
             chunk_question_count = 0
-            async for question in self.parse_streaming_json_async(stream_generator):
+            async for event in self.aiter_chunk_questions(pdf_text, expected_questions):
+                if event["type"] == "continuation":
+                    yield event
+                    continue
+                question = event["question"]
                 chunk_question_count += 1
                 total_questions += 1
                 all_questions.append(question)
@@ -0,0 +1,72 @@
+import asyncio
+import os
+import threading
+import time
+from collections import deque
+from typing import Any, Dict, Optional
+
+
+class LoopLagMonitor:
+    """
+    事件循环阻塞监控：按固定间隔睡眠，实际醒来时间比预期晚多少就是事件循环被阻塞的时长。
+    超过告警阈值时打印日志，便于发现在 async 接口里直接执行的同步调用
+    """
+
+    def __init__(self, interval: float = None, warn_threshold: float = None, window: int = 600):
+        self.interval = interval or float(os.getenv("LOOP_LAG_INTERVAL_MS", "100")) / 1000
+        self.warn_threshold = warn_threshold or float(os.getenv("LOOP_LAG_WARN_MS", "200")) / 1000
+        self._samples = deque(maxlen=window)
+        self._lock = threading.Lock()
+        self._task: Optional[asyncio.Task] = None
+
+        # 统计
+        self.checks = 0
+        self.blocked = 0
+        self.blocked_total = 0.0
+        self.max_lag = 0.0
+
+    def record(self, lag: float):
+        with self._lock:
+            self.checks += 1
+            self._samples.append(lag)
+            self.max_lag = max(self.max_lag, lag)
+            if lag >= self.warn_threshold:
+                self.blocked += 1
+                self.blocked_total += lag
+        if lag >= self.warn_threshold:
+            print(f"🐢 事件循环被阻塞 {lag * 1000:.0f} ms")
+
+    async def _run(self):
+        while True:
+            expected = time.monotonic() + self.interval
+            await asyncio.sleep(self.interval)
+            self.record(max(time.monotonic() - expected, 0.0))
+
+    def start(self):
+        """在当前事件循环中启动监控，重复调用无副作用"""
+        if self._task is None or self._task.done():
+            self._task = asyncio.ensure_future(self._run())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+    def stats(self) -> Dict[str, Any]:
+        """最近窗口内的延迟分布，以及启动以来的阻塞次数和累计阻塞时长"""
+        with self._lock:
+            ordered = sorted(self._samples)
+            return {
+                "interval_ms": round(self.interval * 1000, 1),
+                "warn_threshold_ms": round(self.warn_threshold * 1000, 1),
+                "checks": self.checks,
+                "blocked": self.blocked,
+                "blocked_total_ms": round(self.blocked_total * 1000, 1),
+                "lag_max_ms": round(self.max_lag * 1000, 2),
+                "lag_p50_ms": round(ordered[len(ordered) // 2] * 1000, 2) if ordered else 0.0,
+                "lag_p99_ms": round(ordered[min(len(ordered) - 1, int(len(ordered) * 0.99))] * 1000, 2) if ordered else 0.0
+            }
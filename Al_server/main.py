@@ -1,13 +1,28 @@
-import pdfplumber
 from fastapi import FastAPI, File, UploadFile, Request, Form
-from fastapi.responses import JSONResponse, HTMLResponse, StreamingResponse
+from fastapi.responses import JSONResponse, HTMLResponse, PlainTextResponse, StreamingResponse
 from fastapi.templating import Jinja2Templates
 from fastapi.middleware.cors import CORSMiddleware
 import os
 import json
+import math
+import asyncio
+import functools
+from context_executor import ContextThreadPoolExecutor
 from llm_processor import LLMProcessor
 from explanation_processor import ExplanationProcessor
 from llm_stream_processor import LLMStreamProcessor
+from pdf_extractor import PDFExtractor, join_page_texts
+from cache_store import SQLiteCache
+from upload_buffer import read_upload
+from llm_client import get_llm_client
+from loop_monitor import LoopLagMonitor
+from llm_scheduler import LLMPriorityMiddleware, PRIORITY_BULK, PRIORITY_INTERACTIVE, PRIORITY_STREAMING
+from job_queue import FINISHED_STATES, JOB_SUCCEEDED, Job, JobCancelled, JobQueue, QueueFullError
+from progress_store import create_progress_store, progress_key
+from segment_checkpoint import SegmentCheckpoint
+from metrics import REGISTRY
+from tracing import TracingMiddleware, current_request_id, current_trace_id, get_span_exporter, shutdown_tracing, span, trace
+from token_usage import USAGE_STATS, UsageMiddleware, current_usage, track_usage
 
 # Initialize FastAPI and templates
 app = FastAPI()
@@ -19,44 +34,234 @@ app.add_middleware(
     allow_credentials=True,
     allow_methods=["*"],
     allow_headers=["*"],
+    expose_headers=["X-Request-ID"],
 )
 
+# 上游调用优先级：编辑器中的单题解析 > 管理员等待中的流式/同步提取 > 批量回填和后台任务（默认）
+app.add_middleware(
+    LLMPriorityMiddleware,
+    routes={
+        "/api/generate-explanation": PRIORITY_INTERACTIVE,
+        "/api/stream-extract": PRIORITY_STREAMING,
+        "/api/extract": PRIORITY_STREAMING,
+        "/upload": PRIORITY_STREAMING,
+        "/api/generate-batch-explanations": PRIORITY_BULK,
+    }
+)
+
+# 调用大模型的接口按请求统计token用量，按接口汇总到 /api/usage-stats
+app.add_middleware(
+    UsageMiddleware,
+    routes=[
+        "/upload",
+        "/api/extract",
+        "/api/stream-extract",
+        "/api/generate-explanation",
+        "/api/generate-explanation/stream",
+        "/api/generate-batch-explanations",
+        "/api/generate-batch-explanations/stream",
+    ]
+)
+
+# 每个请求一条trace，响应头回显 X-Request-ID（最后添加，位于最外层，覆盖整个请求）
+app.add_middleware(TracingMiddleware)
+
 templates = Jinja2Templates(directory="templates")
 
+# 共享的DashScope客户端（长连接池），所有处理器共用
+llm_client = get_llm_client()
+
+# 片段提取结果缓存（按片段内容+预期题目数+模型+prompt版本缓存）
+segment_cache = SQLiteCache(
+    os.getenv("SEGMENT_CACHE_PATH", "cache/segments.sqlite3"),
+    max_bytes=int(os.getenv("SEGMENT_CACHE_MAX_MB", "128")) * 1024 * 1024,
+    name="segments"
+)
+
+# 进度和任务状态存储（默认进程内LRU+TTL；配置Redis后多个worker共享）
+progress_store = create_progress_store()
+
 # Initialize LLM processor with increased token limit
-llm_processor = LLMProcessor(max_tokens=8000)
+llm_processor = LLMProcessor(max_tokens=8000, cache=segment_cache, progress_store=progress_store)
+
+# 解析缓存（按规范化prompt+模型+prompt版本缓存，带TTL）
+explanation_cache = SQLiteCache(
+    os.getenv("EXPLANATION_CACHE_PATH", "cache/explanations.sqlite3"),
+    max_bytes=int(os.getenv("EXPLANATION_CACHE_MAX_MB", "64")) * 1024 * 1024,
+    ttl_seconds=float(os.getenv("EXPLANATION_CACHE_TTL_HOURS", "168")) * 3600,
+    name="explanations"
+)
 
 # Initialize explanation processor for fast explanation generation
-explanation_processor = ExplanationProcessor(max_tokens=400)
+explanation_processor = ExplanationProcessor(max_tokens=400, cache=explanation_cache)
 
 
 # Initialize LLM stream processor for true streaming LLM output
 llm_stream_processor = LLMStreamProcessor(max_tokens=16000)
 
-# 进度存储
-progress_storage = {}
+# PDF页面文本缓存（按PDF内容哈希+页码缓存，重复上传同一份试卷时跳过pdfplumber）
+pdf_page_cache = SQLiteCache(
+    os.getenv("PDF_CACHE_PATH", "cache/pdf_pages.sqlite3"),
+    max_bytes=int(os.getenv("PDF_CACHE_MAX_MB", "256")) * 1024 * 1024,
+    name="pdf_pages"
+)
+
+# PDF文本提取器（按页分片，多进程并行提取）
+pdf_extractor = PDFExtractor(cache=pdf_page_cache)
+
+
+# 上传处理中的阻塞部分（PDF提取、分段调用大模型）放到独立线程池执行：
+# 既不阻塞事件循环，也不占用Starlette的默认线程池，解析等接口不会排在上传后面
+extraction_executor = ContextThreadPoolExecutor(
+    max_workers=int(os.getenv("EXTRACTION_WORKERS", "4")),
+    thread_name_prefix="extract"
+)
+
+# 事件循环阻塞监控
+loop_monitor = LoopLagMonitor()
+
+class CancelOnDisconnectResponse(StreamingResponse):
+    """
+    客户端断开时立即取消推送的SSE响应：收到 http.disconnect 后取消推送任务并关闭生成器，
+    取消会传递到生成器内正在等待的上游流式调用。不依赖 Starlette 各版本对两个子任务的收尾方式。
+    
+    receive() 只由 listen_for_disconnect 读取，接口内不能再轮询 request.is_disconnected()，
+    同一个 receive 通道有两个读者时会互相吞掉 http.disconnect
+    """
+    
+    async def __call__(self, scope, receive, send):
+        streaming = asyncio.ensure_future(self.stream_response(send))
+        listening = asyncio.ensure_future(self.listen_for_disconnect(receive))
+        try:
+            await asyncio.wait([streaming, listening], return_when=asyncio.FIRST_COMPLETED)
+        finally:
+            streaming.cancel()
+            listening.cancel()
+            await asyncio.wait([streaming, listening])
+            # 在 send() 处被取消时生成器停在 yield，需要显式关闭才会执行其中的清理
+            if hasattr(self.body_iterator, "aclose"):
+                await self.body_iterator.aclose()
+        if not streaming.cancelled() and streaming.exception() is not None:
+            raise streaming.exception()
+        if self.background is not None and not streaming.cancelled():
+            await self.background()
+
+async def run_blocking(fn, *args, **kwargs):
+    """在提取线程池中执行同步函数并等待结果"""
+    loop = asyncio.get_event_loop()
+    return await loop.run_in_executor(extraction_executor, functools.partial(fn, *args, **kwargs))
+
+async def run_store(fn, *args, **kwargs):
+    """在默认线程池中执行进度存储的读写：共享存储是阻塞的网络调用，也不占用提取线程池"""
+    loop = asyncio.get_event_loop()
+    return await loop.run_in_executor(None, functools.partial(fn, *args, **kwargs))
 
-def extract_pdf_text(file_path: str) -> str:
+def extract_pdf_text(source) -> str:
     """
     Extracts text content from PDF file using pdfplumber for better code formatting.
     
     Args:
-        file_path (str): Path to the PDF file
+        source: Path to the PDF file, or an UploadBuffer holding the uploaded PDF
         
     Returns:
         str: Extracted text content
     """
     try:
-        pdf_text = ""
-        with pdfplumber.open(file_path) as pdf:
-            for page in pdf.pages:
-                page_text = page.extract_text()
-                if page_text:
-                    pdf_text += page_text + "\n"
-        return pdf_text.strip()
+        return pdf_extractor.extract_text(source)
     except Exception as e:
         raise ValueError(f"Error extracting PDF text: {str(e)}")
 
+def iter_pdf_pages(source):
+    """
+    按页码顺序惰性产出PDF每页文本，供流水线处理使用
+    
+    Args:
+        source: Path to the PDF file, or an UploadBuffer holding the uploaded PDF
+    """
+    try:
+        yield from pdf_extractor.iter_pages(source)
+    except Exception as e:
+        raise ValueError(f"Error extracting PDF text: {str(e)}")
+
+async def extract_questions(upload, filename: str, use_llm: bool = True, parallel_workers: int = 3, progress_id: str = None,
+                            expected_questions: int = None, on_progress=None, cancel_event=None, checkpoint=None) -> dict:
+    """
+    从已读取的上传缓冲区中提取题目，阻塞部分在提取线程池中执行；上传接口和后台任务共用
+    
+    Args:
+        upload: 上传缓冲区，由调用方负责关闭
+        filename: 文件名
+        use_llm: 是否使用大模型处理
+        parallel_workers: 并行线程数
+        progress_id: 进度ID
+        expected_questions: 预期题目数量（用于校准）
+        on_progress: 进度回调（在提取线程中调用）
+        cancel_event: 取消标志
+        checkpoint: 片段检查点（后台任务使用）
+    """
+    if not use_llm:
+        # 仅返回原始文本
+        pdf_text = await run_blocking(extract_pdf_text, upload)
+        return {
+            "filename": filename,
+            "raw_content": pdf_text,
+            "questions": [],
+            "status": "success",
+            "processed": False,
+            "question_count": 0
+        }
+    
+    print(f"📄 开始处理PDF文件: {filename}")
+    
+    # 发送开始处理的消息
+    if progress_id:
+        await run_store(progress_store.set, progress_key(progress_id), {
+            "type": "start",
+            "message": f"开始处理PDF文件: {filename}"
+        })
+    
+    # 边提取边处理：页面提取与大模型调用重叠进行
+    page_texts = []
+    def iter_pages():
+        for page_text in iter_pdf_pages(upload):
+            page_texts.append(page_text)
+            yield page_text
+    
+    questions = await run_blocking(
+        llm_processor.process_pdf_pages_with_progress,
+        iter_pages(), 
+        max_workers=parallel_workers, 
+        progress_id=progress_id,
+        expected_questions=expected_questions,
+        on_progress=on_progress,
+        cancel_event=cancel_event,
+        checkpoint=checkpoint
+    )
+    pdf_text = join_page_texts(page_texts)
+    print(f"📊 PDF文本长度: {len(pdf_text)} 字符")
+    
+    print(f"✅ 处理完成，提取到 {len(questions)} 个题目")
+    
+    # 发送完成消息
+    if progress_id:
+        await run_store(progress_store.set, progress_key(progress_id), {
+            "type": "complete",
+            "message": f"处理完成！总共提取到 {len(questions)} 个题目",
+            "question_count": len(questions)
+        })
+    
+    return {
+        "filename": filename,
+        "raw_content": pdf_text,
+        "questions": questions,
+        "status": "success",
+        "processed": True,
+        "question_count": len(questions),
+        "segment_count": len(llm_processor.get_last_segments()) if hasattr(llm_processor, 'get_last_segments') else 1,
+        "parallel_workers": parallel_workers,
+        "expected_questions": expected_questions
+    }
+
 async def process_pdf_file(file: UploadFile, use_llm: bool = True, parallel_workers: int = 3, progress_id: str = None, expected_questions: int = None):
     """
     处理PDF文件
@@ -75,71 +280,23 @@ async def process_pdf_file(file: UploadFile, use_llm: bool = True, parallel_work
         print(f"   - parallel_workers: {parallel_workers}")
         print(f"   - expected_questions: {expected_questions}")
         
-        # 保存上传的文件
-        file_path = f"temp_{file.filename}"
-        with open(file_path, "wb") as buffer:
-            content = await file.read()
-            buffer.write(content)
-        
-        try:
-            # 提取PDF文本
-            pdf_text = extract_pdf_text(file_path)
-            
-            if not use_llm:
-                # 仅返回原始文本
-                return {
-                    "filename": file.filename,
-                    "raw_content": pdf_text,
-                    "questions": [],
-                    "status": "success",
-                    "processed": False,
-                    "question_count": 0
-                }
-            
-            print(f"📄 开始处理PDF文件: {file.filename}")
-            print(f"📊 PDF文本长度: {len(pdf_text)} 字符")
-            
-            # 发送开始处理的消息
-            if progress_id:
-                progress_storage[progress_id] = {
-                    "type": "start",
-                    "message": f"开始处理PDF文件: {file.filename}",
-                    "text_length": len(pdf_text)
-                }
-            
-            questions = llm_processor.process_pdf_text_with_progress(
-                pdf_text, 
-                max_workers=parallel_workers, 
-                progress_id=progress_id,
-                expected_questions=expected_questions
-            )
-            
-            print(f"✅ 处理完成，提取到 {len(questions)} 个题目")
+        with span("process_pdf_file", filename=file.filename, use_llm=use_llm, parallel_workers=parallel_workers) as process_span, \
+                track_usage() as usage:
+            # 分块读取上传文件（小文件留在内存，大文件落到唯一的临时文件）
+            upload = await read_upload(file)
             
-            # 发送完成消息
-            if progress_id:
-                progress_storage[progress_id] = {
-                    "type": "complete",
-                    "message": f"处理完成！总共提取到 {len(questions)} 个题目",
-                    "question_count": len(questions)
-                }
-            
-            return {
-                "filename": file.filename,
-                "raw_content": pdf_text,
-                "questions": questions,
-                "status": "success",
-                "processed": True,
-                "question_count": len(questions),
-                "segment_count": len(llm_processor.get_last_segments()) if hasattr(llm_processor, 'get_last_segments') else 1,
-                "parallel_workers": parallel_workers,
-                "expected_questions": expected_questions
-            }
-            
-        finally:
-            # 清理临时文件
-            if os.path.exists(file_path):
-                os.remove(file_path)
+            try:
+                result = await extract_questions(
+                    upload, file.filename, use_llm, parallel_workers,
+                    progress_id=progress_id, expected_questions=expected_questions
+                )
+                process_span.set_attribute("questions", result["question_count"])
+                # 这份试卷消耗的token（缓存命中和合并掉的片段不计）
+                result["usage"] = usage.to_dict()
+                return result
+            finally:
+                # 释放上传缓冲区和临时文件
+                upload.close()
                 
     except Exception as e:
         return {
@@ -148,7 +305,129 @@ async def process_pdf_file(file: UploadFile, use_llm: bool = True, parallel_work
             "status": "error"
         }
 
+async def run_extraction_job(job: Job) -> dict:
+    """
+    后台任务入口：提取题目，进度事件发布给任务订阅者；
+    每个片段的状态记录在检查点中，恢复任务时只重新处理失败和未完成的片段
+    """
+    # 沿用提交任务的请求的trace，任务的执行过程接在上传请求之后；token用量记在提交接口名下
+    with trace("extraction_job", request_id=job.meta.get("request_id"), trace_id=job.meta.get("trace_id"),
+               job_id=job.id, resume=bool(job.payload.get("resume"))), track_usage("/api/jobs") as usage:
+        try:
+            result = await _run_extraction_job(job)
+            result["usage"] = usage.to_dict()
+            return result
+        finally:
+            # 失败或取消的任务也在状态中给出已消耗的用量（恢复任务只统计本次执行）
+            job.meta["usage"] = usage.to_dict()
+
+async def _run_extraction_job(job: Job) -> dict:
+    params = job.payload
+    on_progress = lambda event: extraction_jobs.publish(job, event)
+    
+    if params.get("resume"):
+        checkpoint = await run_store(SegmentCheckpoint.load, progress_store, job.id)
+        if checkpoint is None:
+            raise ValueError("检查点已过期，请重新上传")
+        # 早期片段的键只在写入时续期，恢复期间不能过期
+        await run_store(checkpoint.refresh)
+        questions = await run_blocking(
+            llm_processor.resume_segments,
+            checkpoint,
+            max_workers=params["parallel_workers"],
+            on_progress=on_progress,
+            cancel_event=job.cancel_event
+        )
+        result = {
+            "filename": job.meta["filename"],
+            "raw_content": checkpoint.raw_content,
+            "questions": questions,
+            "status": "success",
+            "processed": True,
+            "question_count": len(questions),
+            "segment_count": len(checkpoint.segments),
+            "parallel_workers": params["parallel_workers"],
+            "expected_questions": checkpoint.expected_questions
+        }
+    else:
+        checkpoint = SegmentCheckpoint(progress_store, job.id, {"expected_questions": params["expected_questions"]})
+        result = await extract_questions(
+            params["upload"], job.meta["filename"], params["use_llm"], params["parallel_workers"],
+            expected_questions=params["expected_questions"],
+            on_progress=on_progress,
+            cancel_event=job.cancel_event,
+            checkpoint=checkpoint if params["use_llm"] else None
+        )
+    if job.cancel_event.is_set():
+        raise JobCancelled()
+    if checkpoint.segments:
+        result["checkpoint"] = checkpoint.summary()
+    return result
+
+# PDF提取后台任务队列（有界并发和排队上限）
+extraction_jobs = JobQueue(run_extraction_job, store=progress_store)
 
+def register_app_metrics():
+    """
+    注册抓取时才取值的指标：缓存命中、上游并发和排队、任务队列深度等都直接读取已有的统计，
+    请求路径上没有额外开销
+    """
+    caches = (pdf_page_cache, explanation_cache, segment_cache)
+
+    def cache_hit_ratio():
+        ratios = {}
+        for cache in caches:
+            lookups = cache.hits + cache.misses
+            ratios[(cache.name,)] = cache.hits / lookups if lookups else 0
+        return ratios
+
+    def scheduler_classes(field):
+        return lambda: {
+            (priority,): values[field]
+            for priority, values in llm_client.governor.scheduler.stats()["classes"].items()
+        }
+
+    REGISTRY.callback("cache_hits_total", "缓存命中次数", lambda: {(c.name,): c.hits for c in caches}, "counter", ["cache"])
+    REGISTRY.callback("cache_misses_total", "缓存未命中次数", lambda: {(c.name,): c.misses for c in caches}, "counter", ["cache"])
+    REGISTRY.callback("cache_hit_ratio", "缓存命中率", cache_hit_ratio, "gauge", ["cache"])
+    REGISTRY.callback("llm_upstream_in_flight", "进行中的上游请求数", lambda: llm_client.governor.in_flight)
+    REGISTRY.callback("llm_upstream_waiting", "等待上游名额或限速的请求数", lambda: llm_client.governor.waiting)
+    REGISTRY.callback("llm_scheduler_in_flight", "各优先级占用的上游名额", scheduler_classes("in_flight"), "gauge", ["priority"])
+    REGISTRY.callback("llm_scheduler_waiting", "各优先级排队等待名额的请求数", scheduler_classes("waiting"), "gauge", ["priority"])
+    REGISTRY.callback("llm_coalesced_requests_total", "与进行中的相同请求合并而未发出的上游请求数",
+                      lambda: llm_client.coalescing_stats()["shared"], "counter")
+    REGISTRY.callback("llm_stream_cancelled_total", "客户端断开后被取消的上游流数",
+                      lambda: llm_stream_processor.cancelled_streams, "counter")
+    REGISTRY.callback("extraction_jobs_queued", "排队中的提取任务数（队列深度）", lambda: extraction_jobs.stats()["queued"])
+    REGISTRY.callback("extraction_jobs_running", "执行中的提取任务数", lambda: extraction_jobs.stats()["running"])
+    REGISTRY.callback("event_loop_blocked_total", "事件循环被阻塞超过阈值的次数", lambda: loop_monitor.blocked, "counter")
+    REGISTRY.callback("trace_spans_exported_total", "已导出的span数", lambda: get_span_exporter().exported, "counter")
+    REGISTRY.callback("trace_spans_dropped_total", "导出队列已满而丢弃的span数", lambda: get_span_exporter().dropped, "counter")
+
+register_app_metrics()
+
+@app.on_event("startup")
+async def startup_event():
+    """后台预热DashScope连接池，不阻塞服务启动；启动事件循环阻塞监控"""
+    asyncio.get_event_loop().run_in_executor(None, llm_client.prewarm)
+    asyncio.ensure_future(llm_client.aprewarm())
+    loop_monitor.start()
+    extraction_jobs.start()
+
+@app.on_event("shutdown")
+async def shutdown_event():
+    """关闭PDF提取进程池、提取线程池、缓存和连接池"""
+    await loop_monitor.stop()
+    await extraction_jobs.stop()
+    extraction_executor.shutdown(wait=False)
+    pdf_extractor.shutdown()
+    pdf_page_cache.close()
+    explanation_cache.close()
+    segment_cache.close()
+    progress_store.close()
+    shutdown_tracing()
+    llm_client.close()
+    await llm_client.aclose()
 
 @app.get("/", response_class=HTMLResponse)
 async def home():
@@ -188,13 +467,219 @@ async def get_progress(progress_id: str):
     """
     获取处理进度
     """
-    if progress_id in progress_storage:
-        return progress_storage[progress_id]
+    progress = await run_store(progress_store.get, progress_key(progress_id))
+    if progress is not None:
+        return progress
     else:
         return {"type": "error", "message": "进度ID不存在"}
 
 
 
+@app.post("/api/jobs")
+async def submit_extraction_job(
+    file: UploadFile = File(...),
+    use_llm: bool = Form(True),
+    parallel_workers: int = Form(3),
+    expected_questions: str = Form("")
+):
+    """
+    提交PDF提取后台任务，立即返回任务ID；
+    之后通过 /api/jobs/{job_id} 轮询状态、/api/jobs/{job_id}/events 订阅进度、/api/jobs/{job_id}/result 获取结果
+    
+    排队任务数达到 JOB_QUEUE_MAX 时返回503
+    """
+    expected_questions_int = None
+    if expected_questions and expected_questions.strip():
+        try:
+            expected_questions_int = int(expected_questions)
+        except ValueError:
+            print(f"⚠️ 预期题目数转换失败: {expected_questions}")
+    
+    try:
+        upload = await read_upload(file)
+    except Exception as e:
+        return JSONResponse(status_code=400, content={"error": f"读取上传文件失败: {str(e)}"})
+    
+    try:
+        job = extraction_jobs.submit(
+            {
+                "upload": upload,
+                "use_llm": use_llm,
+                "parallel_workers": parallel_workers,
+                "expected_questions": expected_questions_int
+            },
+            meta={"filename": file.filename, "request_id": current_request_id.get(), "trace_id": current_trace_id()},
+            cleanup=upload.close
+        )
+    except QueueFullError as e:
+        upload.close()
+        return JSONResponse(status_code=503, content={"error": str(e)}, headers={"Retry-After": "30"})
+    
+    print(f"📥 已提交提取任务 {job.id}: {file.filename}")
+    return JSONResponse(status_code=202, content={
+        **job.snapshot(),
+        "queue_position": extraction_jobs.queue_position(job)
+    })
+
+def job_not_found(job_id: str) -> JSONResponse:
+    return JSONResponse(status_code=404, content={"error": f"任务不存在: {job_id}"})
+
+@app.get("/api/jobs/{job_id}")
+async def get_extraction_job(job_id: str):
+    """
+    查询任务状态和最新进度
+    """
+    status = await extraction_jobs.status(job_id)
+    if status is None:
+        return job_not_found(job_id)
+    return status
+
+@app.get("/api/jobs/{job_id}/events")
+async def stream_extraction_job(job_id: str):
+    """
+    通过SSE订阅任务进度：先补发已有事件，之后实时推送，任务结束（job_complete / job_failed / job_cancelled）后关闭
+    """
+    events = await extraction_jobs.events(job_id)
+    if events is None:
+        return job_not_found(job_id)
+    
+    async def generate_stream():
+        """生成流式响应"""
+        async for event in events:
+            yield f"data: {json.dumps(event, ensure_ascii=False)}\n\n"
+    
+    return StreamingResponse(
+        generate_stream(),
+        media_type="text/event-stream",
+        headers={
+            "Cache-Control": "no-cache",
+            "Connection": "keep-alive",
+            "Access-Control-Allow-Origin": "*",
+            "Access-Control-Allow-Headers": "*",
+        }
+    )
+
+@app.get("/api/jobs/{job_id}/result")
+async def get_extraction_job_result(job_id: str):
+    """
+    获取任务结果，格式与 /upload 的返回相同；任务未结束时返回409
+    """
+    outcome = await extraction_jobs.result(job_id)
+    if outcome is None:
+        status = await extraction_jobs.status(job_id)
+        if status is None:
+            return job_not_found(job_id)
+        return JSONResponse(status_code=409, content={"error": "任务尚未完成", **status})
+    if outcome["status"] != JOB_SUCCEEDED:
+        return {
+            "filename": (await extraction_jobs.status(job_id) or {}).get("filename"),
+            "error": outcome["error"] or "任务已取消",
+            "status": "error",
+            "job_status": outcome["status"]
+        }
+    return outcome["result"]
+
+@app.post("/api/jobs/{job_id}/cancel")
+async def cancel_extraction_job(job_id: str):
+    """
+    取消任务：排队中的任务立即取消，执行中的任务在当前片段完成后停止
+    """
+    status = await extraction_jobs.request_cancel(job_id)
+    if status is None:
+        return job_not_found(job_id)
+    return status
+
+@app.post("/api/jobs/{job_id}/resume")
+async def resume_extraction_job(job_id: str, parallel_workers: int = Form(3)):
+    """
+    恢复任务：沿用原任务ID重新排队，只重新处理检查点中失败或未完成的片段，成功片段的题目直接沿用；
+    原任务提取页面的过程中被中断时检查点不完整，需要重新上传
+    """
+    status = await extraction_jobs.status(job_id)
+    if status is None:
+        return job_not_found(job_id)
+    if status["status"] not in FINISHED_STATES:
+        return JSONResponse(status_code=409, content={"error": "任务尚未结束，不能恢复", **status})
+    
+    checkpoint = await run_store(SegmentCheckpoint.load, progress_store, job_id)
+    if checkpoint is None:
+        return JSONResponse(status_code=409, content={"error": "没有可恢复的检查点，请重新上传"})
+    if not checkpoint.extraction_complete:
+        return JSONResponse(status_code=409, content={"error": "页面提取未完成，无法恢复，请重新上传", **checkpoint.summary()})
+    if not checkpoint.unfinished():
+        return JSONResponse(status_code=409, content={"error": "所有片段均已成功，无需恢复", **checkpoint.summary()})
+    
+    try:
+        job = extraction_jobs.submit(
+            {"resume": True, "parallel_workers": parallel_workers},
+            meta={"filename": status.get("filename"), "request_id": current_request_id.get(), "trace_id": current_trace_id()},
+            job_id=job_id
+        )
+    except QueueFullError as e:
+        return JSONResponse(status_code=503, content={"error": str(e)}, headers={"Retry-After": "30"})
+    
+    print(f"♻️ 恢复提取任务 {job_id}，重试 {len(checkpoint.unfinished())} 个片段")
+    return JSONResponse(status_code=202, content={
+        **job.snapshot(),
+        "queue_position": extraction_jobs.queue_position(job),
+        **checkpoint.summary()
+    })
+
+@app.get("/api/job-stats")
+async def get_job_stats():
+    """
+    获取后台任务队列统计（排队数、执行数、拒绝数等）
+    """
+    return {**extraction_jobs.stats(), "store": progress_store.stats()}
+
+@app.get("/api/cache-stats")
+async def get_cache_stats():
+    """
+    获取缓存命中统计（SQLite统计查询在线程池中执行）
+    """
+    pdf_pages, explanations, segments = await asyncio.gather(
+        pdf_page_cache.astats(), explanation_cache.astats(), segment_cache.astats()
+    )
+    return {
+        "pdf_pages": pdf_pages,
+        "explanations": explanations,
+        "segments": segments,
+        "llm_coalescing": llm_client.coalescing_stats()
+    }
+
+@app.get("/api/llm-stats")
+async def get_llm_stats():
+    """
+    获取上游调用调速统计（排队时延、限流重试次数、当前并发）
+    """
+    return {
+        "governor": llm_client.governor.stats(),
+        "explanation_hedging": explanation_processor.latency.stats(),
+        "stream_cancellation": llm_stream_processor.cancellation_stats()
+    }
+
+@app.get("/api/usage-stats")
+async def get_usage_stats():
+    """
+    获取进程启动以来的token用量：总计，以及按接口、处理器、模型分组；
+    unreported_calls 为已产生输出但没有拿到用量的上游调用数（如客户端断开后被关闭的流）
+    """
+    return USAGE_STATS.stats()
+
+@app.get("/metrics")
+async def get_metrics():
+    """
+    Prometheus文本格式的指标：各阶段耗时直方图、解析失败、缓存命中、并发和队列深度
+    """
+    return PlainTextResponse(REGISTRY.render(), media_type="text/plain; version=0.0.4")
+
+@app.get("/api/loop-stats")
+async def get_loop_stats():
+    """
+    获取事件循环阻塞统计，blocked 持续增长说明有同步调用阻塞了事件循环
+    """
+    return loop_monitor.stats()
+
 @app.post("/api/extract")
 async def extract_pdf_api(
     file: UploadFile = File(...), 
@@ -214,6 +699,29 @@ async def extract_pdf_raw(file: UploadFile = File(...)):
     """
     return await process_pdf_file(file, use_llm=False)
 
+def request_usage():
+    """当前请求到目前为止消耗的token用量（由 UsageMiddleware 开启统计），不在统计范围内时返回None"""
+    usage = current_usage.get()
+    return usage.to_dict() if usage is not None else None
+
+def request_deadline(request: Request, body: dict):
+    """
+    读取调用方给出的时间预算：请求头 X-Request-Deadline-Ms 或请求体 deadline_ms（剩余毫秒数）
+    
+    Returns:
+        截止时间（事件循环时钟），未提供时返回None
+    """
+    budget_ms = request.headers.get("X-Request-Deadline-Ms", body.get("deadline_ms"))
+    if budget_ms is None:
+        return None
+    # 请求体是任意JSON，列表、对象、布尔值等一律按格式错误处理
+    if isinstance(budget_ms, bool) or not isinstance(budget_ms, (int, float, str)):
+        raise ValueError("deadline_ms 必须是数字")
+    budget_ms = float(budget_ms)
+    if not math.isfinite(budget_ms) or budget_ms <= 0:
+        raise ValueError("deadline_ms 必须是大于0的有限数字")
+    return asyncio.get_event_loop().time() + budget_ms / 1000
+
 @app.post("/api/generate-explanation")
 async def generate_explanation(request: Request):
     """
@@ -235,7 +743,9 @@ async def generate_explanation(request: Request):
                 {"label": "C", "value": "C", "text": "选项内容"},
                 {"label": "D", "value": "D", "text": "选项内容"}
             ]
-        }
+        },
+        "force_refresh": false,  // 可选，为true时跳过缓存重新生成
+        "deadline_ms": 3000  // 可选，调用方愿意等待的毫秒数，也可通过请求头 X-Request-Deadline-Ms 传入
     }
     """
     try:
@@ -258,8 +768,20 @@ async def generate_explanation(request: Request):
                 content={"error": "题目数据格式不正确"}
             )
         
-        # 生成解析
-        result = explanation_processor.generate_explanation(question_data)
+        try:
+            deadline = request_deadline(request, body)
+        except ValueError as e:
+            return JSONResponse(
+                status_code=400,
+                content={"error": f"截止时间格式不正确: {str(e)}"}
+            )
+        
+        # 生成解析（超过近期p95耗时未返回时自动对冲）
+        result = await explanation_processor.agenerate_explanation(
+            question_data,
+            force_refresh=bool(body.get("force_refresh", False)),
+            deadline=deadline
+        )
         
         return JSONResponse(content=result)
         
@@ -274,6 +796,100 @@ async def generate_explanation(request: Request):
             content={"error": f"生成解析失败: {str(e)}"}
         )
 
+@app.post("/api/generate-explanation/stream")
+async def stream_explanation(request: Request):
+    """
+    流式生成单个题目的答案解析，模型每输出一段文本就通过SSE推送
+    
+    请求体格式与 /api/generate-explanation 相同。
+    事件类型：delta（增量文本 content）、complete（result 与非流式接口的返回结构相同）
+    """
+    try:
+        body = await request.json()
+    except json.JSONDecodeError:
+        return JSONResponse(
+            status_code=400,
+            content={"error": "请求体不是有效的JSON格式"}
+        )
+    
+    if "question" not in body:
+        return JSONResponse(
+            status_code=400,
+            content={"error": "请求体中缺少question字段"}
+        )
+    
+    question_data = body["question"]
+    if not explanation_processor.validate_question_data(question_data):
+        return JSONResponse(
+            status_code=400,
+            content={"error": "题目数据格式不正确"}
+        )
+    
+    try:
+        deadline = request_deadline(request, body)
+    except ValueError as e:
+        return JSONResponse(
+            status_code=400,
+            content={"error": f"截止时间格式不正确: {str(e)}"}
+        )
+    
+    async def generate_stream():
+        """生成流式响应"""
+        async for event in explanation_processor.astream_explanation(
+            question_data,
+            force_refresh=bool(body.get("force_refresh", False)),
+            deadline=deadline
+        ):
+            yield f"data: {json.dumps(event, ensure_ascii=False)}\n\n"
+    
+    return StreamingResponse(
+        generate_stream(),
+        media_type="text/event-stream",
+        headers={
+            "Cache-Control": "no-cache",
+            "Connection": "keep-alive",
+            "Access-Control-Allow-Origin": "*",
+            "Access-Control-Allow-Headers": "*",
+        }
+    )
+
+def validate_batch_questions(body: dict):
+    """
+    校验批量解析请求体
+    
+    Returns:
+        tuple: (题目列表, 错误响应)，校验通过时错误响应为None
+    """
+    if "questions" not in body:
+        return None, JSONResponse(
+            status_code=400,
+            content={"error": "请求体中缺少questions字段"}
+        )
+    
+    questions = body["questions"]
+    
+    if not isinstance(questions, list):
+        return None, JSONResponse(
+            status_code=400,
+            content={"error": "questions字段必须是数组"}
+        )
+    
+    if len(questions) == 0:
+        return None, JSONResponse(
+            status_code=400,
+            content={"error": "questions数组不能为空"}
+        )
+    
+    # 验证每个题目数据
+    for i, question in enumerate(questions):
+        if not explanation_processor.validate_question_data(question):
+            return None, JSONResponse(
+                status_code=400,
+                content={"error": f"第{i+1}个题目数据格式不正确"}
+            )
+    
+    return questions, None
+
 @app.post("/api/generate-batch-explanations")
 async def generate_batch_explanations(request: Request):
     """
@@ -297,7 +913,10 @@ async def generate_batch_explanations(request: Request):
                     {"label": "D", "value": "D", "text": "选项内容"}
                 ]
             }
-        ]
+        ],
+        "max_workers": 5,  // 可选，并发数
+        "force_refresh": false,  // 可选，为true时跳过缓存重新生成
+        "packed": false  // 可选，为true时把多道题目打包进一次请求，适合大批量回填
     }
     """
     try:
@@ -305,42 +924,24 @@ async def generate_batch_explanations(request: Request):
         body = await request.json()
         
         # 验证请求数据
-        if "questions" not in body:
-            return JSONResponse(
-                status_code=400,
-                content={"error": "请求体中缺少questions字段"}
-            )
+        questions, error_response = validate_batch_questions(body)
+        if error_response:
+            return error_response
         
-        questions = body["questions"]
-        
-        if not isinstance(questions, list):
-            return JSONResponse(
-                status_code=400,
-                content={"error": "questions字段必须是数组"}
-            )
-        
-        if len(questions) == 0:
-            return JSONResponse(
-                status_code=400,
-                content={"error": "questions数组不能为空"}
-            )
-        
-        # 验证每个题目数据
-        for i, question in enumerate(questions):
-            if not explanation_processor.validate_question_data(question):
-                return JSONResponse(
-                    status_code=400,
-                    content={"error": f"第{i+1}个题目数据格式不正确"}
-                )
-        
-        # 批量生成解析
-        results = explanation_processor.generate_batch_explanations(questions)
+        # 批量生成解析（有界并发）
+        results = await explanation_processor.agenerate_batch_explanations(
+            questions,
+            body.get("max_workers"),
+            force_refresh=bool(body.get("force_refresh", False)),
+            packed=bool(body.get("packed", False))
+        )
         
         return JSONResponse(content={
             "results": results,
             "total_count": len(results),
             "success_count": len([r for r in results if r["status"] == "success"]),
-            "error_count": len([r for r in results if r["status"] == "error"])
+            "error_count": len([r for r in results if r["status"] == "error"]),
+            "usage": request_usage()
         })
         
     except json.JSONDecodeError:
@@ -355,14 +956,83 @@ async def generate_batch_explanations(request: Request):
         )
 
 
+@app.post("/api/generate-batch-explanations/stream")
+async def stream_batch_explanations(request: Request):
+    """
+    流式批量生成答案解析，每完成一个题目立即通过SSE返回，
+    事件中的 index 为该题目在请求 questions 数组中的下标
+    
+    请求体格式与 /api/generate-batch-explanations 相同，可选 max_workers、force_refresh、packed
+    """
+    try:
+        body = await request.json()
+    except json.JSONDecodeError:
+        return JSONResponse(
+            status_code=400,
+            content={"error": "请求体不是有效的JSON格式"}
+        )
+    
+    questions, error_response = validate_batch_questions(body)
+    if error_response:
+        return error_response
+    
+    async def generate_stream():
+        """生成流式响应"""
+        success_count = 0
+        error_count = 0
+        try:
+            async for index, result in explanation_processor.aiter_batch_explanations(
+                questions,
+                body.get("max_workers"),
+                force_refresh=bool(body.get("force_refresh", False)),
+                packed=bool(body.get("packed", False))
+            ):
+                if result["status"] == "success":
+                    success_count += 1
+                else:
+                    error_count += 1
+                yield f"data: {json.dumps({'type': 'explanation', 'index': index, 'result': result}, ensure_ascii=False)}\n\n"
+            
+            complete_data = {
+                "type": "batch_complete",
+                "total_count": len(questions),
+                "success_count": success_count,
+                "error_count": error_count,
+                "usage": request_usage()
+            }
+            yield f"data: {json.dumps(complete_data, ensure_ascii=False)}\n\n"
+        except Exception as e:
+            error_data = {
+                "type": "error",
+                "message": f"批量生成解析失败: {str(e)}",
+                "error": str(e)
+            }
+            yield f"data: {json.dumps(error_data, ensure_ascii=False)}\n\n"
+    
+    return StreamingResponse(
+        generate_stream(),
+        media_type="text/event-stream",
+        headers={
+            "Cache-Control": "no-cache",
+            "Connection": "keep-alive",
+            "Access-Control-Allow-Origin": "*",
+            "Access-Control-Allow-Headers": "*",
+        }
+    )
+
 @app.post("/api/stream-extract")
 async def stream_extract_pdf(
+    request: Request,
     file: UploadFile = File(...),
-    expected_questions: str = Form("")
+    expected_questions: str = Form(""),
+    parallel_streams: int = Form(0)
 ):
     """
     流式处理PDF文件，实时返回题目结果
-    使用LLM的流式输出，每当生成一个完整题目就立即返回
+    使用LLM的流式输出，每当生成一个完整题目就立即返回；
+    多个片段并发处理，题目按原文顺序返回（question_index 为题目在原文中的位置）
+    
+    parallel_streams: 并发流式调用数，0 表示使用 STREAM_PARALLEL_STREAMS
     """
     # 处理expected_questions参数
     expected_questions_int = None
@@ -372,31 +1042,38 @@ async def stream_extract_pdf(
         except ValueError:
             print(f"⚠️ 预期题目数转换失败: {expected_questions}")
     
-    # 先读取文件内容
-    content = await file.read()
+    # 分块读取上传文件（小文件留在内存，大文件落到唯一的临时文件）
+    try:
+        upload = await read_upload(file)
+    except Exception as e:
+        upload = None
+        read_error = str(e)
     
-    def generate_stream():
-        """生成流式响应"""
-        file_path = None
+    async def generate_stream():
+        """
+        生成流式响应；客户端断开时该生成器被取消（见 CancelOnDisconnectResponse），
+        取消会传递到各片段的上游流式请求并立即关闭连接
+        """
+        events = None
         try:
-            # 保存上传的文件
-            file_path = f"temp_{file.filename}"
-            with open(file_path, "wb") as buffer:
-                buffer.write(content)
+            if upload is None:
+                raise ValueError(read_error)
             
-            # 提取PDF文本
-            pdf_text = extract_pdf_text(file_path)
-            
-            # 使用LLM流式处理器
-            for data in llm_stream_processor.process_pdf_text_stream(
-                pdf_text,
-                expected_questions=expected_questions_int
-            ):
+            # 边提取边流式处理：凑够完整题目的片段立即交给LLM
+            events = llm_stream_processor.process_pdf_pages_stream_async(
+                iter_pdf_pages(upload),
+                expected_questions=expected_questions_int,
+                parallel_streams=parallel_streams or None
+            )
+            async for data in events:
                 yield f"data: {json.dumps(data, ensure_ascii=False)}\n\n"
             
             # 发送结束标记
-            yield f"data: {json.dumps({'type': 'stream_end', 'message': '流式处理完成'}, ensure_ascii=False)}\n\n"
+            yield f"data: {json.dumps({'type': 'stream_end', 'message': '流式处理完成', 'usage': request_usage()}, ensure_ascii=False)}\n\n"
                 
+        except asyncio.CancelledError:
+            print("🔌 客户端已断开，停止流式处理")
+            raise
         except Exception as e:
             error_data = {
                 "type": "error",
@@ -405,14 +1082,16 @@ async def stream_extract_pdf(
             }
             yield f"data: {json.dumps(error_data, ensure_ascii=False)}\n\n"
         finally:
-            # 清理临时文件
-            if file_path and os.path.exists(file_path):
-                try:
-                    os.remove(file_path)
-                except:
-                    pass
+            try:
+                # 流水线关闭时会等页面线程结束，之后才能释放上传文件
+                if events is not None:
+                    await events.aclose()
+            finally:
+                # 释放上传缓冲区和临时文件
+                if upload is not None:
+                    upload.close()
     
-    return StreamingResponse(
+    return CancelOnDisconnectResponse(
         generate_stream(),
         media_type="text/event-stream",
         headers={
@@ -0,0 +1,291 @@
+import bisect
+import math
+import threading
+import time
+from contextlib import ContextDecorator
+from typing import Callable, Dict, Iterable, List, Optional, Tuple, Union
+
+# 默认耗时分桶（秒），覆盖从毫秒级的缓存命中到分钟级的长流式调用
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120)
+
+LabelValues = Tuple[str, ...]
+
+
+def _escape(value: str) -> str:
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _format_labels(names: Iterable[str], values: Iterable[str], extra: str = "") -> str:
+    parts = [f'{name}="{_escape(value)}"' for name, value in zip(names, values)]
+    if extra:
+        parts.append(extra)
+    return "{" + ",".join(parts) + "}" if parts else ""
+
+
+def _format_value(value: float) -> str:
+    if math.isinf(value):
+        return "+Inf" if value > 0 else "-Inf"
+    if float(value).is_integer():
+        return str(int(value))
+    return repr(float(value))
+
+
+class _Metric:
+    kind = ""
+
+    def __init__(self, name: str, documentation: str, labelnames: Iterable[str] = ()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._lock = threading.Lock()
+        self._children: Dict[LabelValues, object] = {}
+
+    def _new_child(self):
+        raise NotImplementedError
+
+    def labels(self, *values: str):
+        """按标签值取子指标，标签值按 labelnames 的顺序传入"""
+        if len(values) != len(self.labelnames):
+            raise ValueError(f"{self.name} 需要标签 {self.labelnames}，实际传入 {values}")
+        key = tuple(str(value) for value in values)
+        child = self._children.get(key)
+        if child is None:
+            with self._lock:
+                child = self._children.setdefault(key, self._new_child())
+        return child
+
+    def _default(self):
+        if self.labelnames:
+            raise ValueError(f"{self.name} 带有标签，需先调用 labels()")
+        return self.labels()
+
+    def header(self) -> List[str]:
+        return [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.kind}"]
+
+    def render(self) -> List[str]:
+        raise NotImplementedError
+
+
+class _Value:
+    __slots__ = ("_lock", "value")
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.value = 0.0
+
+    def inc(self, amount: float = 1):
+        with self._lock:
+            self.value += amount
+
+    def dec(self, amount: float = 1):
+        with self._lock:
+            self.value -= amount
+
+    def set(self, value: float):
+        self.value = value
+
+
+class Counter(_Metric):
+    """只增不减的计数器"""
+
+    kind = "counter"
+
+    def _new_child(self):
+        return _Value()
+
+    def inc(self, amount: float = 1):
+        self._default().inc(amount)
+
+    def render(self) -> List[str]:
+        lines = self.header()
+        for values, child in sorted(self._children.items()):
+            lines.append(f"{self.name}{_format_labels(self.labelnames, values)} {_format_value(child.value)}")
+        return lines
+
+
+class Gauge(Counter):
+    """可增可减的瞬时值"""
+
+    kind = "gauge"
+
+    def dec(self, amount: float = 1):
+        self._default().dec(amount)
+
+    def set(self, value: float):
+        self._default().set(value)
+
+
+class _HistogramValue:
+    __slots__ = ("_lock", "_bounds", "counts", "sum", "count")
+
+    def __init__(self, bounds: Tuple[float, ...]):
+        self._lock = threading.Lock()
+        self._bounds = bounds
+        # 最后一个桶对应 +Inf
+        self.counts = [0] * (len(bounds) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value: float):
+        index = bisect.bisect_left(self._bounds, value)
+        with self._lock:
+            self.counts[index] += 1
+            self.sum += value
+            self.count += 1
+
+    def time(self) -> "_Timer":
+        """计时代码块或函数，结束时把耗时（秒）记入直方图；可用作上下文管理器或装饰器"""
+        return _Timer(self)
+
+    def snapshot(self) -> Tuple[List[int], float, int]:
+        with self._lock:
+            return list(self.counts), self.sum, self.count
+
+
+class _Timer(ContextDecorator):
+    def __init__(self, target: _HistogramValue):
+        self._target = target
+        self._started = 0.0
+
+    def _recreate_cm(self):
+        # 用作装饰器时每次调用使用新的计时器，多线程并发调用互不干扰
+        return _Timer(self._target)
+
+    def __enter__(self):
+        self._started = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self._target.observe(time.perf_counter() - self._started)
+        return False
+
+
+class Histogram(_Metric):
+    """
+    固定分桶直方图：观测一次只需一次二分查找和一次加锁累加，
+    分桶在抓取时才累加成 Prometheus 要求的累计形式
+    """
+
+    kind = "histogram"
+
+    def __init__(self, name: str, documentation: str, labelnames: Iterable[str] = (), buckets: Iterable[float] = DEFAULT_BUCKETS):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(sorted(buckets))
+
+    def _new_child(self):
+        return _HistogramValue(self.buckets)
+
+    def observe(self, value: float):
+        self._default().observe(value)
+
+    def render(self) -> List[str]:
+        lines = self.header()
+        for values, child in sorted(self._children.items()):
+            counts, total, count = child.snapshot()
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets + (math.inf,), counts):
+                cumulative += bucket_count
+                labels = _format_labels(self.labelnames, values, f'le="{_format_value(bound)}"')
+                lines.append(f"{self.name}_bucket{labels} {cumulative}")
+            labels = _format_labels(self.labelnames, values)
+            lines.append(f"{self.name}_sum{labels} {_format_value(total)}")
+            lines.append(f"{self.name}_count{labels} {count}")
+        return lines
+
+
+class CallbackMetric(_Metric):
+    """
+    抓取时才调用回调取值的指标，用于已经在别处统计好的数值（缓存命中、并发数、队列深度等），
+    请求路径上没有任何额外开销。回调返回单个数值，或 {标签值元组: 数值}
+    """
+
+    def __init__(self, name: str, documentation: str, fn: Callable[[], Union[float, Dict[LabelValues, float]]],
+                 kind: str = "gauge", labelnames: Iterable[str] = ()):
+        super().__init__(name, documentation, labelnames)
+        self.kind = kind
+        self.fn = fn
+
+    def render(self) -> List[str]:
+        try:
+            samples = self.fn()
+        except Exception as e:
+            print(f"⚠️ 采集指标 {self.name} 失败: {str(e)}")
+            return []
+        if not isinstance(samples, dict):
+            samples = {(): samples}
+        lines = self.header()
+        for values, value in sorted(samples.items()):
+            if value is None:
+                continue
+            lines.append(f"{self.name}{_format_labels(self.labelnames, values)} {_format_value(value)}")
+        return lines
+
+
+class MetricsRegistry:
+    """指标注册表，render() 输出 Prometheus 文本格式"""
+
+    def __init__(self):
+        self._metrics: Dict[str, _Metric] = {}
+        self._lock = threading.Lock()
+
+    def register(self, metric: _Metric) -> _Metric:
+        with self._lock:
+            if metric.name in self._metrics:
+                raise ValueError(f"指标 {metric.name} 已注册")
+            self._metrics[metric.name] = metric
+        return metric
+
+    def counter(self, name: str, documentation: str, labelnames: Iterable[str] = ()) -> Counter:
+        return self.register(Counter(name, documentation, labelnames))
+
+    def gauge(self, name: str, documentation: str, labelnames: Iterable[str] = ()) -> Gauge:
+        return self.register(Gauge(name, documentation, labelnames))
+
+    def histogram(self, name: str, documentation: str, labelnames: Iterable[str] = (),
+                  buckets: Iterable[float] = DEFAULT_BUCKETS) -> Histogram:
+        return self.register(Histogram(name, documentation, labelnames, buckets))
+
+    def callback(self, name: str, documentation: str, fn: Callable[[], Union[float, Dict[LabelValues, float]]],
+                 kind: str = "gauge", labelnames: Iterable[str] = ()) -> CallbackMetric:
+        """注册抓取时取值的指标；同名指标重复注册时替换回调（应用重新加载时）"""
+        metric = CallbackMetric(name, documentation, fn, kind, labelnames)
+        with self._lock:
+            self._metrics[name] = metric
+        return metric
+
+    def get(self, name: str) -> Optional[_Metric]:
+        return self._metrics.get(name)
+
+    def render(self) -> str:
+        with self._lock:
+            metrics = list(self._metrics.values())
+        lines = []
+        for metric in metrics:
+            lines.extend(metric.render())
+        return "\n".join(lines) + "\n"
+
+
+REGISTRY = MetricsRegistry()
+
+# 各处理阶段的指标，在对应模块中直接观测
+PDF_PAGE_SECONDS = REGISTRY.histogram(
+    "pdf_page_extract_seconds", "单页PDF文本提取耗时（不含缓存命中的页）",
+    buckets=(0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5)
+)
+SPLIT_SECONDS = REGISTRY.histogram(
+    "text_split_seconds", "一份文本切分为片段的耗时", ["splitter"],
+    buckets=(0.0005, 0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1)
+)
+UPSTREAM_TTFB_SECONDS = REGISTRY.histogram(
+    "llm_upstream_ttfb_seconds", "上游首字节耗时：非流式为收到响应头，流式为收到第一段增量文本", ["processor", "mode"]
+)
+UPSTREAM_LATENCY_SECONDS = REGISTRY.histogram(
+    "llm_upstream_latency_seconds", "上游请求总耗时（不含排队限速）", ["processor", "mode", "outcome"]
+)
+STREAM_TOKENS_PER_SECOND = REGISTRY.histogram(
+    "llm_stream_tokens_per_second", "流式输出速度：首段文本之后每秒生成的token数", ["processor"],
+    buckets=(5, 10, 20, 30, 40, 60, 80, 100, 150, 200, 300)
+)
+PARSE_FAILURES = REGISTRY.counter(
+    "llm_parse_failures_total", "模型输出解析失败次数", ["parser"]
+)
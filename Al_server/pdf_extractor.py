@@ -0,0 +1,217 @@
+import hashlib
+import os
+import threading
+import time
+import pdfplumber
+from concurrent.futures import ProcessPoolExecutor
+from typing import Dict, Generator, List, Tuple, Union
+from cache_store import SQLiteCache
+from metrics import PDF_PAGE_SECONDS
+from tracing import record_span
+from upload_buffer import UploadBuffer
+
+
+# 提取逻辑或pdfplumber版本变化时，旧缓存自动失效
+EXTRACTOR_VERSION = f"pdfplumber-{pdfplumber.__version__}-v1"
+
+
+def _extract_page(pdf, page_index: int) -> Tuple[str, int, int]:
+    """提取单页文本，同时返回起止时间（Unix纳秒，跨进程可比）"""
+    started_ns = time.time_ns()
+    page_text = pdf.pages[page_index].extract_text() or ""
+    return page_text, started_ns, time.time_ns()
+
+
+def _record_page(page_index: int, started_ns: int, ended_ns: int, **attributes):
+    """记录单页提取的耗时指标和span"""
+    PDF_PAGE_SECONDS.observe((ended_ns - started_ns) / 1e9)
+    record_span("pdf.page", started_ns, ended_ns, page=page_index, **attributes)
+
+
+def _extract_page_indices(file_path: str, page_indices: List[int]) -> List[Tuple[str, int, int]]:
+    """子进程入口：重新打开PDF，提取指定页的文本和起止时间"""
+    with pdfplumber.open(file_path) as pdf:
+        return [_extract_page(pdf, page_index) for page_index in page_indices]
+
+
+def file_sha256(file_path: str) -> str:
+    """计算文件内容的SHA-256"""
+    digest = hashlib.sha256()
+    with open(file_path, "rb") as f:
+        for block in iter(lambda: f.read(1024 * 1024), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def _open_pdf(source: Union[str, UploadBuffer]):
+    """打开PDF，source 可以是文件路径，也可以是内存/磁盘上的上传缓冲区"""
+    if isinstance(source, str):
+        return pdfplumber.open(source)
+    return pdfplumber.open(source.open_stream())
+
+
+def _source_path(source: Union[str, UploadBuffer]) -> str:
+    """子进程只能按路径重新打开PDF，上传缓冲区在内存中时先落盘"""
+    return source if isinstance(source, str) else source.ensure_path()
+
+
+def _source_digest(source: Union[str, UploadBuffer]) -> str:
+    return file_sha256(source) if isinstance(source, str) else source.sha256
+
+
+def join_page_texts(page_texts: List[str]) -> str:
+    """把逐页文本拼成整份文本，与逐页 += 的结果一致"""
+    return "\n".join(text for text in page_texts if text).strip()
+
+
+class PDFExtractor:
+    """
+    PDF文本提取器，按页分片后交给进程池并行提取，页数较少时退化为串行。
+    配置了缓存时，按 (PDF内容SHA-256, 页码, 提取器版本) 缓存每页文本，只提取缺失的页
+    """
+
+    def __init__(self, max_workers: int = None, min_parallel_pages: int = None, cache: SQLiteCache = None):
+        self.max_workers = max_workers or int(os.getenv("PDF_EXTRACT_WORKERS", str(os.cpu_count() or 1)))
+        # 页数低于该值时直接串行提取，避免进程调度开销超过收益
+        self.min_parallel_pages = min_parallel_pages or int(os.getenv("PDF_PARALLEL_MIN_PAGES", "8"))
+        self.cache = cache
+        self._executor = None
+        self._lock = threading.Lock()
+
+    def _get_executor(self) -> ProcessPoolExecutor:
+        """懒加载进程池，整个服务共用一个"""
+        with self._lock:
+            if self._executor is None:
+                self._executor = ProcessPoolExecutor(max_workers=self.max_workers)
+            return self._executor
+
+    def shutdown(self):
+        """关闭进程池"""
+        with self._lock:
+            if self._executor is not None:
+                self._executor.shutdown(wait=False)
+                self._executor = None
+
+    def _split_page_shards(self, page_indices: List[int]) -> List[List[int]]:
+        """把待提取的页码切成连续的若干段，每个worker负责一段"""
+        shard_count = min(self.max_workers, len(page_indices))
+        shard_size = -(-len(page_indices) // shard_count)
+        return [
+            page_indices[start:start + shard_size]
+            for start in range(0, len(page_indices), shard_size)
+        ]
+
+    def _doc_key(self, digest: str) -> str:
+        return f"doc:{digest}:{EXTRACTOR_VERSION}"
+
+    def _page_key(self, digest: str, page_index: int) -> str:
+        return f"page:{digest}:{EXTRACTOR_VERSION}:{page_index}"
+
+    def _load_cached_pages(self, source: Union[str, UploadBuffer], digest: str) -> tuple:
+        """
+        读取缓存中的页数和页面文本
+
+        Returns:
+            tuple: (页数, {页码: 文本})
+        """
+        page_count = None
+        if self.cache:
+            cached_count = self.cache.get(self._doc_key(digest))
+            if cached_count is not None:
+                page_count = int(cached_count)
+
+        if page_count is None:
+            with _open_pdf(source) as pdf:
+                page_count = len(pdf.pages)
+            if self.cache:
+                self.cache.set(self._doc_key(digest), str(page_count))
+
+        if not self.cache:
+            return page_count, {}
+
+        keys = {self._page_key(digest, i): i for i in range(page_count)}
+        cached = self.cache.get_many(keys)
+        return page_count, {keys[key]: text for key, text in cached.items()}
+
+    def iter_pages(self, source: Union[str, UploadBuffer], digest: str = None) -> Generator[str, None, None]:
+        """
+        按页码顺序惰性产出每页文本，前面的页提取完即可交给下游处理
+
+        Args:
+            source: PDF文件路径或上传缓冲区
+            digest: PDF内容的SHA-256，调用方已算好时传入可避免重复读文件
+
+        Yields:
+            str: 单页文本
+        """
+        if self.cache and not digest:
+            digest = _source_digest(source)
+
+        page_count, cached_pages = self._load_cached_pages(source, digest)
+        missing = [i for i in range(page_count) if i not in cached_pages]
+
+        if not missing:
+            print(f"⚡ PDF共 {page_count} 页，全部命中缓存")
+            for page_index in range(page_count):
+                yield cached_pages[page_index]
+            return
+
+        if cached_pages:
+            print(f"⚡ PDF共 {page_count} 页，缓存命中 {len(cached_pages)} 页，提取剩余 {len(missing)} 页")
+
+        if self.max_workers <= 1 or len(missing) < self.min_parallel_pages:
+            with _open_pdf(source) as pdf:
+                for page_index in range(page_count):
+                    if page_index in cached_pages:
+                        yield cached_pages[page_index]
+                        continue
+                    page_text, started_ns, ended_ns = _extract_page(pdf, page_index)
+                    _record_page(page_index, started_ns, ended_ns)
+                    if self.cache:
+                        self.cache.set(self._page_key(digest, page_index), page_text)
+                    yield page_text
+            return
+
+        shards = self._split_page_shards(missing)
+        print(f"📄 PDF共 {page_count} 页，{len(missing)} 页分 {len(shards)} 段并行提取")
+
+        file_path = _source_path(source)
+        executor = self._get_executor()
+        futures = [executor.submit(_extract_page_indices, file_path, shard) for shard in shards]
+        shard_of_page = {page_index: n for n, shard in enumerate(shards) for page_index in shard}
+
+        # 按页码顺序产出，遇到未缓存的页就等待其所在分段完成
+        extracted: Dict[int, str] = {}
+        for page_index in range(page_count):
+            if page_index in cached_pages:
+                yield cached_pages[page_index]
+                continue
+            if page_index not in extracted:
+                shard_index = shard_of_page[page_index]
+                shard_results = futures[shard_index].result()
+                for i, (_, started_ns, ended_ns) in zip(shards[shard_index], shard_results):
+                    _record_page(i, started_ns, ended_ns, shard=shard_index)
+                shard_texts = {i: result[0] for i, result in zip(shards[shard_index], shard_results)}
+                extracted.update(shard_texts)
+                if self.cache:
+                    self.cache.set_many({
+                        self._page_key(digest, i): text for i, text in shard_texts.items()
+                    })
+            yield extracted[page_index]
+
+    def extract_pages(self, source: Union[str, UploadBuffer], digest: str = None) -> List[str]:
+        """
+        按页提取PDF文本
+
+        Args:
+            source: PDF文件路径或上传缓冲区
+            digest: PDF内容的SHA-256（可选）
+
+        Returns:
+            List[str]: 每页的文本，按页码顺序排列
+        """
+        return list(self.iter_pages(source, digest))
+
+    def extract_text(self, source: Union[str, UploadBuffer], digest: str = None) -> str:
+        """提取整份PDF文本，页与页之间以换行连接"""
+        return join_page_texts(self.extract_pages(source, digest))
@@ -0,0 +1,306 @@
+import asyncio
+import json
+import os
+import socket
+import threading
+import time
+from collections import OrderedDict
+from typing import Any, AsyncGenerator, Dict, List, Optional, Tuple
+from urllib.parse import unquote, urlparse
+
+
+def progress_key(progress_id: str) -> str:
+    """上传进度在存储中的键"""
+    return f"progress:{progress_id}"
+
+
+class ProgressStore:
+    """
+    进度/任务状态存储接口：带TTL的键值读写，以及按频道的发布订阅。
+    值和消息必须可以JSON序列化
+    """
+
+    def get(self, key: str) -> Optional[Any]:
+        raise NotImplementedError
+
+    def set(self, key: str, value: Any, ttl: float = None):
+        raise NotImplementedError
+
+    def delete(self, key: str):
+        raise NotImplementedError
+
+    def publish(self, channel: str, message: Any):
+        """发布消息，可以在任意线程中调用"""
+        raise NotImplementedError
+
+    def subscribe(self, channel: str) -> AsyncGenerator[Any, None]:
+        """订阅频道，逐条产出之后发布的消息，调用方停止迭代即退订"""
+        raise NotImplementedError
+
+    def stats(self) -> Dict[str, Any]:
+        return {}
+
+    def close(self):
+        pass
+
+
+class MemoryProgressStore(ProgressStore):
+    """
+    进程内存储：条目数超过上限时淘汰最久未访问的条目（LRU），每个条目按写入时间过期（TTL）。
+    只在单个worker进程内可见
+    """
+
+    def __init__(self, max_entries: int = None, ttl: float = None):
+        self.max_entries = max_entries or int(os.getenv("PROGRESS_STORE_MAX_ENTRIES", "10000"))
+        self.ttl = ttl or float(os.getenv("PROGRESS_STORE_TTL", "3600"))
+        self._entries: "OrderedDict[str, Tuple[float, Any]]" = OrderedDict()
+        self._subscribers: Dict[str, List[Tuple[asyncio.AbstractEventLoop, asyncio.Queue]]] = {}
+        self._lock = threading.Lock()
+        self.evicted = 0
+        self.expired = 0
+
+    def get(self, key: str) -> Optional[Any]:
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            if entry[0] < time.monotonic():
+                del self._entries[key]
+                self.expired += 1
+                return None
+            self._entries.move_to_end(key)
+            return entry[1]
+
+    def set(self, key: str, value: Any, ttl: float = None):
+        with self._lock:
+            now = time.monotonic()
+            self._entries[key] = (now + (ttl or self.ttl), value)
+            self._entries.move_to_end(key)
+            # 顺带清理最久未访问一端已过期的条目
+            while self._entries:
+                oldest_key, (expires_at, _) = next(iter(self._entries.items()))
+                if expires_at >= now and len(self._entries) <= self.max_entries:
+                    break
+                del self._entries[oldest_key]
+                if expires_at < now:
+                    self.expired += 1
+                else:
+                    self.evicted += 1
+
+    def delete(self, key: str):
+        with self._lock:
+            self._entries.pop(key, None)
+
+    def publish(self, channel: str, message: Any):
+        with self._lock:
+            subscribers = list(self._subscribers.get(channel, ()))
+        for loop, subscriber in subscribers:
+            loop.call_soon_threadsafe(subscriber.put_nowait, message)
+
+    async def subscribe(self, channel: str) -> AsyncGenerator[Any, None]:
+        entry = (asyncio.get_event_loop(), asyncio.Queue())
+        with self._lock:
+            self._subscribers.setdefault(channel, []).append(entry)
+        try:
+            while True:
+                yield await entry[1].get()
+        finally:
+            with self._lock:
+                subscribers = self._subscribers.get(channel, [])
+                subscribers.remove(entry)
+                if not subscribers:
+                    self._subscribers.pop(channel, None)
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            return {
+                "backend": "memory",
+                "entries": len(self._entries),
+                "max_entries": self.max_entries,
+                "ttl_seconds": self.ttl,
+                "evicted": self.evicted,
+                "expired": self.expired,
+                "channels": len(self._subscribers)
+            }
+
+
+class RedisError(Exception):
+    """Redis返回的错误回复"""
+
+
+def _encode_command(*args) -> bytes:
+    """按RESP协议编码一条命令"""
+    parts = [b"*%d\r\n" % len(args)]
+    for arg in args:
+        data = arg if isinstance(arg, bytes) else str(arg).encode("utf-8")
+        parts.append(b"$%d\r\n%s\r\n" % (len(data), data))
+    return b"".join(parts)
+
+
+def _parse_reply(line: bytes, read_line, read_exact):
+    """解析一条RESP回复，read_line / read_exact 负责从连接读取数据"""
+    kind, rest = line[:1], line[1:-2]
+    if kind == b"+":
+        return rest.decode("utf-8")
+    if kind == b"-":
+        raise RedisError(rest.decode("utf-8"))
+    if kind == b":":
+        return int(rest)
+    if kind == b"$":
+        length = int(rest)
+        return None if length < 0 else read_exact(length + 2)[:-2]
+    if kind == b"*":
+        count = int(rest)
+        return None if count < 0 else [_parse_reply(read_line(), read_line, read_exact) for _ in range(count)]
+    raise RedisError(f"无法解析的回复: {line[:50]!r}")
+
+
+async def _aparse_reply(reader: asyncio.StreamReader):
+    """_parse_reply 的异步版本"""
+    line = await reader.readline()
+    if not line:
+        raise ConnectionError("Redis连接已关闭")
+    kind, rest = line[:1], line[1:-2]
+    if kind == b"*":
+        count = int(rest)
+        return None if count < 0 else [await _aparse_reply(reader) for _ in range(count)]
+    if kind == b"$":
+        length = int(rest)
+        return None if length < 0 else (await reader.readexactly(length + 2))[:-2]
+    return _parse_reply(line, None, None)
+
+
+class _RedisConnection:
+    """同步RESP连接"""
+
+    def __init__(self, host: str, port: int, password: Optional[str], db: int, timeout: float):
+        self.sock = socket.create_connection((host, port), timeout=timeout)
+        self.file = self.sock.makefile("rb")
+        if password:
+            self.execute("AUTH", password)
+        if db:
+            self.execute("SELECT", db)
+
+    def _read_exact(self, size: int) -> bytes:
+        data = self.file.read(size)
+        if len(data) < size:
+            raise ConnectionError("Redis连接已关闭")
+        return data
+
+    def _read_line(self) -> bytes:
+        line = self.file.readline()
+        if not line:
+            raise ConnectionError("Redis连接已关闭")
+        return line
+
+    def execute(self, *args):
+        self.sock.sendall(_encode_command(*args))
+        return _parse_reply(self._read_line(), self._read_line, self._read_exact)
+
+    def close(self):
+        try:
+            self.file.close()
+            self.sock.close()
+        except OSError:
+            pass
+
+
+class RedisProgressStore(ProgressStore):
+    """
+    基于Redis协议（RESP）的存储，多个worker进程共享进度和任务状态。
+    只用到 GET/SET EX/DEL/PUBLISH/SUBSCRIBE，兼容Redis及其协议兼容实现；
+    连接按需创建并复用，出错的连接直接丢弃
+    """
+
+    def __init__(self, url: str, ttl: float = None, prefix: str = None, timeout: float = 5):
+        parsed = urlparse(url)
+        self.host = parsed.hostname or "localhost"
+        self.port = parsed.port or 6379
+        self.password = unquote(parsed.password) if parsed.password else None
+        self.db = int(parsed.path.lstrip("/") or 0)
+        self.ttl = ttl or float(os.getenv("PROGRESS_STORE_TTL", "3600"))
+        self.prefix = prefix if prefix is not None else os.getenv("PROGRESS_STORE_PREFIX", "gesp:")
+        self.timeout = timeout
+        self._idle: List[_RedisConnection] = []
+        self._lock = threading.Lock()
+        self.errors = 0
+
+    def _execute(self, *args):
+        with self._lock:
+            conn = self._idle.pop() if self._idle else None
+        if conn is None:
+            conn = _RedisConnection(self.host, self.port, self.password, self.db, self.timeout)
+        try:
+            result = conn.execute(*args)
+        except RedisError:
+            self._release(conn)
+            raise
+        except Exception:
+            self.errors += 1
+            conn.close()
+            raise
+        self._release(conn)
+        return result
+
+    def _release(self, conn: _RedisConnection):
+        with self._lock:
+            self._idle.append(conn)
+
+    def get(self, key: str) -> Optional[Any]:
+        value = self._execute("GET", self.prefix + key)
+        return None if value is None else json.loads(value)
+
+    def set(self, key: str, value: Any, ttl: float = None):
+        self._execute("SET", self.prefix + key, json.dumps(value, ensure_ascii=False), "EX", max(int(ttl or self.ttl), 1))
+
+    def delete(self, key: str):
+        self._execute("DEL", self.prefix + key)
+
+    def publish(self, channel: str, message: Any):
+        self._execute("PUBLISH", self.prefix + channel, json.dumps(message, ensure_ascii=False))
+
+    async def subscribe(self, channel: str) -> AsyncGenerator[Any, None]:
+        """每个订阅使用独立的异步连接，退订时关闭"""
+        reader, writer = await asyncio.open_connection(self.host, self.port)
+        try:
+            if self.password:
+                writer.write(_encode_command("AUTH", self.password))
+                await _aparse_reply(reader)
+            writer.write(_encode_command("SUBSCRIBE", self.prefix + channel))
+            await writer.drain()
+            while True:
+                reply = await _aparse_reply(reader)
+                if isinstance(reply, list) and len(reply) == 3 and reply[0] == b"message":
+                    yield json.loads(reply[2])
+        finally:
+            writer.close()
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            idle = len(self._idle)
+        return {
+            "backend": "redis",
+            "address": f"{self.host}:{self.port}/{self.db}",
+            "ttl_seconds": self.ttl,
+            "idle_connections": idle,
+            "errors": self.errors
+        }
+
+    def close(self):
+        with self._lock:
+            idle, self._idle = self._idle, []
+        for conn in idle:
+            conn.close()
+
+
+def create_progress_store(url: str = None) -> ProgressStore:
+    """
+    按 PROGRESS_STORE_URL 创建存储：memory://（默认，单进程）或 redis://[:密码@]主机:端口/库号（多worker共享）
+    """
+    url = url or os.getenv("PROGRESS_STORE_URL", "memory://")
+    scheme = urlparse(url).scheme
+    if scheme == "memory":
+        return MemoryProgressStore()
+    if scheme == "redis":
+        return RedisProgressStore(url)
+    raise ValueError(f"不支持的进度存储: {url}")
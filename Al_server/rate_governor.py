@@ -0,0 +1,289 @@
+import asyncio
+import os
+import random
+import threading
+import time
+from contextlib import asynccontextmanager, contextmanager
+from typing import Any, AsyncGenerator, Awaitable, Callable, Dict, Generator, Iterator, AsyncIterator, Optional
+from llm_scheduler import PriorityScheduler
+from tracing import record_span
+
+# 上游返回这些状态码时视为限流/过载，退避后重试
+RETRYABLE_STATUS = {429, 503}
+
+
+def _error_status(error: Exception) -> Optional[int]:
+    """从 requests / aiohttp 的异常中取出HTTP状态码"""
+    response = getattr(error, "response", None)
+    if response is not None and getattr(response, "status_code", None) is not None:
+        return response.status_code
+    return getattr(error, "status", None)
+
+
+def _retry_after(error: Exception) -> Optional[float]:
+    """读取 Retry-After 响应头（秒）"""
+    response = getattr(error, "response", None)
+    headers = getattr(response, "headers", None) or getattr(error, "headers", None)
+    if not headers:
+        return None
+    try:
+        return float(headers.get("Retry-After"))
+    except (TypeError, ValueError):
+        return None
+
+
+def estimate_request_tokens(payload: Dict[str, Any]) -> int:
+    """
+    粗略估算一次请求消耗的token数：输入按字符数计，输出按 max_tokens 计但设上限，
+    避免大 max_tokens 的流式请求把每分钟token配额一次占满
+    """
+    input_chars = sum(len(message.get("content", "")) for message in payload.get("messages", []))
+    output_estimate = min(payload.get("max_tokens") or 1000, 4000)
+    return input_chars + output_estimate
+
+
+class TokenBucket:
+    """按分钟配额匀速补充的令牌桶，允许透支，透支部分换算为需要等待的时间"""
+
+    def __init__(self, per_minute: float):
+        self.capacity = per_minute
+        self.rate = per_minute / 60.0
+        self.tokens = per_minute
+        self.updated = time.monotonic()
+
+    def reserve(self, amount: float, now: float) -> float:
+        """预占 amount 个令牌，返回需要等待的秒数（调用方需持有锁）"""
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        # 单个请求超过整桶容量时按整桶计，避免永远等不到
+        self.tokens -= min(amount, self.capacity)
+        return 0.0 if self.tokens >= 0 else -self.tokens / self.rate
+
+
+class RateGovernor:
+    """
+    进程级上游调用调速器，所有处理器共用：
+    - 请求数/分钟、token数/分钟两个令牌桶
+    - 最大并发请求数，空出的名额按优先级和调用方公平分配（见 PriorityScheduler）
+    - 遇到429/503时全局暂停并按指数退避（带抖动）重试
+    """
+
+    def __init__(self, rpm: float = None, tpm: float = None, max_in_flight: int = None,
+                 max_retries: int = None, backoff_base: float = None, backoff_max: float = None):
+        self.rpm = rpm or float(os.getenv("LLM_RPM", "600"))
+        self.tpm = tpm or float(os.getenv("LLM_TPM", "1000000"))
+        self.max_in_flight = max_in_flight or int(os.getenv("LLM_MAX_IN_FLIGHT", "16"))
+        self.max_retries = max_retries if max_retries is not None else int(os.getenv("MAX_RETRIES", "3"))
+        self.backoff_base = backoff_base or float(os.getenv("LLM_BACKOFF_BASE", "1"))
+        self.backoff_max = backoff_max or float(os.getenv("LLM_BACKOFF_MAX", "30"))
+
+        self._lock = threading.Lock()
+        self._request_bucket = TokenBucket(self.rpm)
+        self._token_bucket = TokenBucket(self.tpm)
+        self.scheduler = PriorityScheduler(self.max_in_flight)
+        self._paused_until = 0.0
+
+        # 统计
+        self.in_flight = 0
+        self.waiting = 0
+        self.requests = 0
+        self.throttled = 0
+        self.retries = 0
+        self.queue_delay_total = 0.0
+        self.queue_delay_max = 0.0
+
+    def _reserve(self, tokens: int) -> float:
+        """预占配额，返回需要等待的秒数"""
+        with self._lock:
+            now = time.monotonic()
+            delay = max(
+                self._request_bucket.reserve(1, now),
+                self._token_bucket.reserve(tokens, now),
+                self._paused_until - now
+            )
+        return max(delay, 0.0)
+
+    def _record_start(self, queue_delay: float, priority: str):
+        with self._lock:
+            self.waiting -= 1
+            self.in_flight += 1
+            self.requests += 1
+            self.queue_delay_total += queue_delay
+            self.queue_delay_max = max(self.queue_delay_max, queue_delay)
+        if queue_delay >= 0.001:
+            # 排队等待名额或配额的时间单独记为一个span，便于区分慢在排队还是慢在上游
+            end_ns = time.time_ns()
+            record_span("llm.wait_slot", end_ns - int(queue_delay * 1e9), end_ns, priority=priority)
+
+    def _record_end(self):
+        with self._lock:
+            self.in_flight -= 1
+
+    def _backoff(self, attempt: int, error: Exception) -> Optional[float]:
+        """
+        判断是否需要重试；需要时返回退避秒数，并让所有调用方一起暂停
+
+        Returns:
+            退避秒数；不可重试或已达重试上限时返回None
+        """
+        status = _error_status(error)
+        if status not in RETRYABLE_STATUS:
+            return None
+        with self._lock:
+            self.throttled += 1
+        if attempt >= self.max_retries:
+            return None
+
+        delay = _retry_after(error)
+        if delay is None:
+            # 指数退避 + 全抖动
+            delay = random.uniform(0, min(self.backoff_max, self.backoff_base * (2 ** attempt)))
+        with self._lock:
+            self.retries += 1
+            self._paused_until = max(self._paused_until, time.monotonic() + delay)
+        print(f"⏳ 上游返回 {status}，{delay:.1f} 秒后第 {attempt + 1} 次重试")
+        return delay
+
+    @contextmanager
+    def acquire(self, tokens: int) -> Generator[None, None, None]:
+        """同步占用一个并发名额和相应配额"""
+        started = time.monotonic()
+        with self._lock:
+            self.waiting += 1
+        priority = self.scheduler.acquire(tokens)
+        try:
+            delay = self._reserve(tokens)
+            if delay > 0:
+                time.sleep(delay)
+            self._record_start(time.monotonic() - started, priority)
+        except BaseException:
+            with self._lock:
+                self.waiting -= 1
+            self.scheduler.release(priority)
+            raise
+        try:
+            yield
+        finally:
+            self._record_end()
+            self.scheduler.release(priority)
+
+    @asynccontextmanager
+    async def aacquire(self, tokens: int) -> AsyncGenerator[None, None]:
+        """异步占用一个并发名额和相应配额，等待期间不阻塞事件循环"""
+        started = time.monotonic()
+        with self._lock:
+            self.waiting += 1
+        try:
+            # 并发名额与同步调用共用
+            priority = await self.scheduler.aacquire(tokens)
+        except BaseException:
+            with self._lock:
+                self.waiting -= 1
+            raise
+        try:
+            delay = self._reserve(tokens)
+            if delay > 0:
+                await asyncio.sleep(delay)
+            self._record_start(time.monotonic() - started, priority)
+        except BaseException:
+            with self._lock:
+                self.waiting -= 1
+            self.scheduler.release(priority)
+            raise
+        try:
+            yield
+        finally:
+            self._record_end()
+            self.scheduler.release(priority)
+
+    def call(self, fn: Callable[[], Any], tokens: int) -> Any:
+        """在调速器控制下执行同步调用，限流时退避重试"""
+        attempt = 0
+        while True:
+            try:
+                with self.acquire(tokens):
+                    return fn()
+            except Exception as e:
+                delay = self._backoff(attempt, e)
+                if delay is None:
+                    raise
+                time.sleep(delay)
+                attempt += 1
+
+    async def acall(self, fn: Callable[[], Awaitable[Any]], tokens: int) -> Any:
+        """在调速器控制下执行异步调用，限流时退避重试"""
+        attempt = 0
+        while True:
+            try:
+                async with self.aacquire(tokens):
+                    return await fn()
+            except Exception as e:
+                delay = self._backoff(attempt, e)
+                if delay is None:
+                    raise
+                await asyncio.sleep(delay)
+                attempt += 1
+
+    def stream(self, factory: Callable[[], Iterator[str]], tokens: int) -> Generator[str, None, None]:
+        """
+        在调速器控制下执行同步流式调用，整个流期间占用一个并发名额；
+        只有在收到第一块数据之前被限流才会重试
+        """
+        attempt = 0
+        while True:
+            received = False
+            try:
+                with self.acquire(tokens):
+                    source = factory()
+                    try:
+                        for chunk in source:
+                            received = True
+                            yield chunk
+                    finally:
+                        source.close()
+                return
+            except Exception as e:
+                delay = None if received else self._backoff(attempt, e)
+                if delay is None:
+                    raise
+                time.sleep(delay)
+                attempt += 1
+
+    async def astream(self, factory: Callable[[], AsyncIterator[str]], tokens: int) -> AsyncGenerator[str, None]:
+        """异步版本的 stream"""
+        attempt = 0
+        while True:
+            received = False
+            try:
+                async with self.aacquire(tokens):
+                    source = factory()
+                    try:
+                        async for chunk in source:
+                            received = True
+                            yield chunk
+                    finally:
+                        await source.aclose()
+                return
+            except Exception as e:
+                delay = None if received else self._backoff(attempt, e)
+                if delay is None:
+                    raise
+                await asyncio.sleep(delay)
+                attempt += 1
+
+    def stats(self) -> Dict[str, Any]:
+        """调速器统计：排队时延、限流次数、并发数等"""
+        with self._lock:
+            return {
+                "rpm_limit": self.rpm,
+                "tpm_limit": self.tpm,
+                "max_in_flight": self.max_in_flight,
+                "in_flight": self.in_flight,
+                "waiting": self.waiting,
+                "requests": self.requests,
+                "throttled": self.throttled,
+                "retries": self.retries,
+                "queue_delay_avg_ms": round(self.queue_delay_total / self.requests * 1000, 2) if self.requests else 0.0,
+                "queue_delay_max_ms": round(self.queue_delay_max * 1000, 2),
+                "scheduler": self.scheduler.stats()
+            }
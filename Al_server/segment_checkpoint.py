@@ -0,0 +1,146 @@
+import copy
+import os
+import threading
+from typing import Any, Dict, List, Optional
+from progress_store import ProgressStore
+
+# 片段状态
+SEGMENT_PENDING = "pending"
+SEGMENT_OK = "ok"
+SEGMENT_FAILED = "failed"
+
+
+def checkpoint_key(job_id: str) -> str:
+    """检查点的任务级信息（片段数、提取是否完成、全文等）"""
+    return f"job:{job_id}:segments"
+
+
+def segment_key(job_id: str, segment_index: int) -> str:
+    """单个片段的状态"""
+    return f"job:{job_id}:segments:{segment_index}"
+
+
+class SegmentCheckpoint:
+    """
+    提取任务的片段检查点：记录每个片段的内容、状态（pending/ok/failed）、尝试次数和解析出的题目，
+    每次状态变化后写回存储。每个片段单独一个键，状态变化只写回变化的片段，不重写整个检查点。
+    任务失败或部分片段失败时，恢复操作只需重新处理未成功的片段
+
+    检查点使用自己的过期时间（CHECKPOINT_TTL，默认比进度条目长），而各个键只在写入时续期：
+    早期写入的片段会先于后面的片段过期，恢复前需调用 refresh 给所有键续期
+    """
+
+    def __init__(self, store: ProgressStore, job_id: str, state: Dict[str, Any] = None, ttl: float = None):
+        self.store = store
+        self.job_id = job_id
+        self.ttl = ttl or float(os.getenv("CHECKPOINT_TTL", "86400"))
+        self._lock = threading.Lock()
+        state = state or {}
+        self.segments: List[Dict[str, Any]] = state.get("segments", [])
+        # 页面全部提取并切分完成后才为True，否则检查点缺少后面的片段
+        self.extraction_complete: bool = state.get("extraction_complete", False)
+        self.raw_content: str = state.get("raw_content", "")
+        self.expected_questions: Optional[int] = state.get("expected_questions")
+
+    @classmethod
+    def load(cls, store: ProgressStore, job_id: str, ttl: float = None) -> Optional["SegmentCheckpoint"]:
+        """
+        读取已有检查点，不存在或有片段已过期时返回None。
+        读到的状态深拷贝一份，进程内存储返回的是存储中的对象，不能和检查点共用
+        """
+        state = store.get(checkpoint_key(job_id))
+        if state is None:
+            return None
+        segments = []
+        for segment_index in range(state["segment_count"]):
+            segment = store.get(segment_key(job_id, segment_index))
+            if segment is None:
+                return None
+            segments.append(segment)
+        return cls(store, job_id, copy.deepcopy({**state, "segments": segments}), ttl)
+
+    def _save_info(self):
+        """写回任务级信息，调用方持有锁"""
+        self.store.set(checkpoint_key(self.job_id), {
+            "segment_count": len(self.segments),
+            "extraction_complete": self.extraction_complete,
+            "raw_content": self.raw_content,
+            "expected_questions": self.expected_questions
+        }, ttl=self.ttl)
+
+    def _save_segment(self, segment: Dict[str, Any]):
+        """写回单个片段（写入副本，之后的修改不影响存储中的值），调用方持有锁"""
+        self.store.set(segment_key(self.job_id, segment["segment_index"]), copy.deepcopy(segment), ttl=self.ttl)
+
+    def refresh(self):
+        """重写所有片段和任务级信息，整个检查点重新获得完整的过期时间（恢复任务开始时调用）"""
+        with self._lock:
+            for segment in self.segments:
+                self._save_segment(segment)
+            self._save_info()
+
+    def add_segment(self, segment_index: int, content: str):
+        with self._lock:
+            segment = {
+                "segment_index": segment_index,
+                "content": content,
+                "status": SEGMENT_PENDING,
+                "attempts": 0,
+                "questions": [],
+                "error": None
+            }
+            self.segments.append(segment)
+            # 先写片段再更新片段数，读到的片段数不会超过已写入的片段
+            self._save_segment(segment)
+            self._save_info()
+
+    def record_result(self, result: Dict[str, Any]):
+        """记录 process_segment 的结果"""
+        with self._lock:
+            segment = self.segments[result["segment_index"]]
+            segment["attempts"] += result.get("attempts", 1)
+            if result.get("success"):
+                segment["status"] = SEGMENT_OK
+                segment["questions"] = result["questions"]
+                segment["error"] = None
+            else:
+                segment["status"] = SEGMENT_FAILED
+                segment["error"] = result.get("error") or "解析失败"
+            self._save_segment(segment)
+
+    def complete_extraction(self, raw_content: str):
+        with self._lock:
+            self.extraction_complete = True
+            self.raw_content = raw_content
+            self._save_info()
+
+    def unfinished(self) -> List[Dict[str, Any]]:
+        """需要重新处理的片段：失败的，以及上次未完成的"""
+        with self._lock:
+            return [segment for segment in self.segments if segment["status"] != SEGMENT_OK]
+
+    def questions(self) -> List[Dict[str, Any]]:
+        """按片段顺序合并已成功片段的题目"""
+        with self._lock:
+            questions = []
+            for segment in self.segments:
+                if segment["status"] == SEGMENT_OK:
+                    questions.extend(segment["questions"])
+            return questions
+
+    def summary(self) -> Dict[str, Any]:
+        with self._lock:
+            counts = {SEGMENT_PENDING: 0, SEGMENT_OK: 0, SEGMENT_FAILED: 0}
+            for segment in self.segments:
+                counts[segment["status"]] += 1
+            return {
+                "segment_count": len(self.segments),
+                "segments_ok": counts[SEGMENT_OK],
+                "segments_failed": counts[SEGMENT_FAILED],
+                "segments_pending": counts[SEGMENT_PENDING],
+                "extraction_complete": self.extraction_complete,
+                "failed_segments": [
+                    {"segment_index": s["segment_index"], "attempts": s["attempts"], "error": s["error"]}
+                    for s in self.segments if s["status"] == SEGMENT_FAILED
+                ]
+            }
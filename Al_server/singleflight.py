@@ -0,0 +1,305 @@
+import asyncio
+import copy
+import threading
+from typing import Any, AsyncGenerator, AsyncIterator, Awaitable, Callable, Dict, Generator, Iterator
+
+
+class _Call:
+    """一次进行中的同步调用"""
+
+    def __init__(self):
+        self.event = threading.Event()
+        self.result = None
+        self.error = None
+
+
+class SingleFlight:
+    """
+    同步调用合并：相同key的并发调用只真正执行一次，结果分发给所有等待者
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._calls: Dict[str, _Call] = {}
+        self.executed = 0
+        self.shared = 0
+
+    def do(self, key: str, fn: Callable[[], Any]) -> Any:
+        """
+        执行或加入一次调用
+
+        Args:
+            key: 调用的唯一标识，相同key视为相同请求
+            fn: 实际执行的函数
+
+        Returns:
+            fn 的返回值（跟随者拿到的是深拷贝，互不影响）
+        """
+        with self._lock:
+            call = self._calls.get(key)
+            leader = call is None
+            if leader:
+                call = _Call()
+                self._calls[key] = call
+                self.executed += 1
+            else:
+                self.shared += 1
+
+        if not leader:
+            call.event.wait()
+            if call.error is not None:
+                raise call.error
+            return copy.deepcopy(call.result)
+
+        try:
+            call.result = fn()
+            return call.result
+        except BaseException as e:
+            call.error = e
+            raise
+        finally:
+            with self._lock:
+                del self._calls[key]
+            call.event.set()
+
+
+class AsyncSingleFlight:
+    """
+    异步调用合并：相同key的并发调用共享同一个任务。
+    某个等待者被取消不会影响其他等待者，所有等待者都离开后才取消上游任务
+    """
+
+    def __init__(self):
+        self._calls: Dict[str, list] = {}
+        self.executed = 0
+        self.shared = 0
+
+    async def do(self, key: str, fn: Callable[[], Awaitable[Any]]) -> Any:
+        entry = self._calls.get(key)
+        leader = entry is None
+        if leader:
+            task = asyncio.ensure_future(fn())
+            entry = [task, 0]
+            self._calls[key] = entry
+            self.executed += 1
+
+            def cleanup(_):
+                if self._calls.get(key) is entry:
+                    del self._calls[key]
+            task.add_done_callback(cleanup)
+        else:
+            self.shared += 1
+
+        task = entry[0]
+        entry[1] += 1
+        try:
+            result = await asyncio.shield(task)
+        except asyncio.CancelledError:
+            if not task.done() and entry[1] == 1:
+                task.cancel()
+            raise
+        finally:
+            entry[1] -= 1
+        return result if leader else copy.deepcopy(result)
+
+
+class _StreamBroadcast:
+    """
+    一路上游流的广播：不单独起线程，由订阅者在各自的线程里轮流拉取上游（同一时刻只有一个拉取者），
+    收到的块缓存下来，每个订阅者从头回放再继续接收新块。只有一个订阅者时就是在调用方线程里直接迭代上游；
+    所有订阅者离开后关闭上游
+    """
+
+    def __init__(self, source_factory: Callable[[], Iterator[str]], on_done: Callable[["_StreamBroadcast"], None]):
+        self.chunks = []
+        self.done = False
+        self.cancelled = False
+        self.error = None
+        self.subscribers = 0
+        self._cond = threading.Condition()
+        self._source_factory = source_factory
+        self._source = None
+        self._pulling = False
+        self._on_done = on_done
+
+    def _close(self):
+        if self._source is not None and hasattr(self._source, "close"):
+            self._source.close()
+        self._on_done(self)
+
+    def _pull(self):
+        """拉取上游的下一块，调用方已在锁内占用拉取权；上游在第一次拉取时才创建，沿用该订阅者的上下文"""
+        chunk = None
+        finished = True
+        try:
+            if self._source is None:
+                self._source = self._source_factory()
+            chunk = next(self._source)
+            finished = False
+        except StopIteration:
+            pass
+        except Exception as e:
+            self.error = e
+        finally:
+            with self._cond:
+                self._pulling = False
+                if finished:
+                    self.done = True
+                else:
+                    self.chunks.append(chunk)
+                self._cond.notify_all()
+            if finished:
+                self._close()
+
+    def subscribe(self) -> Generator[str, None, None]:
+        """订阅并回放数据，调用方需先在 subscribers 中登记"""
+        position = 0
+        try:
+            while True:
+                with self._cond:
+                    # 其他订阅者正在拉取时等它带回新块
+                    while position >= len(self.chunks) and not self.done and self._pulling:
+                        self._cond.wait()
+                    pull = position >= len(self.chunks) and not self.done
+                    if pull:
+                        self._pulling = True
+                    batch = self.chunks[position:]
+                    position = len(self.chunks)
+                    finished = self.done and not batch
+                if pull:
+                    self._pull()
+                    continue
+                if finished:
+                    if self.error is not None:
+                        raise self.error
+                    return
+                for chunk in batch:
+                    yield chunk
+        finally:
+            with self._cond:
+                self.subscribers -= 1
+                # 拉取只发生在订阅者自己的迭代中，无人订阅时不会有拉取进行中，可以直接关闭上游
+                abandoned = self.subscribers == 0 and not self.done
+                if abandoned:
+                    self.cancelled = True
+                    self.done = True
+                    self._cond.notify_all()
+            if abandoned:
+                self._close()
+
+
+class StreamGroup:
+    """同步流式调用合并，相同key的并发流共享一路上游连接"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._streams: Dict[str, _StreamBroadcast] = {}
+        self.executed = 0
+        self.shared = 0
+
+    def subscribe(self, key: str, source_factory: Callable[[], Iterator[str]]) -> Generator[str, None, None]:
+        with self._lock:
+            broadcast = self._streams.get(key)
+            if broadcast is not None:
+                # 在广播的锁内判断并登记，避免加入一个最后一个订阅者刚刚放弃的流
+                with broadcast._cond:
+                    if broadcast.cancelled:
+                        broadcast = None
+                    else:
+                        broadcast.subscribers += 1
+                        self.shared += 1
+            if broadcast is None:
+                def on_done(finished, key=key):
+                    with self._lock:
+                        if self._streams.get(key) is finished:
+                            del self._streams[key]
+                broadcast = _StreamBroadcast(source_factory, on_done)
+                broadcast.subscribers = 1
+                self._streams[key] = broadcast
+                self.executed += 1
+        yield from broadcast.subscribe()
+
+
+class _AsyncStreamBroadcast:
+    """异步版本的上游流广播"""
+
+    def __init__(self, source_factory: Callable[[], AsyncIterator[str]], on_done: Callable[["_AsyncStreamBroadcast"], None]):
+        self.chunks = []
+        self.done = False
+        self.cancelled = False
+        self.error = None
+        self.subscribers = 0
+        self._cond = asyncio.Condition()
+        self._source_factory = source_factory
+        self._on_done = on_done
+        self.task = asyncio.ensure_future(self._pump())
+
+    async def _pump(self):
+        source = self._source_factory()
+        try:
+            async for chunk in source:
+                async with self._cond:
+                    self.chunks.append(chunk)
+                    self._cond.notify_all()
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            self.error = e
+        finally:
+            await source.aclose()
+            self.done = True
+            self._on_done(self)
+            async with self._cond:
+                self._cond.notify_all()
+
+    async def subscribe(self) -> AsyncGenerator[str, None]:
+        self.subscribers += 1
+        position = 0
+        try:
+            while True:
+                async with self._cond:
+                    while position >= len(self.chunks) and not self.done:
+                        await self._cond.wait()
+                    batch = self.chunks[position:]
+                    position = len(self.chunks)
+                    finished = self.done and not batch
+                if finished:
+                    if self.error is not None:
+                        raise self.error
+                    return
+                for chunk in batch:
+                    yield chunk
+        finally:
+            self.subscribers -= 1
+            if self.subscribers == 0 and not self.done:
+                # 所有订阅者都已离开，立即取消上游
+                self.cancelled = True
+                self.task.cancel()
+
+
+class AsyncStreamGroup:
+    """异步流式调用合并"""
+
+    def __init__(self):
+        self._streams: Dict[str, _AsyncStreamBroadcast] = {}
+        self.executed = 0
+        self.shared = 0
+
+    async def subscribe(self, key: str, source_factory: Callable[[], AsyncIterator[str]]) -> AsyncGenerator[str, None]:
+        broadcast = self._streams.get(key)
+        if broadcast is None or broadcast.cancelled:
+            def on_done(finished, key=key):
+                if self._streams.get(key) is finished:
+                    del self._streams[key]
+            broadcast = _AsyncStreamBroadcast(source_factory, on_done)
+            self._streams[key] = broadcast
+            self.executed += 1
+        else:
+            self.shared += 1
+
+        stream = broadcast.subscribe()
+        try:
+            async for chunk in stream:
+                yield chunk
+        finally:
+            await stream.aclose()
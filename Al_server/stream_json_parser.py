@@ -0,0 +1,214 @@
+import json
+import re
+from typing import Any, AsyncIterable, AsyncGenerator, Dict, Generator, Iterable, List, Optional
+from metrics import PARSE_FAILURES
+
+QUESTION_SEPARATOR = "---QUESTION_SEPARATOR---"
+
+# 对象内部（字符串之外）需要关心的字符：括号、引号，以及可能是分隔符开头的 '-'
+_STRUCTURE_CHARS = re.compile(r'[{}\[\]"\-]')
+# 字符串内容（不含结束引号），遇到块末尾的单个转义符时停下
+_STRING_BODY = re.compile(r'[^"\\]*(?:\\.[^"\\]*)*', re.S)
+
+
+class StreamingJSONParser:
+    """
+    增量解析大模型流式输出的JSON对象序列
+
+    逐块喂入文本，跨块维护括号深度、字符串/转义状态和分隔符的部分匹配，
+    每个顶层对象的右括号一到就立即产出，已扫描过的文本不会被重复扫描，总耗时与输出长度成线性。
+    对象之间的分隔符、代码块标记等其他文字被忽略；对象内部（字符串之外）出现分隔符说明该对象残缺，
+    丢弃后从分隔符之后重新同步
+    """
+
+    def __init__(self, separator: str = QUESTION_SEPARATOR):
+        self.separator = separator
+        # 当前未闭合对象已收到的文本片段，对象闭合时才拼接
+        self._parts: List[str] = []
+        self._stack: List[str] = []
+        self._in_string = False
+        # 上一块以转义符结尾
+        self._escape = False
+        # 上一块末尾已匹配的分隔符前缀长度
+        self._separator_matched = 0
+        # 流结束时仍未闭合的对象文本，说明输出被截断
+        self.partial: Optional[str] = None
+        self.errors = 0
+
+    def _resync(self, preview: str):
+        """对象尚未闭合就遇到分隔符，丢弃残缺对象并重新同步"""
+        print(f"JSON解析错误: 对象未闭合即遇到分隔符，已跳过")
+        print(f"问题JSON: {preview[:200]}...")
+        self.errors += 1
+        PARSE_FAILURES.labels("stream_json").inc()
+        self._parts = []
+        self._stack = []
+
+    def feed(self, chunk: str) -> List[Dict[str, Any]]:
+        """
+        喂入一块文本，每块只扫描一次
+
+        Returns:
+            List[Dict]: 本块中闭合的完整对象
+        """
+        found = []
+        separator = self.separator
+        stack = self._stack
+        in_string = self._in_string
+        end = len(chunk)
+        pos = 0
+        # 当前对象在本块中的起始位置，不在对象中时为None
+        segment_start = 0 if stack else None
+
+        if self._separator_matched:
+            rest = separator[self._separator_matched:]
+            piece = chunk[:len(rest)]
+            if rest.startswith(piece):
+                if len(piece) < len(rest):
+                    self._separator_matched += len(piece)
+                    self._parts.append(chunk)
+                    return found
+                self._resync("".join(self._parts))
+                stack = self._stack
+                segment_start = None
+                pos = len(piece)
+            # 不是分隔符时，已匹配的字符只是普通文本
+            self._separator_matched = 0
+
+        if self._escape:
+            self._escape = False
+            pos += 1
+
+        while pos < end:
+            if in_string:
+                # 一次跳过整段字符串内容，停在结束引号或块末尾
+                pos = _STRING_BODY.match(chunk, pos).end()
+                if pos >= end:
+                    break
+                if chunk[pos] == "\\":
+                    # 转义符在块末尾，下一块的第一个字符属于转义
+                    self._escape = True
+                    break
+                in_string = False
+                pos += 1
+                continue
+
+            if segment_start is None:
+                start = chunk.find("{", pos)
+                if start == -1:
+                    # 对象之间的分隔符和其他文字直接丢弃
+                    break
+                segment_start = start
+                stack.append("{")
+                pos = start + 1
+                continue
+
+            match = _STRUCTURE_CHARS.search(chunk, pos)
+            if match is None:
+                break
+            char = match.group()
+            pos = match.end()
+
+            if char == '"':
+                in_string = True
+            elif char == "{" or char == "[":
+                stack.append(char)
+            elif char == "}" or char == "]":
+                stack.pop()
+                if not stack:
+                    object_text = chunk[segment_start:pos]
+                    if self._parts:
+                        self._parts.append(object_text)
+                        object_text = "".join(self._parts)
+                        self._parts = []
+                    obj = self._decode(object_text)
+                    if obj is not None:
+                        found.append(obj)
+                    segment_start = None
+            elif chunk.startswith(separator, match.start()):
+                self._resync("".join(self._parts) + chunk[segment_start:match.start()])
+                stack = self._stack
+                segment_start = None
+                pos = match.start() + len(separator)
+            elif separator.startswith(chunk[match.start():]):
+                # 块末尾可能是被切断的分隔符，留到下一块继续匹配
+                self._separator_matched = end - match.start()
+                break
+
+        self._in_string = in_string
+        if segment_start is not None:
+            self._parts.append(chunk[segment_start:])
+        return found
+
+    def _decode(self, object_text: str) -> Optional[Dict[str, Any]]:
+        try:
+            return json.loads(object_text)
+        except json.JSONDecodeError as e:
+            print(f"JSON解析错误: {e}")
+            print(f"问题JSON: {object_text[:200]}...")
+            self.errors += 1
+            PARSE_FAILURES.labels("stream_json").inc()
+            return None
+
+    def finish(self) -> List[Dict[str, Any]]:
+        """
+        流结束时调用，尝试一次性补全最后一个未闭合的对象
+
+        只有在所有字段值都已完整输出、仅缺少收尾括号时才能补全；
+        补全失败的残缺文本保存在 partial 中
+
+        Returns:
+            List[Dict]: 补全成功的对象
+        """
+        if not self._stack:
+            return []
+
+        object_text = "".join(self._parts).rstrip()
+        stack = self._stack
+        in_string = self._in_string
+        self._parts, self._stack = [], []
+        self._in_string = self._escape = False
+        self._separator_matched = 0
+
+        if not in_string and object_text[-1] not in ",:":
+            closers = "".join("}" if opener == "{" else "]" for opener in reversed(stack))
+            try:
+                return [json.loads(object_text + closers)]
+            except json.JSONDecodeError:
+                pass
+
+        self.partial = object_text
+        return []
+
+
+def parse_json_stream(chunks: Iterable[str], parser: StreamingJSONParser = None) -> Generator[Dict[str, Any], None, None]:
+    """
+    从文本块迭代器中逐个产出完整的JSON对象
+
+    Args:
+        chunks: 流式文本块
+        parser: 可传入解析器以便结束后查看 partial 等状态
+    """
+    parser = parser or StreamingJSONParser()
+    try:
+        for chunk in chunks:
+            yield from parser.feed(chunk)
+        yield from parser.finish()
+    finally:
+        # 提前停止消费时关闭上游流
+        if hasattr(chunks, "close"):
+            chunks.close()
+
+
+async def aparse_json_stream(chunks: AsyncIterable[str], parser: StreamingJSONParser = None) -> AsyncGenerator[Dict[str, Any], None]:
+    """parse_json_stream 的异步版本"""
+    parser = parser or StreamingJSONParser()
+    try:
+        async for chunk in chunks:
+            for obj in parser.feed(chunk):
+                yield obj
+        for obj in parser.finish():
+            yield obj
+    finally:
+        if hasattr(chunks, "aclose"):
+            await chunks.aclose()
@@ -0,0 +1,14 @@
+import os
+import sys
+import tempfile
+
+# 测试从 Al_server 目录导入模块；缓存写到临时目录，不连接Redis、不导出span
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+_cache_dir = tempfile.mkdtemp(prefix="gesp-test-cache-")
+for name, filename in (("PDF_CACHE_PATH", "pdf_pages.sqlite3"), ("SEGMENT_CACHE_PATH", "segments.sqlite3"),
+                       ("EXPLANATION_CACHE_PATH", "explanations.sqlite3")):
+    os.environ.setdefault(name, os.path.join(_cache_dir, filename))
+os.environ["PROGRESS_STORE_URL"] = "memory://"
+os.environ.setdefault("TRACE_EXPORTER", "none")
+os.environ.setdefault("DASHSCOPE_API_KEY", "test-key")
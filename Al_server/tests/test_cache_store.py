@@ -0,0 +1,138 @@
+import asyncio
+import random
+import threading
+import zlib
+
+import pytest
+
+import cache_store
+from cache_store import SQLiteCache
+
+
+class FakeClock:
+    def __init__(self, now: float = 1000.0):
+        self.now = now
+
+    def __call__(self) -> float:
+        return self.now
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = FakeClock()
+    monkeypatch.setattr(cache_store.time, "time", clock)
+    return clock
+
+
+def blob_size(value: str) -> int:
+    return len(zlib.compress(value.encode("utf-8")))
+
+
+def noise(seed: int, length: int = 2000) -> str:
+    """不可压缩的内容，条目大小可预估"""
+    rng = random.Random(seed)
+    return "".join(rng.choice("abcdefghijklmnopqrstuvwxyz0123456789") for _ in range(length))
+
+
+def test_round_trip_and_stats(tmp_path):
+    cache = SQLiteCache(str(tmp_path / "c.sqlite3"), max_bytes=1 << 20, name="t")
+    cache.set_many({"a": "第一题", "b": "第二题"})
+    assert cache.get("a") == "第一题"
+    assert cache.get_many(["a", "b", "missing"]) == {"a": "第一题", "b": "第二题"}
+    assert cache.get("missing") is None
+    stats = cache.stats()
+    assert (stats["hits"], stats["misses"], stats["entries"]) == (3, 2, 2)
+    cache.close()
+
+
+def test_expired_entries_are_missed_and_deleted(tmp_path, clock):
+    cache = SQLiteCache(str(tmp_path / "c.sqlite3"), max_bytes=1 << 20, ttl_seconds=60)
+    cache.set("old", "v1")
+    clock.now += 30
+    cache.set("new", "v2")
+    # 读取不会延长TTL，过期时间按写入时间计算
+    assert cache.get("old") == "v1"
+
+    clock.now += 31
+    assert cache.get("old") is None
+    assert cache.get("new") == "v2"
+    assert cache.stats()["entries"] == 1
+    cache.close()
+
+
+def test_no_ttl_never_expires(tmp_path, clock):
+    cache = SQLiteCache(str(tmp_path / "c.sqlite3"), max_bytes=1 << 20)
+    cache.set("k", "v")
+    clock.now += 10 ** 9
+    assert cache.get("k") == "v"
+    cache.close()
+
+
+def test_evicts_least_recently_accessed(tmp_path, clock):
+    values = {key: noise(seed) for seed, key in enumerate("abcd")}
+    entry = max(blob_size(value) for value in values.values())
+    # 最多容纳三个条目
+    cache = SQLiteCache(str(tmp_path / "c.sqlite3"), max_bytes=entry * 3 + 10)
+    for key in "abc":
+        cache.set(key, values[key])
+        clock.now += 1
+    # 读取 a 后 b 成为最久未访问的条目
+    assert cache.get("a") == values["a"]
+    clock.now += 1
+
+    cache.set("d", values["d"])
+
+    assert cache.get("b") is None
+    assert cache.get_many("acd") == {key: values[key] for key in "acd"}
+    assert cache.stats()["size_bytes"] <= cache.max_bytes
+    cache.close()
+
+
+def test_persists_across_instances(tmp_path):
+    path = str(tmp_path / "c.sqlite3")
+    cache = SQLiteCache(path, max_bytes=1 << 20)
+    cache.set("k", "持久化")
+    cache.close()
+    reopened = SQLiteCache(path, max_bytes=1 << 20)
+    assert reopened.get("k") == "持久化"
+    reopened.close()
+
+
+class ThreadRecordingConnection:
+    """记录SQLite语句在哪个线程执行（sqlite3.Connection 的方法不能直接替换）"""
+
+    def __init__(self, conn):
+        self.conn = conn
+        self.threads = []
+
+    def execute(self, *args):
+        self.threads.append(threading.current_thread())
+        return self.conn.execute(*args)
+
+    def executemany(self, *args):
+        self.threads.append(threading.current_thread())
+        return self.conn.executemany(*args)
+
+    def close(self):
+        self.conn.close()
+
+
+def test_async_methods_run_off_the_event_loop(tmp_path):
+    cache = SQLiteCache(str(tmp_path / "c.sqlite3"), max_bytes=1 << 20)
+    cache._conn = conn = ThreadRecordingConnection(cache._conn)
+
+    async def scenario():
+        await cache.aset("a", "第一题")
+        await cache.aset_many({"b": "第二题"})
+        return await cache.aget("a"), await cache.aget_many(["a", "b", "missing"]), await cache.astats()
+
+    loop = asyncio.new_event_loop()
+    try:
+        single, many, stats = loop.run_until_complete(scenario())
+    finally:
+        loop.close()
+        cache.close()
+    assert single == "第一题"
+    assert many == {"a": "第一题", "b": "第二题"}
+    assert stats["entries"] == 2
+    assert conn.threads and threading.main_thread() not in conn.threads
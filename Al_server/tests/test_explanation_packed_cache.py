@@ -0,0 +1,115 @@
+import asyncio
+import json
+import threading
+
+import pytest
+
+pytest.importorskip("requests")
+
+from cache_store import SQLiteCache
+from explanation_processor import ExplanationProcessor
+
+
+def make_question(number: int):
+    return {"question_text": f"第{number}题：下面程序输出什么？", "question_type": "text", "correct_answer": "A",
+            "options": [{"label": "A", "text": str(number)}, {"label": "B", "text": "0"}]}
+
+
+@pytest.fixture
+def processor(tmp_path):
+    processor = ExplanationProcessor(client=object(), cache=SQLiteCache(str(tmp_path / "e.sqlite3"), max_bytes=1 << 20))
+    calls = {"packed": 0, "single": []}
+
+    def packed(questions):
+        calls["packed"] += 1
+        return json.dumps([{"index": i, "explanation": f"打包解析{i}"} for i in range(1, len(questions) + 1)],
+                          ensure_ascii=False)
+
+    def single(prompt):
+        calls["single"].append(prompt)
+        return "单题解析"
+
+    async def apacked(questions):
+        return packed(questions)
+
+    async def asingle(prompt, deadline=None):
+        return single(prompt)
+
+    processor.call_packed_api = packed
+    processor.call_api = single
+    processor.acall_packed_api = apacked
+    processor.acall_api = asingle
+    processor.calls = calls
+    yield processor
+    processor.cache.close()
+
+
+def test_packed_output_is_not_served_to_single_requests(processor):
+    questions = [make_question(1), make_question(2)]
+    results = processor.generate_batch_explanations(questions, packed=True)
+    assert [r["explanation"] for r in results] == ["打包解析1", "打包解析2"]
+
+    # 单题请求不会拿到打包模式的输出
+    single = processor.generate_explanation(questions[0])
+    assert single["explanation"] == "单题解析"
+    assert single["cache_hit"] is False
+
+
+def test_same_pack_is_served_from_packed_cache(processor):
+    questions = [make_question(1), make_question(2)]
+    processor.generate_batch_explanations(questions, packed=True)
+    again = processor.generate_batch_explanations(questions, packed=True)
+
+    assert processor.calls["packed"] == 1
+    assert [r["explanation"] for r in again] == ["打包解析1", "打包解析2"]
+    assert all(r["cache_hit"] for r in again)
+
+    processor.generate_batch_explanations(questions, packed=True, force_refresh=True)
+    assert processor.calls["packed"] == 2
+
+
+def test_packed_batch_reuses_single_question_cache(processor):
+    questions = [make_question(1), make_question(2), make_question(3)]
+    processor.generate_explanation(questions[1])
+
+    results = processor.generate_batch_explanations(questions, packed=True)
+
+    assert results[1]["explanation"] == "单题解析" and results[1]["cache_hit"]
+    assert [results[0]["explanation"], results[2]["explanation"]] == ["打包解析1", "打包解析2"]
+
+
+def test_async_packed_output_is_not_served_to_single_requests(processor):
+    questions = [make_question(1), make_question(2)]
+    loop = asyncio.new_event_loop()
+    try:
+        results = loop.run_until_complete(processor.agenerate_batch_explanations(questions, packed=True))
+        single = loop.run_until_complete(processor.agenerate_explanation(questions[0]))
+    finally:
+        loop.close()
+    assert [r["explanation"] for r in results] == ["打包解析1", "打包解析2"]
+    assert single["explanation"] == "单题解析"
+
+
+def test_async_paths_do_not_touch_sqlite_on_the_event_loop(processor, monkeypatch):
+    threads = []
+    for name in ("get_many", "set_many"):
+        original = getattr(processor.cache, name)
+
+        def record(*args, _original=original):
+            threads.append(threading.current_thread())
+            return _original(*args)
+        monkeypatch.setattr(processor.cache, name, record)
+
+    async def consume_stream(question):
+        return [event async for event in processor.astream_explanation(question)]
+
+    questions = [make_question(1), make_question(2)]
+    loop = asyncio.new_event_loop()
+    try:
+        loop.run_until_complete(processor.agenerate_batch_explanations(questions, packed=True))
+        loop.run_until_complete(processor.agenerate_batch_explanations(questions, packed=True))
+        loop.run_until_complete(processor.agenerate_explanation(make_question(3)))
+        loop.run_until_complete(consume_stream(make_question(3)))
+    finally:
+        loop.close()
+    assert threads and threading.main_thread() not in threads
@@ -0,0 +1,135 @@
+import asyncio
+
+import pytest
+
+from hedging import LatencyTracker, hedged_call
+
+
+@pytest.fixture
+def loop():
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    yield loop
+    loop.close()
+    asyncio.set_event_loop(None)
+
+
+class Upstream:
+    """可控耗时的假上游，记录开始、完成和被取消的调用"""
+
+    def __init__(self, delay: float, result: str = None, error: Exception = None):
+        self.delay = delay
+        self.result = result
+        self.error = error
+        self.started = 0
+        self.cancelled = 0
+
+    async def __call__(self, remaining: float):
+        self.started += 1
+        try:
+            await asyncio.sleep(self.delay)
+        except asyncio.CancelledError:
+            self.cancelled += 1
+            raise
+        if self.error is not None:
+            raise self.error
+        return self.result
+
+
+def test_threshold_uses_default_until_enough_samples():
+    tracker = LatencyTracker(default_threshold=1.5, min_samples=5, max_hedge_ratio=1)
+    for _ in range(4):
+        tracker.record(0.1)
+    assert tracker.threshold() == 1.5
+    tracker.record(0.1)
+    assert tracker.threshold() == 0.1
+
+
+def test_threshold_is_p95_of_recent_samples():
+    tracker = LatencyTracker(window=100, min_samples=20, max_hedge_ratio=1)
+    for ms in range(1, 101):
+        tracker.record(ms / 1000)
+    assert tracker.threshold() == pytest.approx(0.096)
+    # 窗口只保留最近的样本
+    for _ in range(100):
+        tracker.record(0.01)
+    assert tracker.threshold() == pytest.approx(0.01)
+
+
+def test_hedge_ratio_is_capped():
+    tracker = LatencyTracker(max_hedge_ratio=0.1)
+    for _ in range(20):
+        tracker.record_call()
+    allowed = sum(tracker.allow_hedge() for _ in range(5))
+    assert allowed == 2
+    assert tracker.stats()["hedged"] == 2
+
+
+def test_fast_call_is_not_hedged(loop):
+    tracker = LatencyTracker(default_threshold=0.2, max_hedge_ratio=1)
+    primary, hedge = Upstream(0.01, "primary"), Upstream(0.01, "hedge")
+
+    result = loop.run_until_complete(hedged_call(primary, hedge, tracker, loop.time() + 1))
+
+    assert result == "primary"
+    assert hedge.started == 0
+    assert tracker.stats()["calls"] == 1 and tracker.stats()["hedged"] == 0
+
+
+def test_slow_primary_is_hedged_and_loser_cancelled(loop):
+    tracker = LatencyTracker(default_threshold=0.05, max_hedge_ratio=1)
+    primary, hedge = Upstream(1, "primary"), Upstream(0.01, "hedge")
+
+    async def scenario():
+        started = loop.time()
+        result = await hedged_call(primary, hedge, tracker, started + 2)
+        elapsed = loop.time() - started
+        await asyncio.sleep(0)
+        return result, elapsed
+
+    result, elapsed = loop.run_until_complete(scenario())
+    assert result == "hedge"
+    # 对冲请求在阈值之后才发出
+    assert 0.05 <= elapsed < 0.5
+    assert primary.cancelled == 1
+    assert tracker.stats()["hedge_wins"] == 1
+    # 胜者和被取消的输家都记入耗时样本
+    assert len(tracker._samples) == 2
+
+
+def test_hedge_not_sent_when_ratio_exhausted(loop):
+    tracker = LatencyTracker(default_threshold=0.02, max_hedge_ratio=0)
+    primary, hedge = Upstream(0.1, "primary"), Upstream(0.01, "hedge")
+    assert loop.run_until_complete(hedged_call(primary, hedge, tracker, loop.time() + 1)) == "primary"
+    assert hedge.started == 0
+
+
+def test_failed_primary_falls_back_to_hedge(loop):
+    tracker = LatencyTracker(default_threshold=0.02, max_hedge_ratio=1)
+    primary = Upstream(0.05, error=RuntimeError("primary failed"))
+    hedge = Upstream(0.1, "hedge")
+    assert loop.run_until_complete(hedged_call(primary, hedge, tracker, loop.time() + 1)) == "hedge"
+
+
+def test_both_failing_raises_last_error(loop):
+    tracker = LatencyTracker(default_threshold=0.01, max_hedge_ratio=1)
+    primary = Upstream(0.02, error=RuntimeError("primary"))
+    hedge = Upstream(0.05, error=RuntimeError("hedge"))
+    with pytest.raises(RuntimeError, match="hedge"):
+        loop.run_until_complete(hedged_call(primary, hedge, tracker, loop.time() + 1))
+
+
+def test_deadline_cancels_pending_calls(loop):
+    tracker = LatencyTracker(default_threshold=0.02, max_hedge_ratio=1)
+    primary, hedge = Upstream(5, "primary"), Upstream(5, "hedge")
+
+    async def scenario():
+        with pytest.raises(asyncio.TimeoutError):
+            await hedged_call(primary, hedge, tracker, loop.time() + 0.1)
+        await asyncio.sleep(0)
+
+    loop.run_until_complete(scenario())
+    assert (primary.cancelled, hedge.cancelled) == (1, 1)
+    # 到截止时间被取消的调用也记入样本，作为耗时下界
+    assert len(tracker._samples) == 2
+    assert min(tracker._samples) >= 0.05
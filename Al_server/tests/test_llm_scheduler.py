@@ -0,0 +1,173 @@
+import asyncio
+
+import pytest
+
+import llm_scheduler
+from llm_scheduler import PRIORITY_BULK, PRIORITY_INTERACTIVE, PRIORITY_STREAMING, PriorityScheduler, llm_priority
+
+
+class FakeTime:
+    """替换模块中的 time，只影响调度器的等待时间计算，不影响事件循环"""
+
+    def __init__(self):
+        self.now = 1000.0
+
+    def monotonic(self) -> float:
+        return self.now
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = FakeTime()
+    monkeypatch.setattr(llm_scheduler, "time", clock)
+    return clock
+
+
+@pytest.fixture
+def loop():
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    yield loop
+    loop.close()
+    asyncio.set_event_loop(None)
+
+
+class Harness:
+    """在指定优先级和调用方下排队，按获得名额的顺序记录"""
+
+    def __init__(self, scheduler: PriorityScheduler):
+        self.scheduler = scheduler
+        self.granted = []
+        self.tasks = []
+
+    async def enqueue(self, name: str, priority: str, caller: str = None, tokens: int = 1):
+        async def wait():
+            with llm_priority(priority, caller):
+                granted_priority = await self.scheduler.aacquire(tokens)
+            self.granted.append(name)
+            return granted_priority
+
+        self.tasks.append(asyncio.ensure_future(wait()))
+        await settle()
+
+    async def release_all(self, holding: str):
+        """归还占着的名额，之后每个获得名额的请求完成后立即归还"""
+        released = set()
+        self.scheduler.release(holding)
+        for _ in range(len(self.tasks) * 10):
+            await settle()
+            for task in self.tasks:
+                if task.done() and task not in released:
+                    released.add(task)
+                    self.scheduler.release(task.result())
+            if len(released) == len(self.tasks):
+                break
+        return self.granted
+
+    async def cancel_waiting(self):
+        for task in self.tasks:
+            task.cancel()
+        await asyncio.gather(*self.tasks, return_exceptions=True)
+
+
+async def settle():
+    for _ in range(5):
+        await asyncio.sleep(0)
+
+
+def test_higher_class_goes_first(loop, clock):
+    scheduler = PriorityScheduler(max_slots=1, reserved_interactive=0, aging=5, weights={})
+
+    async def scenario():
+        harness = Harness(scheduler)
+        holding = await scheduler.aacquire()
+        await harness.enqueue("bulk", PRIORITY_BULK)
+        await harness.enqueue("streaming", PRIORITY_STREAMING)
+        await harness.enqueue("interactive", PRIORITY_INTERACTIVE)
+        return await harness.release_all(holding)
+
+    assert loop.run_until_complete(scenario()) == ["interactive", "streaming", "bulk"]
+
+
+@pytest.mark.parametrize("waited, first", [(4, "interactive"), (9, "interactive"), (11, "bulk")])
+def test_waiting_bulk_request_is_promoted(loop, clock, waited, first):
+    scheduler = PriorityScheduler(max_slots=1, reserved_interactive=0, aging=5, weights={})
+
+    async def scenario():
+        harness = Harness(scheduler)
+        holding = await scheduler.aacquire()
+        await harness.enqueue("bulk", PRIORITY_BULK, "backfill")
+        # 每等待 aging 秒提升一级：9秒时仍低一级；11秒时与 interactive 同级，先到的 bulk 先获得名额
+        clock.now += waited
+        await harness.enqueue("interactive", PRIORITY_INTERACTIVE, "editor")
+        return await harness.release_all(holding)
+
+    order = loop.run_until_complete(scenario())
+    assert order[0] == first
+    assert scheduler.stats()["aged_promotions"] == (1 if first == "bulk" else 0)
+
+
+def test_callers_share_a_class_fairly(loop, clock):
+    scheduler = PriorityScheduler(max_slots=1, reserved_interactive=0, aging=60, weights={})
+
+    async def scenario():
+        harness = Harness(scheduler)
+        holding = await scheduler.aacquire()
+        for number in range(4):
+            await harness.enqueue(f"a{number}", PRIORITY_BULK, "a", tokens=100)
+        await harness.enqueue("b0", PRIORITY_BULK, "b", tokens=100)
+        return await harness.release_all(holding)
+
+    # b 后到，但不用排在 a 的整批请求之后
+    assert loop.run_until_complete(scenario()) == ["a0", "b0", "a1", "a2", "a3"]
+
+
+def test_caller_weights_split_grants(loop, clock):
+    scheduler = PriorityScheduler(max_slots=1, reserved_interactive=0, aging=60, weights={"editor": 3})
+
+    async def scenario():
+        harness = Harness(scheduler)
+        holding = await scheduler.aacquire()
+        for number in range(6):
+            await harness.enqueue(f"backfill{number}", PRIORITY_BULK, "backfill", tokens=100)
+            await harness.enqueue(f"editor{number}", PRIORITY_BULK, "editor", tokens=100)
+        return await harness.release_all(holding)
+
+    order = loop.run_until_complete(scenario())
+    # 权重3的调用方在前4个名额中拿到3个
+    assert sum(name.startswith("editor") for name in order[:4]) == 3
+
+
+def test_reserved_slots_only_serve_interactive(loop, clock):
+    scheduler = PriorityScheduler(max_slots=3, reserved_interactive=1, aging=60, weights={})
+
+    async def scenario():
+        harness = Harness(scheduler)
+        with llm_priority(PRIORITY_BULK):
+            await scheduler.aacquire()
+            await scheduler.aacquire()
+        await harness.enqueue("bulk", PRIORITY_BULK)
+        await harness.enqueue("interactive", PRIORITY_INTERACTIVE)
+        granted = list(harness.granted)
+        waiting = scheduler.stats()["classes"][PRIORITY_BULK]["waiting"]
+        await harness.cancel_waiting()
+        return granted, waiting
+
+    assert loop.run_until_complete(scenario()) == (["interactive"], 1)
+
+
+def test_cancelled_waiter_leaves_the_queue(loop, clock):
+    scheduler = PriorityScheduler(max_slots=1, reserved_interactive=0, aging=60, weights={})
+
+    async def scenario():
+        harness = Harness(scheduler)
+        holding = await scheduler.aacquire()
+        await harness.enqueue("cancelled", PRIORITY_INTERACTIVE)
+        await harness.enqueue("bulk", PRIORITY_BULK)
+        harness.tasks[0].cancel()
+        await settle()
+        harness.tasks.pop(0)
+        return await harness.release_all(holding)
+
+    assert loop.run_until_complete(scenario()) == ["bulk"]
+    assert scheduler.in_flight == 0
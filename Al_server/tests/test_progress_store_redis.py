@@ -0,0 +1,210 @@
+import asyncio
+import socketserver
+import threading
+import time
+
+import pytest
+
+from job_queue import JobQueue
+from progress_store import RedisProgressStore
+
+
+def _bulk(value: bytes) -> bytes:
+    return b"$%d\r\n%s\r\n" % (len(value), value)
+
+
+def _array(*items: bytes) -> bytes:
+    return b"*%d\r\n" % len(items) + b"".join(_bulk(item) for item in items)
+
+
+class _RespHandler(socketserver.StreamRequestHandler):
+    """只实现存储用到的命令：AUTH/SELECT/GET/SET/DEL/PUBLISH/SUBSCRIBE"""
+
+    def _write(self, data: bytes):
+        with self.write_lock:
+            self.wfile.write(data)
+            self.wfile.flush()
+
+    def _read_command(self):
+        line = self.rfile.readline()
+        if not line:
+            return None
+        args = []
+        for _ in range(int(line[1:-2])):
+            length = int(self.rfile.readline()[1:-2])
+            args.append(self.rfile.read(length + 2)[:-2])
+        return args
+
+    def handle(self):
+        server = self.server
+        self.write_lock = threading.Lock()
+        channels = []
+        try:
+            while True:
+                args = self._read_command()
+                if args is None:
+                    return
+                command = args[0].upper()
+                if command == b"GET":
+                    time.sleep(server.get_delay)
+                    with server.lock:
+                        value = server.data.get(args[1])
+                    self._write(b"$-1\r\n" if value is None else _bulk(value))
+                elif command == b"SET":
+                    with server.lock:
+                        server.data[args[1]] = args[2]
+                        server.ttls[args[1]] = int(args[4]) if len(args) > 4 else None
+                    self._write(b"+OK\r\n")
+                elif command == b"DEL":
+                    with server.lock:
+                        removed = server.data.pop(args[1], None) is not None
+                    self._write(b":%d\r\n" % removed)
+                elif command == b"PUBLISH":
+                    with server.lock:
+                        subscribers = list(server.channels.get(args[1], ()))
+                    for subscriber in subscribers:
+                        try:
+                            subscriber._write(_array(b"message", args[1], args[2]))
+                        except (OSError, ValueError):
+                            # 订阅者收到消息后可能已断开，与Redis一样忽略
+                            pass
+                    self._write(b":%d\r\n" % len(subscribers))
+                elif command == b"SUBSCRIBE":
+                    with server.lock:
+                        server.channels.setdefault(args[1], []).append(self)
+                    channels.append(args[1])
+                    self._write(b"*3\r\n" + _bulk(b"subscribe") + _bulk(args[1]) + b":%d\r\n" % len(channels))
+                else:
+                    self._write(b"+OK\r\n")
+        finally:
+            with server.lock:
+                for channel in channels:
+                    server.channels[channel].remove(self)
+
+
+class RespStubServer(socketserver.ThreadingTCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self):
+        super().__init__(("127.0.0.1", 0), _RespHandler)
+        self.lock = threading.Lock()
+        self.data = {}
+        self.ttls = {}
+        self.channels = {}
+        self.get_delay = 0
+
+    def subscriber_count(self, channel: bytes) -> int:
+        with self.lock:
+            return len(self.channels.get(channel, ()))
+
+
+@pytest.fixture
+def redis_server():
+    server = RespStubServer()
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+@pytest.fixture
+def loop():
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    yield loop
+    loop.close()
+    asyncio.set_event_loop(None)
+
+
+def make_store(server) -> RedisProgressStore:
+    return RedisProgressStore(f"redis://127.0.0.1:{server.server_address[1]}/0", ttl=60, prefix="test:")
+
+
+def test_set_get_delete(redis_server):
+    store = make_store(redis_server)
+    try:
+        store.set("progress:a", {"type": "start", "message": "开始处理"}, ttl=30)
+        assert store.get("progress:a") == {"type": "start", "message": "开始处理"}
+        assert redis_server.ttls[b"test:progress:a"] == 30
+        assert store.get("progress:missing") is None
+        store.delete("progress:a")
+        assert store.get("progress:a") is None
+        # 连接被复用
+        assert store.stats()["idle_connections"] == 1
+    finally:
+        store.close()
+
+
+def test_publish_subscribe(redis_server, loop):
+    store = make_store(redis_server)
+
+    async def scenario():
+        received = []
+
+        async def listen():
+            async for message in store.subscribe("job:1"):
+                received.append(message)
+                if len(received) == 2:
+                    return
+
+        listener = asyncio.ensure_future(listen())
+        while redis_server.subscriber_count(b"test:job:1") == 0:
+            await asyncio.sleep(0.01)
+        await loop.run_in_executor(None, store.publish, "job:1", {"seq": 1})
+        await loop.run_in_executor(None, store.publish, "job:other", {"seq": 99})
+        await loop.run_in_executor(None, store.publish, "job:1", {"seq": 2})
+        await asyncio.wait_for(listener, 5)
+        return received
+
+    try:
+        assert loop.run_until_complete(scenario()) == [{"seq": 1}, {"seq": 2}]
+    finally:
+        store.close()
+
+
+def test_job_queue_does_not_block_loop_on_store(redis_server, loop):
+    """另一个进程的任务状态从共享存储读取，读取较慢时事件循环仍能处理其他协程"""
+    store = make_store(redis_server)
+
+    async def runner(job):
+        return {"questions": [], "value": job.payload}
+
+    async def scenario():
+        owner = JobQueue(runner, store=store)
+        other = JobQueue(runner, store=store)
+        owner.start()
+        other.start()
+        try:
+            job = owner.submit(7)
+            while not job.finished:
+                await asyncio.sleep(0.01)
+            # 等写入线程把结束状态写入存储
+            await asyncio.wrap_future(owner._store_writer.submit(lambda: None))
+
+            redis_server.get_delay = 0.2
+            ticks = 0
+
+            async def heartbeat():
+                nonlocal ticks
+                while True:
+                    await asyncio.sleep(0.01)
+                    ticks += 1
+
+            beat = asyncio.ensure_future(heartbeat())
+            status = await other.status(job.id)
+            outcome = await other.result(job.id)
+            beat.cancel()
+            return status, outcome, ticks
+        finally:
+            await owner.stop()
+            await other.stop()
+
+    try:
+        status, outcome, ticks = loop.run_until_complete(scenario())
+    finally:
+        store.close()
+    assert status["status"] == "succeeded"
+    assert outcome == {"status": "succeeded", "result": {"questions": [], "value": 7}, "error": None}
+    assert ticks >= 10
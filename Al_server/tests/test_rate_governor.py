@@ -0,0 +1,172 @@
+import asyncio
+
+import pytest
+
+import rate_governor
+from rate_governor import RateGovernor
+
+
+class FakeResponse:
+    def __init__(self, status_code, headers=None):
+        self.status_code = status_code
+        self.headers = headers or {}
+
+
+class HTTPError(Exception):
+    """requests 风格：状态码在 response 上"""
+
+    def __init__(self, status_code, headers=None):
+        super().__init__(f"HTTP {status_code}")
+        self.response = FakeResponse(status_code, headers)
+
+
+class ClientResponseError(Exception):
+    """aiohttp 风格：状态码和响应头直接在异常上"""
+
+    def __init__(self, status, headers=None):
+        super().__init__(f"HTTP {status}")
+        self.status = status
+        self.headers = headers or {}
+
+
+@pytest.fixture
+def sleeps(monkeypatch):
+    """不真正等待，记录每次等待的秒数；抖动取上限，退避时长可预测"""
+    recorded = []
+    monkeypatch.setattr(rate_governor.time, "sleep", recorded.append)
+    monkeypatch.setattr(rate_governor.random, "uniform", lambda low, high: high)
+    return recorded
+
+
+def make_governor(**kwargs):
+    options = dict(rpm=10 ** 6, tpm=10 ** 9, max_in_flight=4, max_retries=3, backoff_base=1, backoff_max=30)
+    options.update(kwargs)
+    return RateGovernor(**options)
+
+
+def flaky(errors, result="ok"):
+    """依次抛出 errors 中的异常，之后返回 result"""
+    calls = []
+
+    def fn():
+        calls.append(1)
+        if len(calls) <= len(errors):
+            raise errors[len(calls) - 1]
+        return result
+    fn.calls = calls
+    return fn
+
+
+@pytest.mark.parametrize("status", [429, 503])
+def test_retries_with_exponential_backoff(sleeps, status):
+    governor = make_governor()
+    fn = flaky([HTTPError(status), HTTPError(status)])
+
+    assert governor.call(fn, tokens=10) == "ok"
+
+    assert len(fn.calls) == 3
+    backoffs = [delay for delay in sleeps if delay in (1, 2)]
+    assert backoffs[:2] == [1, 2]
+    stats = governor.stats()
+    assert (stats["throttled"], stats["retries"], stats["in_flight"], stats["waiting"]) == (2, 2, 0, 0)
+
+
+def test_backoff_is_capped(sleeps):
+    governor = make_governor(max_retries=6, backoff_max=5)
+    fn = flaky([HTTPError(429)] * 5)
+    governor.call(fn, tokens=10)
+    assert max(sleeps) <= 5
+
+
+def test_retry_after_header_overrides_backoff(sleeps):
+    governor = make_governor()
+    fn = flaky([HTTPError(429, {"Retry-After": "7"})])
+    governor.call(fn, tokens=10)
+    assert 7.0 in sleeps
+
+
+def test_throttling_pauses_all_callers(sleeps):
+    governor = make_governor()
+    fn = flaky([HTTPError(503, {"Retry-After": "20"})])
+    governor.call(fn, tokens=10)
+    # 睡眠被替换掉，暂停期仍未结束：其他调用方预占配额时也要等待
+    assert governor._reserve(10) == pytest.approx(20, abs=1)
+
+
+def test_non_retryable_error_is_raised_immediately(sleeps):
+    governor = make_governor()
+    fn = flaky([HTTPError(500)])
+    with pytest.raises(HTTPError):
+        governor.call(fn, tokens=10)
+    assert len(fn.calls) == 1
+    assert governor.stats()["throttled"] == 0
+    assert sleeps == []
+
+
+def test_gives_up_after_max_retries(sleeps):
+    governor = make_governor(max_retries=2)
+    fn = flaky([HTTPError(429)] * 5)
+    with pytest.raises(HTTPError):
+        governor.call(fn, tokens=10)
+    assert len(fn.calls) == 3
+    stats = governor.stats()
+    assert (stats["throttled"], stats["retries"]) == (3, 2)
+
+
+def test_stream_is_not_retried_after_first_chunk(sleeps):
+    governor = make_governor()
+    attempts = []
+
+    def factory():
+        attempts.append(1)
+        yield "partial"
+        raise HTTPError(503)
+
+    stream = governor.stream(factory, tokens=10)
+    assert next(stream) == "partial"
+    with pytest.raises(HTTPError):
+        next(stream)
+    assert len(attempts) == 1
+    assert governor.stats()["in_flight"] == 0
+
+
+def test_stream_retries_before_first_chunk(sleeps):
+    governor = make_governor()
+    attempts = []
+
+    def factory():
+        attempts.append(1)
+        if len(attempts) == 1:
+            raise HTTPError(429)
+        yield "a"
+        yield "b"
+
+    assert list(governor.stream(factory, tokens=10)) == ["a", "b"]
+    assert len(attempts) == 2
+
+
+def test_async_call_backs_off_on_aiohttp_errors(monkeypatch):
+    monkeypatch.setattr(rate_governor.random, "uniform", lambda low, high: high)
+    delays = []
+    real_sleep = asyncio.sleep
+
+    async def fake_sleep(delay):
+        delays.append(delay)
+        await real_sleep(0)
+    monkeypatch.setattr(rate_governor.asyncio, "sleep", fake_sleep)
+
+    governor = make_governor()
+    errors = [ClientResponseError(429), ClientResponseError(503, {"Retry-After": "3"})]
+
+    async def fn():
+        if errors:
+            raise errors.pop(0)
+        return "ok"
+
+    loop = asyncio.new_event_loop()
+    try:
+        assert loop.run_until_complete(governor.acall(fn, tokens=10)) == "ok"
+    finally:
+        loop.close()
+    assert 1 in delays and 3.0 in delays
+    assert governor.stats()["retries"] == 2
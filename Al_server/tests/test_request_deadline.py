@@ -0,0 +1,53 @@
+import asyncio
+
+import pytest
+
+pytest.importorskip("fastapi")
+
+import main
+
+
+class FakeRequest:
+    def __init__(self, headers=None):
+        self.headers = headers or {}
+
+
+@pytest.fixture
+def loop():
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    yield loop
+    loop.close()
+    asyncio.set_event_loop(None)
+
+
+def test_no_budget_means_no_deadline(loop):
+    assert main.request_deadline(FakeRequest(), {}) is None
+
+
+@pytest.mark.parametrize("budget", [1500, 1500.0, "1500"])
+def test_budget_from_body(loop, budget):
+    deadline = main.request_deadline(FakeRequest(), {"deadline_ms": budget})
+    assert deadline - loop.time() == pytest.approx(1.5, abs=0.1)
+
+
+def test_header_takes_precedence(loop):
+    deadline = main.request_deadline(FakeRequest({"X-Request-Deadline-Ms": "200"}), {"deadline_ms": 5000})
+    assert deadline - loop.time() == pytest.approx(0.2, abs=0.1)
+
+
+@pytest.mark.parametrize("budget", [[1000], {"ms": 1000}, True, "abc", "nan", "inf", float("nan"), 0, -5])
+def test_invalid_budget_raises_value_error(loop, budget):
+    with pytest.raises(ValueError):
+        main.request_deadline(FakeRequest(), {"deadline_ms": budget})
+
+
+@pytest.mark.parametrize("budget", [[1000], "nan"])
+def test_invalid_budget_is_a_400(budget):
+    from fastapi.testclient import TestClient
+
+    question = {"question_text": "1+1=?", "question_type": "text", "correct_answer": "B",
+                "options": [{"label": "A", "text": "1"}, {"label": "B", "text": "2"}]}
+    response = TestClient(main.app).post("/api/generate-explanation",
+                                         json={"question": question, "deadline_ms": budget})
+    assert response.status_code == 400
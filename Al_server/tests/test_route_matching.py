@@ -0,0 +1,54 @@
+import asyncio
+
+import pytest
+
+from llm_scheduler import PRIORITY_BULK, PRIORITY_INTERACTIVE, PRIORITY_STREAMING, LLMPriorityMiddleware, current_priority
+from token_usage import UsageMiddleware, current_usage
+
+PRIORITY_ROUTES = {
+    "/api/generate-explanation": PRIORITY_INTERACTIVE,
+    "/api/extract": PRIORITY_STREAMING,
+    "/api/generate-batch-explanations": PRIORITY_BULK,
+}
+USAGE_ROUTES = ["/api/extract", "/api/generate-explanation", "/api/generate-explanation/stream"]
+
+
+def call(middleware_cls, routes, path):
+    """用给定路径调用中间件，返回内层应用看到的优先级和统计范围"""
+    seen = {}
+
+    async def app(scope, receive, send):
+        usage = current_usage.get()
+        seen["priority"] = current_priority.get()
+        seen["endpoint"] = usage.endpoint if usage else None
+
+    middleware = middleware_cls(app, routes)
+    loop = asyncio.new_event_loop()
+    try:
+        loop.run_until_complete(middleware({"type": "http", "path": path, "headers": []}, None, None))
+    finally:
+        loop.close()
+    return seen
+
+
+@pytest.mark.parametrize("path, priority", [
+    ("/api/extract", PRIORITY_STREAMING),
+    ("/api/extract/", PRIORITY_STREAMING),
+    ("/api/generate-explanation/stream", PRIORITY_INTERACTIVE),
+    # 只共享字符串前缀、不是同一路径段的接口不匹配，沿用默认优先级
+    ("/api/extract-raw", PRIORITY_BULK),
+    ("/api/generate-explanations", PRIORITY_BULK),
+])
+def test_priority_matches_whole_path_segments(path, priority):
+    assert call(LLMPriorityMiddleware, PRIORITY_ROUTES, path)["priority"] == priority
+
+
+@pytest.mark.parametrize("path, endpoint", [
+    ("/api/extract", "/api/extract"),
+    ("/api/generate-explanation", "/api/generate-explanation"),
+    ("/api/generate-explanation/stream", "/api/generate-explanation/stream"),
+    ("/api/extract-raw", None),
+])
+def test_usage_matches_whole_path_segments(path, endpoint):
+    assert call(UsageMiddleware, USAGE_ROUTES, path)["endpoint"] == endpoint
+
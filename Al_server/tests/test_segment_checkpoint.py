@@ -0,0 +1,121 @@
+import progress_store
+from progress_store import MemoryProgressStore
+from segment_checkpoint import SEGMENT_FAILED, SEGMENT_OK, SEGMENT_PENDING, SegmentCheckpoint
+
+
+class RecordingStore(MemoryProgressStore):
+    """记录每次写入的键和过期时间"""
+
+    def __init__(self):
+        super().__init__()
+        self.writes = []
+        self.ttls = {}
+
+    def set(self, key, value, ttl=None):
+        self.writes.append(key)
+        self.ttls[key] = ttl
+        super().set(key, value, ttl)
+
+
+def make_checkpoint(store, segments=3):
+    checkpoint = SegmentCheckpoint(store, "job1", {"expected_questions": 10})
+    for index in range(segments):
+        checkpoint.add_segment(index, f"片段{index}")
+    checkpoint.complete_extraction("全文")
+    return checkpoint
+
+
+def test_record_result_writes_only_changed_segment():
+    store = RecordingStore()
+    checkpoint = make_checkpoint(store)
+    store.writes.clear()
+
+    checkpoint.record_result({"segment_index": 1, "success": True, "questions": [{"question_text": "q"}]})
+    checkpoint.record_result({"segment_index": 2, "success": False, "error": "超时"})
+
+    assert store.writes == ["job:job1:segments:1", "job:job1:segments:2"]
+
+
+def test_load_round_trip():
+    store = MemoryProgressStore()
+    checkpoint = make_checkpoint(store)
+    checkpoint.record_result({"segment_index": 0, "success": True, "questions": [{"question_text": "q"}]})
+    checkpoint.record_result({"segment_index": 2, "success": False, "error": "超时", "attempts": 3})
+
+    loaded = SegmentCheckpoint.load(store, "job1")
+
+    assert [s["status"] for s in loaded.segments] == [SEGMENT_OK, SEGMENT_PENDING, SEGMENT_FAILED]
+    assert loaded.segments[2]["attempts"] == 3
+    assert loaded.extraction_complete and loaded.raw_content == "全文" and loaded.expected_questions == 10
+    assert loaded.questions() == [{"question_text": "q"}]
+    assert SegmentCheckpoint.load(store, "missing") is None
+
+
+def test_loaded_checkpoint_does_not_alias_store():
+    store = MemoryProgressStore()
+    make_checkpoint(store)
+    first = SegmentCheckpoint.load(store, "job1")
+    second = SegmentCheckpoint.load(store, "job1")
+
+    # 只改内存中的状态、不写回时，存储和其他副本都不受影响
+    first.segments[0]["status"] = SEGMENT_OK
+    first.segments[0]["questions"].append({"question_text": "q"})
+
+    assert second.segments[0]["status"] == SEGMENT_PENDING
+    assert SegmentCheckpoint.load(store, "job1").segments[0]["questions"] == []
+
+    first.record_result({"segment_index": 1, "success": True, "questions": [{"question_text": "q2"}]})
+    assert second.segments[1]["status"] == SEGMENT_PENDING
+    assert SegmentCheckpoint.load(store, "job1").segments[1]["status"] == SEGMENT_OK
+
+
+def test_incomplete_checkpoint_is_discarded_when_segment_expired():
+    store = MemoryProgressStore()
+    make_checkpoint(store)
+    store.delete("job:job1:segments:1")
+    assert SegmentCheckpoint.load(store, "job1") is None
+
+
+def test_writes_use_checkpoint_ttl(monkeypatch):
+    monkeypatch.setenv("CHECKPOINT_TTL", "7200")
+    store = RecordingStore()
+    checkpoint = make_checkpoint(store)
+    checkpoint.record_result({"segment_index": 0, "success": True, "questions": []})
+    assert set(store.ttls.values()) == {7200}
+    assert SegmentCheckpoint.load(store, "job1").ttl == 7200
+
+
+def test_refresh_rewrites_every_key():
+    store = RecordingStore()
+    checkpoint = make_checkpoint(store)
+    store.writes.clear()
+    checkpoint.refresh()
+    assert sorted(store.writes) == ["job:job1:segments", "job:job1:segments:0",
+                                    "job:job1:segments:1", "job:job1:segments:2"]
+
+
+class FakeMonotonic:
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+
+def test_early_segments_outlive_progress_ttl(monkeypatch):
+    clock = FakeMonotonic()
+    monkeypatch.setattr(progress_store.time, "monotonic", clock)
+    store = MemoryProgressStore(ttl=3600)
+    checkpoint = SegmentCheckpoint(store, "job1", ttl=86400)
+    checkpoint.add_segment(0, "片段0")
+    # 后面的片段在一个多小时后才写入
+    clock.now += 3000
+    checkpoint.add_segment(1, "片段1")
+    checkpoint.complete_extraction("全文")
+    clock.now += 3000
+    assert SegmentCheckpoint.load(store, "job1") is not None
+
+    # 恢复时整体续期：原先最早的片段到期之后仍然可以读取
+    SegmentCheckpoint.load(store, "job1").refresh()
+    clock.now += 86400 - 1000
+    assert SegmentCheckpoint.load(store, "job1") is not None
@@ -0,0 +1,194 @@
+import asyncio
+import threading
+import time
+
+import pytest
+
+from singleflight import AsyncSingleFlight, AsyncStreamGroup, SingleFlight, StreamGroup
+
+
+@pytest.fixture
+def loop():
+    loop = asyncio.new_event_loop()
+    yield loop
+    loop.close()
+
+
+def test_sync_calls_share_one_execution():
+    flight = SingleFlight()
+    started = threading.Event()
+    release = threading.Event()
+    calls = []
+
+    def fn():
+        calls.append(1)
+        started.set()
+        release.wait(5)
+        return {"questions": [1]}
+
+    results = []
+    leader = threading.Thread(target=lambda: results.append(flight.do("k", fn)))
+    leader.start()
+    started.wait(5)
+    followers = [threading.Thread(target=lambda: results.append(flight.do("k", fn))) for _ in range(3)]
+    for thread in followers:
+        thread.start()
+    while flight.shared < 3:
+        time.sleep(0.01)
+    release.set()
+    for thread in [leader] + followers:
+        thread.join(5)
+
+    assert len(calls) == 1
+    assert results == [{"questions": [1]}] * 4
+    # 跟随者拿到的是副本
+    assert len({id(result) for result in results}) == 4
+
+
+def test_sync_error_propagates_to_followers():
+    flight = SingleFlight()
+    release = threading.Event()
+
+    def fn():
+        release.wait(5)
+        raise ValueError("boom")
+
+    errors = []
+
+    def call():
+        try:
+            flight.do("k", fn)
+        except ValueError as e:
+            errors.append(str(e))
+
+    threads = [threading.Thread(target=call) for _ in range(3)]
+    for thread in threads:
+        thread.start()
+    while flight.executed + flight.shared < 3:
+        time.sleep(0.01)
+    release.set()
+    for thread in threads:
+        thread.join(5)
+    assert errors == ["boom"] * 3
+    # 出错后不残留，下一次调用重新执行
+    assert flight.do("k", lambda: "ok") == "ok"
+
+
+def test_cancelled_waiter_does_not_cancel_shared_task(loop):
+    flight = AsyncSingleFlight()
+    upstream = {"cancelled": False}
+
+    async def fn():
+        try:
+            await asyncio.sleep(0.1)
+            return "result"
+        except asyncio.CancelledError:
+            upstream["cancelled"] = True
+            raise
+
+    async def scenario():
+        first = asyncio.ensure_future(flight.do("k", fn))
+        second = asyncio.ensure_future(flight.do("k", fn))
+        await asyncio.sleep(0.01)
+        first.cancel()
+        return await second, first
+
+    result, first = loop.run_until_complete(scenario())
+    assert result == "result"
+    assert first.cancelled()
+    assert not upstream["cancelled"]
+    assert (flight.executed, flight.shared) == (1, 1)
+
+
+def test_last_waiter_leaving_cancels_shared_task(loop):
+    flight = AsyncSingleFlight()
+    upstream = {"cancelled": False}
+
+    async def fn():
+        try:
+            await asyncio.sleep(10)
+        except asyncio.CancelledError:
+            upstream["cancelled"] = True
+            raise
+
+    async def scenario():
+        waiters = [asyncio.ensure_future(flight.do("k", fn)) for _ in range(2)]
+        await asyncio.sleep(0.01)
+        for waiter in waiters:
+            waiter.cancel()
+        await asyncio.wait(waiters)
+        await asyncio.sleep(0)
+
+    loop.run_until_complete(scenario())
+    assert upstream["cancelled"]
+    assert flight._calls == {}
+
+
+def test_stream_group_replays_to_late_subscriber():
+    group = StreamGroup()
+    opened = []
+
+    def source():
+        opened.append(1)
+        yield from ["a", "b", "c"]
+
+    first = group.subscribe("k", source)
+    assert next(first) == "a"
+    second = group.subscribe("k", source)
+    assert list(second) == ["a", "b", "c"]
+    assert list(first) == ["b", "c"]
+    assert len(opened) == 1
+    assert (group.executed, group.shared) == (1, 1)
+
+
+def test_stream_group_closes_source_when_all_subscribers_leave():
+    group = StreamGroup()
+    closed = []
+
+    def source():
+        try:
+            while True:
+                yield "chunk"
+        finally:
+            closed.append(1)
+
+    first = group.subscribe("k", source)
+    second = group.subscribe("k", source)
+    assert next(first) == "chunk"
+    assert next(second) == "chunk"
+    first.close()
+    assert closed == []
+    second.close()
+    assert closed == [1]
+    # 放弃的流不会被新订阅者复用
+    third = group.subscribe("k", source)
+    assert next(third) == "chunk"
+    third.close()
+    assert group.executed == 2
+
+
+def test_async_stream_group_cancels_upstream_when_abandoned(loop):
+    group = AsyncStreamGroup()
+    state = {"closed": False}
+
+    async def source():
+        try:
+            while True:
+                yield "chunk"
+                await asyncio.sleep(0.01)
+        finally:
+            state["closed"] = True
+
+    async def scenario():
+        received = []
+        stream = group.subscribe("k", source)
+        async for chunk in stream:
+            received.append(chunk)
+            if len(received) == 2:
+                break
+        await stream.aclose()
+        await asyncio.sleep(0.05)
+        return received
+
+    assert loop.run_until_complete(scenario()) == ["chunk", "chunk"]
+    assert state["closed"]
@@ -0,0 +1,82 @@
+import json
+
+import pytest
+
+pytest.importorskip("requests")
+
+from llm_stream_processor import LLMStreamProcessor
+from stream_json_parser import QUESTION_SEPARATOR
+
+STEM = "下面程序输出什么？"
+SOURCE = "\n".join(f"第{number}题 {STEM}\nint main() {{ cout << {number}; }}\nA. {number}  B. 0" for number in range(1, 4))
+
+
+def make_question(number: int):
+    return {"question_text": f"{STEM}\nint main() {{ cout << {number}; }}", "question_type": "code",
+            "correct_answer": "A", "options": [{"label": "A", "text": str(number)}, {"label": "B", "text": "0"}]}
+
+
+def render(questions):
+    return "".join(f"{json.dumps(q, ensure_ascii=False)}\n{QUESTION_SEPARATOR}\n" for q in questions)
+
+
+@pytest.fixture
+def processor():
+    processor = LLMStreamProcessor(client=object())
+    processor.max_continuations = 3
+    processor.rounds = []
+    return processor
+
+
+def script(processor, outputs):
+    """按轮次依次返回 (输出文本, finish_reason)，记录每轮的提示词"""
+    outputs = iter(outputs)
+
+    def call_api_stream(prompt, stream_state=None):
+        text, finish_reason = next(outputs)
+        processor.rounds.append(prompt)
+        yield text
+        stream_state["finish_reason"] = finish_reason
+
+    processor.call_api_stream = call_api_stream
+
+
+def test_continuation_starts_after_matched_question_with_repeated_stems(processor):
+    assert processor.find_continuation_text(SOURCE, [make_question(1)]).startswith("第2题")
+    assert processor.find_continuation_text(SOURCE, [make_question(1), make_question(2)]).startswith("第3题")
+    assert processor.find_continuation_text(SOURCE, [make_question(n) for n in range(1, 4)]) == ""
+
+
+def test_continuation_falls_back_to_question_count(processor):
+    questions = [{"question_text": "原文中找不到的题干"}]
+    assert processor.find_continuation_text(SOURCE, questions).startswith("第2题")
+
+
+def test_truncated_output_resumes_without_dropping_questions(processor):
+    script(processor, [(render([make_question(1)]) + '{"question_text": "下面', "length"),
+                       (render([make_question(2), make_question(3)]), "stop")])
+
+    events = list(processor.iter_chunk_questions(SOURCE, expected=3))
+
+    questions = [event["question"] for event in events if event["type"] == "question"]
+    assert questions == [make_question(n) for n in range(1, 4)]
+    assert len(processor.rounds) == 2
+    assert "cout << 1;" not in processor.rounds[1] and "cout << 2;" in processor.rounds[1]
+
+
+def test_overestimated_count_without_remaining_text_does_not_continue(processor):
+    script(processor, [(render([make_question(n) for n in range(1, 4)]), "stop")])
+
+    events = list(processor.iter_chunk_questions(SOURCE, expected=5))
+
+    assert [event["type"] for event in events] == ["question"] * 3
+    assert len(processor.rounds) == 1
+
+
+def test_continuation_without_new_questions_stops(processor):
+    script(processor, [(render([make_question(1)]), "stop"), ("", "stop"), ("", "stop")])
+
+    events = list(processor.iter_chunk_questions(SOURCE, expected=3))
+
+    assert [event["type"] for event in events] == ["question", "continuation"]
+    assert len(processor.rounds) == 2
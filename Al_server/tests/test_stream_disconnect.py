@@ -0,0 +1,152 @@
+import asyncio
+import json
+import threading
+import time
+
+import pytest
+
+pytest.importorskip("fastapi")
+
+import main
+
+BOUNDARY = "gesp-test-boundary"
+
+
+def multipart_body() -> bytes:
+    return (
+        f"--{BOUNDARY}\r\n"
+        'Content-Disposition: form-data; name="file"; filename="paper.pdf"\r\n'
+        "Content-Type: application/pdf\r\n\r\n"
+        "%PDF-fake\r\n"
+        f"--{BOUNDARY}--\r\n"
+    ).encode()
+
+
+QUESTION = {"question_text": "1+1=?", "question_type": "single_choice", "correct_answer": "B",
+            "options": [{"label": "A", "text": "1"}, {"label": "B", "text": "2"}]}
+
+
+@pytest.fixture
+def upstream(monkeypatch):
+    """替换页面提取和上游流式调用：上游先输出一道题目，然后长时间挂起，记录是否被关闭"""
+    state = {"started": 0, "closed": 0, "finished": 0}
+
+    def fake_pages(upload):
+        yield "第 1 题\n" + "题干 " * 50
+        yield "第 2 题\n" + "题干 " * 50
+
+    async def fake_stream(prompt, stream_state=None):
+        state["started"] += 1
+        try:
+            yield "[" + json.dumps(QUESTION, ensure_ascii=False) + ","
+            await asyncio.sleep(30)
+            yield json.dumps(QUESTION, ensure_ascii=False) + "]"
+            state["finished"] += 1
+        finally:
+            state["closed"] += 1
+
+    monkeypatch.setattr(main, "iter_pdf_pages", fake_pages)
+    monkeypatch.setattr(main.llm_stream_processor, "call_api_stream_async", fake_stream)
+    return state
+
+
+def test_stream_extract_cancels_upstream_on_disconnect(upstream):
+    cancelled_before = main.llm_stream_processor.cancelled_streams
+
+    async def run():
+        body = multipart_body()
+        got_question = asyncio.Event()
+        request_sent = False
+        sent = []
+        receives = []
+
+        async def receive():
+            nonlocal request_sent
+            receives.append(1)
+            if not request_sent:
+                request_sent = True
+                return {"type": "http.request", "body": body, "more_body": False}
+            # 收到第一道题目后客户端断开
+            await got_question.wait()
+            return {"type": "http.disconnect"}
+
+        async def send(message):
+            sent.append(message)
+            if message["type"] == "http.response.body" and b'"type": "question"' in message.get("body", b""):
+                got_question.set()
+
+        scope = {
+            "type": "http", "asgi": {"version": "3.0"}, "http_version": "1.1", "method": "POST",
+            "scheme": "http", "path": "/api/stream-extract", "raw_path": b"/api/stream-extract",
+            "root_path": "", "query_string": b"", "client": ("127.0.0.1", 50000), "server": ("testserver", 80),
+            "headers": [(b"content-type", f"multipart/form-data; boundary={BOUNDARY}".encode()),
+                        (b"content-length", str(len(body)).encode())],
+        }
+        try:
+            await asyncio.wait_for(main.app(scope, receive, send), timeout=5)
+        except asyncio.CancelledError:
+            pass
+        # 等取消传递到各片段任务
+        for _ in range(50):
+            if upstream["closed"] == upstream["started"]:
+                break
+            await asyncio.sleep(0.02)
+        return sent, receives
+
+    loop = asyncio.new_event_loop()
+    try:
+        sent, receives = loop.run_until_complete(run())
+    finally:
+        loop.close()
+
+    assert any(b'"type": "question"' in m.get("body", b"") for m in sent if m["type"] == "http.response.body")
+    assert upstream["started"] >= 1
+    assert upstream["closed"] == upstream["started"]
+    assert upstream["finished"] == 0
+    assert main.llm_stream_processor.cancelled_streams == cancelled_before + 1
+    # receive() 只有一个读者：请求体一次，断开消息一次
+    assert len(receives) == 2
+
+
+def test_pipeline_joins_page_thread_when_cancelled_twice(upstream, monkeypatch):
+    pages_reading = threading.Event()
+    pages_done = threading.Event()
+
+    def slow_pages():
+        yield "第 1 题\n" + "题干 " * 50
+        yield "第 2 题\n" + "题干 " * 50
+        # 页面线程在流水线被取消时还在读取文件
+        pages_reading.set()
+        time.sleep(0.3)
+        pages_done.set()
+        yield "第 3 题\n" + "题干 " * 50
+
+    # 片段较小，每页的题目立即发出，不用等整份PDF提取完
+    monkeypatch.setattr(main.llm_stream_processor, "segment_max_chars", 100)
+
+    async def run():
+        events = main.llm_stream_processor.process_pdf_pages_stream_async(slow_pages(), parallel_streams=1)
+        got_question = asyncio.Event()
+
+        async def consume():
+            async for event in events:
+                if event["type"] == "question":
+                    got_question.set()
+
+        task = asyncio.ensure_future(consume())
+        await got_question.wait()
+        while not pages_reading.is_set():
+            await asyncio.sleep(0.01)
+        task.cancel()
+        await asyncio.sleep(0.05)
+        task.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await task
+        # 任务结束时页面线程必须已经退出，调用方随后会关闭上传文件
+        return pages_done.is_set()
+
+    loop = asyncio.new_event_loop()
+    try:
+        assert loop.run_until_complete(run())
+    finally:
+        loop.close()
@@ -0,0 +1,159 @@
+import asyncio
+import json
+import random
+
+import pytest
+
+from stream_json_parser import QUESTION_SEPARATOR, StreamingJSONParser, aparse_json_stream, parse_json_stream
+
+
+def make_question(number: int):
+    # 字符串中包含引号、反斜杠、括号和分隔符的开头字符，数组中有负数
+    return {
+        "question_text": f"第{number}题 \\ \"引号\" {{}} [] --- - 下面程序输出什么？",
+        "question_code": "int main() {\n  cout << \"a\\\\b\";\n}",
+        "options": [{"label": "A", "text": "-1"}, {"label": "B", "text": "{[\"]}"}],
+        "scores": [-1, -2],
+        "level": number
+    }
+
+
+def split_every(text: str, size: int):
+    return [text[i:i + size] for i in range(0, len(text), size)]
+
+
+def feed_all(parser: StreamingJSONParser, chunks):
+    found = []
+    for chunk in chunks:
+        found.extend(parser.feed(chunk))
+    return found
+
+
+@pytest.mark.parametrize("size", [1, 2, 3, 7, 1000])
+def test_objects_split_at_every_position(size):
+    questions = [make_question(i) for i in range(3)]
+    text = "".join(f"{json.dumps(q, ensure_ascii=False)}\n{QUESTION_SEPARATOR}\n" for q in questions)
+    assert list(parse_json_stream(split_every(text, size))) == questions
+
+
+def test_random_chunking_matches_whole_input():
+    rng = random.Random(2024)
+    for _ in range(300):
+        questions = [make_question(i) for i in range(rng.randint(1, 5))]
+        separator = rng.choice([f"\n{QUESTION_SEPARATOR}\n", QUESTION_SEPARATOR, "\n", ",\n"])
+        text = separator.join(json.dumps(q, ensure_ascii=False, indent=rng.choice([None, 2])) for q in questions)
+        text = rng.choice(["", "```json\n[", "["]) + text + rng.choice(["", "]", "\n```"])
+        chunks, pos = [], 0
+        while pos < len(text):
+            size = rng.randint(1, 9)
+            chunks.append(text[pos:pos + size])
+            pos += size
+        assert list(parse_json_stream(chunks)) == questions
+
+
+@pytest.mark.parametrize("text", [
+    '{"a": "x\\"y"}',
+    '{"a": "x\\\\"}',
+    '{"a": "\\\\\\""}',
+    '{"a": "\\u4e2d\\n"}',
+])
+def test_escape_split_across_chunks(text):
+    expected = json.loads(text)
+    for cut in range(1, len(text)):
+        parser = StreamingJSONParser()
+        assert feed_all(parser, [text[:cut], text[cut:]]) == [expected], cut
+
+
+def test_escape_alone_in_chunk():
+    parser = StreamingJSONParser()
+    assert feed_all(parser, ['{"a": "x', "\\", '"', '"}']) == [{"a": 'x"'}]
+
+
+def test_partial_separator_across_chunks_is_just_text():
+    # 字符串之外的 '-' 开头的内容被切断，最终不是分隔符（负数）
+    parser = StreamingJSONParser()
+    assert feed_all(parser, ['{"n": [1, -', '2]}']) == [{"n": [1, -2]}]
+    parser = StreamingJSONParser()
+    assert feed_all(parser, ['{"n": [1, ---QUES', 'TION']) == []
+    assert parser.errors == 0
+
+
+def test_separator_inside_object_resyncs():
+    good = {"question_text": "完整的题目"}
+    for cut in range(1, len(QUESTION_SEPARATOR)):
+        parser = StreamingJSONParser()
+        chunks = ['{"question_text": "残缺", "options": [', "\n" + QUESTION_SEPARATOR[:cut],
+                  QUESTION_SEPARATOR[cut:] + "\n", json.dumps(good, ensure_ascii=False)]
+        assert feed_all(parser, chunks) == [good], cut
+        assert parser.errors == 1
+
+
+def test_separator_inside_string_is_kept():
+    question = {"question_text": f"文本中出现 {QUESTION_SEPARATOR} 也不影响"}
+    text = json.dumps(question, ensure_ascii=False)
+    assert list(parse_json_stream(split_every(text, 4))) == [question]
+
+
+def test_invalid_object_is_skipped():
+    parser = StreamingJSONParser()
+    found = feed_all(parser, ['{"a": nope}', QUESTION_SEPARATOR, '{"b": 1}'])
+    assert found == [{"b": 1}]
+    assert parser.errors == 1
+
+
+def test_finish_closes_object_missing_only_brackets():
+    parser = StreamingJSONParser()
+    assert parser.feed('{"question_text": "q", "options": [{"label": "A"}') == []
+    assert parser.finish() == [{"question_text": "q", "options": [{"label": "A"}]}]
+    assert parser.partial is None
+
+
+@pytest.mark.parametrize("tail", [
+    '{"question_text": "被截断的字',
+    '{"question_text": "q",',
+    '{"question_text": "q", "level":',
+    '{"question_text": "q", "level": 1, "options": [{"label": "A", "text"',
+])
+def test_finish_keeps_truncated_text_in_partial(tail):
+    parser = StreamingJSONParser()
+    assert parser.feed(tail) == []
+    assert parser.finish() == []
+    assert parser.partial == tail
+
+
+def test_finish_without_open_object():
+    parser = StreamingJSONParser()
+    parser.feed('{"a": 1}\n' + QUESTION_SEPARATOR)
+    assert parser.finish() == []
+    assert parser.partial is None
+
+
+def test_parse_json_stream_closes_source_on_early_stop():
+    closed = []
+
+    def source():
+        try:
+            yield '{"a": 1}{"b": 2}'
+            yield '{"c": 3}'
+        finally:
+            closed.append(1)
+
+    stream = parse_json_stream(source())
+    assert next(stream) == {"a": 1}
+    stream.close()
+    assert closed == [1]
+
+
+def test_async_stream_with_truncated_tail():
+    async def source():
+        for chunk in ['{"a": 1}', QUESTION_SEPARATOR, '{"b": [1, 2', ']']:
+            yield chunk
+
+    async def collect():
+        return [obj async for obj in aparse_json_stream(source())]
+
+    loop = asyncio.new_event_loop()
+    try:
+        assert loop.run_until_complete(collect()) == [{"a": 1}, {"b": [1, 2]}]
+    finally:
+        loop.close()
@@ -0,0 +1,58 @@
+import asyncio
+
+import pytest
+
+pytest.importorskip("requests")
+
+from llm_stream_processor import LLMStreamProcessor
+
+# 每个片段的题目数和输出每道题目前的等待时间：后面的片段先完成
+CHUNKS = {"片段0": (3, 0.03), "片段1": (2, 0.001), "片段2": (2, 0.01)}
+
+
+@pytest.fixture
+def processor():
+    processor = LLMStreamProcessor(client=object())
+
+    def split_page(segmenter, page_index, page_text):
+        return [page_text]
+
+    async def chunk_questions(chunk_text, expected=None, chunk_index=0):
+        count, delay = CHUNKS[chunk_text]
+        for number in range(count):
+            await asyncio.sleep(delay)
+            yield {"type": "question", "question": {"question_text": f"{chunk_text}-{number}"}}
+
+    processor._split_page = split_page
+    processor.aiter_chunk_questions = chunk_questions
+    return processor
+
+
+def run(processor, parallel_streams):
+    async def collect():
+        return [event async for event in processor.process_pdf_pages_stream_async(list(CHUNKS), parallel_streams=parallel_streams)]
+
+    loop = asyncio.new_event_loop()
+    try:
+        return loop.run_until_complete(collect())
+    finally:
+        loop.close()
+
+
+@pytest.mark.parametrize("parallel_streams", [1, 3])
+def test_questions_are_emitted_in_source_order(processor, parallel_streams):
+    events = run(processor, parallel_streams)
+    questions = [event for event in events if event["type"] == "question"]
+
+    assert [event["question"]["question_text"] for event in questions] == [
+        "片段0-0", "片段0-1", "片段0-2", "片段1-0", "片段1-1", "片段2-0", "片段2-1"
+    ]
+    assert [event["question_index"] for event in questions] == list(range(7))
+    assert events[-1]["type"] == "process_complete" and events[-1]["total_questions"] == 7
+
+
+def test_later_chunks_run_concurrently(processor):
+    events = run(processor, 3)
+    completions = [event["chunk_index"] for event in events if event["type"] == "chunk_complete"]
+    # 片段事件不等待，后面的片段先完成
+    assert completions[-1] == 0
@@ -0,0 +1,90 @@
+import re
+import time
+from typing import List
+from metrics import SPLIT_SECONDS
+
+# 题目编号，如 "第 1 题"
+QUESTION_PATTERN = re.compile(r'第\s*\d+\s*题')
+# 章节标题，如 "1 单选题（每题 2 分，共 30 分）"
+SECTION_PATTERN = re.compile(r'\d+\s*(单选题|判断题|编程题)')
+
+
+def is_question_boundary(line: str) -> bool:
+    """判断一行是否是题目或章节的开始"""
+    stripped = line.strip()
+    return bool(QUESTION_PATTERN.match(stripped) or SECTION_PATTERN.match(stripped))
+
+
+class QuestionSegmenter:
+    """
+    增量题目切分器，与 split_pdf_text_intelligently 使用相同的边界规则。
+    每读到一个题目边界，边界之前的题目就已完整，达到大小阈值即可切出一个片段，
+    不必等整份PDF提取完成。
+    """
+
+    def __init__(self, max_chunk_size: int = 3000):
+        self.max_chunk_size = max_chunk_size
+        self._lines = []
+        self._size = 0
+        # 本份文本累计的切分耗时，flush 时记入指标
+        self.elapsed = 0.0
+
+    def _take_chunk(self, end: int = None) -> str:
+        """取出当前缓冲的前 end 行作为一个片段"""
+        end = len(self._lines) if end is None else end
+        chunk = "\n".join(self._lines[:end]).strip()
+        self._lines = self._lines[end:]
+        self._size = sum(len(line) + 1 for line in self._lines)
+        return chunk
+
+    def _has_content(self) -> bool:
+        return any(line.strip() for line in self._lines)
+
+    def _find_best_split_line(self) -> int:
+        """在缓冲中寻找最后一个题目开始的行号，找不到返回0"""
+        for i in range(len(self._lines) - 1, -1, -1):
+            if QUESTION_PATTERN.match(self._lines[i].strip()):
+                return i
+        return 0
+
+    def feed(self, text: str) -> List[str]:
+        """
+        追加一段文本（通常是一页），返回已经可以处理的完整片段
+
+        Args:
+            text: 新增文本，需以整行为单位
+
+        Returns:
+            List[str]: 新切出的片段
+        """
+        chunks = []
+        if not text:
+            return chunks
+
+        started = time.perf_counter()
+        for line in text.split('\n'):
+            line_size = len(line) + 1
+
+            if (is_question_boundary(line) and
+                self._size > self.max_chunk_size * 0.3 and
+                self._has_content()):
+                chunks.append(self._take_chunk())
+            elif self._size + line_size > self.max_chunk_size and self._has_content():
+                split_line = self._find_best_split_line()
+                chunks.append(self._take_chunk(split_line if split_line > 0 else None))
+
+            self._lines.append(line)
+            self._size += line_size
+
+        self.elapsed += time.perf_counter() - started
+        return [chunk for chunk in chunks if chunk]
+
+    def flush(self) -> List[str]:
+        """输入结束，返回剩余的最后一个片段"""
+        SPLIT_SECONDS.labels("incremental").observe(self.elapsed)
+        self.elapsed = 0.0
+        if not self._has_content():
+            self._lines = []
+            self._size = 0
+            return []
+        return [self._take_chunk()]
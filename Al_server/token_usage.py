@@ -0,0 +1,192 @@
+import contextvars
+import threading
+from contextlib import contextmanager
+from typing import Any, Dict, Generator, Iterable, Optional, Tuple
+
+from metrics import REGISTRY
+
+LLM_TOKENS = REGISTRY.counter(
+    "llm_tokens_total", "上游返回的 usage 中的token数，kind 为 prompt / completion", ["processor", "model", "kind"]
+)
+LLM_USAGE_UNREPORTED = REGISTRY.counter(
+    "llm_usage_unreported_total", "已产生输出但没有拿到 usage 的上游调用数（如被提前关闭的流），其token未计入", ["processor"]
+)
+
+
+def normalize_usage(usage: Optional[Dict[str, Any]]) -> Optional[Dict[str, int]]:
+    """
+    把响应中的 usage 规整为 prompt_tokens / completion_tokens / total_tokens，
+    同时兼容兼容模式（prompt_tokens）和DashScope原生接口（input_tokens）的字段名；没有 usage 时返回None
+    """
+    if not usage:
+        return None
+    prompt = usage.get("prompt_tokens", usage.get("input_tokens")) or 0
+    completion = usage.get("completion_tokens", usage.get("output_tokens")) or 0
+    total = usage.get("total_tokens") or prompt + completion
+    return {"prompt_tokens": int(prompt), "completion_tokens": int(completion), "total_tokens": int(total)}
+
+
+class _Tokens:
+    __slots__ = ("calls", "prompt_tokens", "completion_tokens", "total_tokens")
+
+    def __init__(self):
+        self.calls = 0
+        self.prompt_tokens = 0
+        self.completion_tokens = 0
+        self.total_tokens = 0
+
+    def add(self, usage: Dict[str, int]):
+        self.calls += 1
+        self.prompt_tokens += usage["prompt_tokens"]
+        self.completion_tokens += usage["completion_tokens"]
+        self.total_tokens += usage["total_tokens"]
+
+    def merge(self, other: "_Tokens"):
+        self.calls += other.calls
+        self.prompt_tokens += other.prompt_tokens
+        self.completion_tokens += other.completion_tokens
+        self.total_tokens += other.total_tokens
+
+    def to_dict(self) -> Dict[str, int]:
+        return {
+            "calls": self.calls,
+            "prompt_tokens": self.prompt_tokens,
+            "completion_tokens": self.completion_tokens,
+            "total_tokens": self.total_tokens
+        }
+
+
+class UsageCollector:
+    """
+    一个统计范围（一次请求、一个后台任务、一道题目的解析）内的token用量，按模型细分。
+    范围可以嵌套，记入子范围的用量同时记入所有上层范围
+    """
+
+    def __init__(self, endpoint: str = None, parent: "UsageCollector" = None):
+        self.parent = parent
+        self.endpoint = endpoint or (parent.endpoint if parent else None)
+        self._lock = threading.Lock()
+        self._total = _Tokens()
+        self._by_model: Dict[str, _Tokens] = {}
+
+    def add(self, model: str, usage: Dict[str, int]):
+        collector = self
+        while collector is not None:
+            with collector._lock:
+                collector._total.add(usage)
+                collector._by_model.setdefault(model, _Tokens()).add(usage)
+            collector = collector.parent
+
+    def to_dict(self) -> Dict[str, Any]:
+        with self._lock:
+            return {
+                **self._total.to_dict(),
+                "by_model": {model: tokens.to_dict() for model, tokens in sorted(self._by_model.items())}
+            }
+
+
+# 当前统计范围，随请求上下文传递到异步任务和（通过 ContextThreadPoolExecutor）线程池
+current_usage: contextvars.ContextVar = contextvars.ContextVar("token_usage", default=None)
+
+
+@contextmanager
+def track_usage(endpoint: str = None) -> Generator[UsageCollector, None, None]:
+    """在代码块内开始一个统计范围，嵌套在当前范围之下；endpoint 为空时沿用上层范围的接口名"""
+    collector = UsageCollector(endpoint, current_usage.get())
+    token = current_usage.set(collector)
+    try:
+        yield collector
+    finally:
+        current_usage.reset(token)
+
+
+class UsageStats:
+    """进程内token用量累计，按接口、处理器和模型分组"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._totals: Dict[Tuple[str, str, str], _Tokens] = {}
+        self._unreported: Dict[str, int] = {}
+
+    def add(self, endpoint: str, processor: str, model: str, usage: Dict[str, int]):
+        with self._lock:
+            self._totals.setdefault((endpoint, processor, model), _Tokens()).add(usage)
+
+    def unreported(self, processor: str):
+        with self._lock:
+            self._unreported[processor] = self._unreported.get(processor, 0) + 1
+
+    def _group(self, items: Iterable[Tuple[Tuple[str, str, str], _Tokens]], field: int) -> Dict[str, Dict[str, int]]:
+        groups: Dict[str, _Tokens] = {}
+        for key, tokens in items:
+            groups.setdefault(key[field], _Tokens()).merge(tokens)
+        return {name: tokens.to_dict() for name, tokens in sorted(groups.items())}
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            items = list(self._totals.items())
+            unreported = dict(self._unreported)
+        total = _Tokens()
+        for _, tokens in items:
+            total.merge(tokens)
+        return {
+            "total": total.to_dict(),
+            "by_endpoint": self._group(items, 0),
+            "by_processor": self._group(items, 1),
+            "by_model": self._group(items, 2),
+            "unreported_calls": unreported
+        }
+
+
+USAGE_STATS = UsageStats()
+
+# 不在任何请求或任务范围内的调用（如脚本直接调用处理器）记在这个接口名下
+BACKGROUND_ENDPOINT = "background"
+
+
+def record_usage(usage: Optional[Dict[str, Any]], model: str, processor: str,
+                 collector: UsageCollector = None) -> Optional[Dict[str, int]]:
+    """
+    记录一次上游调用的token用量：计入进程累计、指标和当前统计范围（或传入的 collector）。
+    合并掉的请求和缓存命中没有上游调用，不产生用量
+
+    Returns:
+        规整后的用量，响应没有 usage 时返回None并计入 unreported
+    """
+    usage = normalize_usage(usage)
+    if usage is None:
+        USAGE_STATS.unreported(processor)
+        LLM_USAGE_UNREPORTED.labels(processor).inc()
+        return None
+    model = model or "unknown"
+    collector = collector or current_usage.get()
+    endpoint = collector.endpoint if collector is not None and collector.endpoint else BACKGROUND_ENDPOINT
+    USAGE_STATS.add(endpoint, processor, model, usage)
+    LLM_TOKENS.labels(processor, model, "prompt").inc(usage["prompt_tokens"])
+    LLM_TOKENS.labels(processor, model, "completion").inc(usage["completion_tokens"])
+    if collector is not None:
+        collector.add(model, usage)
+    return usage
+
+
+class UsageMiddleware:
+    """
+    为调用大模型的接口开启请求级统计范围，接口名取匹配到的路径前缀（避免路径参数撑大分组数）；
+    routes 为路径前缀列表，按路径段做最长前缀匹配（/api/extract 不匹配 /api/extract-raw）
+    """
+
+    def __init__(self, app, routes: Iterable[str]):
+        self.app = app
+        self.routes = sorted(routes, key=len, reverse=True)
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+        path = scope.get("path", "")
+        endpoint = next((prefix for prefix in self.routes if path == prefix or path.startswith(prefix + "/")), None)
+        if endpoint is None:
+            await self.app(scope, receive, send)
+            return
+        with track_usage(endpoint):
+            await self.app(scope, receive, send)
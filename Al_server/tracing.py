@@ -0,0 +1,409 @@
+import contextvars
+import json
+import os
+import queue
+import random
+import re
+import secrets
+import threading
+import time
+import uuid
+from contextlib import contextmanager
+from typing import Any, Dict, Generator, List, Optional
+
+# 当前span，随请求上下文传递到异步任务和（通过 ContextThreadPoolExecutor）线程池
+_current_span: contextvars.ContextVar = contextvars.ContextVar("trace_span", default=None)
+# 当前请求ID，与响应头 X-Request-ID 一致
+current_request_id: contextvars.ContextVar = contextvars.ContextVar("request_id", default=None)
+
+_TRACE_ID = re.compile(r"[0-9a-f]{32}")
+# 回显到响应头的请求ID只保留这些字符
+_REQUEST_ID_UNSAFE = re.compile(r"[^\w.:\-]")
+
+SPAN_OK = "ok"
+SPAN_ERROR = "error"
+SPAN_CANCELLED = "cancelled"
+
+
+def _new_trace_id() -> str:
+    return secrets.token_hex(16)
+
+
+def _new_span_id() -> str:
+    return secrets.token_hex(8)
+
+
+class Span:
+    """
+    一段计时区间：名称、所属trace、父span、起止时间（Unix纳秒）、属性和状态。
+    end() 时交给导出器，未采样的trace只计时不导出
+    """
+
+    __slots__ = ("name", "trace_id", "span_id", "parent_id", "sampled", "start_ns", "end_ns",
+                 "attributes", "status", "error", "thread")
+
+    def __init__(self, name: str, trace_id: str, parent_id: str = None, sampled: bool = True,
+                 attributes: Dict[str, Any] = None, start_ns: int = None):
+        self.name = name
+        self.trace_id = trace_id
+        self.span_id = _new_span_id()
+        self.parent_id = parent_id
+        self.sampled = sampled
+        self.start_ns = start_ns or time.time_ns()
+        self.end_ns: Optional[int] = None
+        self.attributes = attributes or {}
+        self.status = SPAN_OK
+        self.error: Optional[str] = None
+        self.thread = threading.current_thread().name
+
+    def set_attribute(self, key: str, value: Any):
+        self.attributes[key] = value
+
+    def set_attributes(self, **attributes):
+        self.attributes.update(attributes)
+
+    def record_error(self, error: BaseException):
+        if isinstance(error, Exception):
+            self.status = SPAN_ERROR
+            self.error = f"{type(error).__name__}: {error}"
+        else:
+            # 任务取消、生成器提前关闭
+            self.status = SPAN_CANCELLED
+
+    @property
+    def duration_ms(self) -> Optional[float]:
+        return None if self.end_ns is None else (self.end_ns - self.start_ns) / 1e6
+
+    def end(self, end_ns: int = None):
+        """结束span，重复调用只生效一次"""
+        if self.end_ns is not None:
+            return
+        self.end_ns = end_ns or time.time_ns()
+        if self.sampled:
+            get_span_exporter().export(self)
+
+    def to_dict(self) -> Dict[str, Any]:
+        return {
+            "trace_id": self.trace_id,
+            "span_id": self.span_id,
+            "parent_id": self.parent_id,
+            "name": self.name,
+            "start_ns": self.start_ns,
+            "end_ns": self.end_ns,
+            "duration_ms": round(self.duration_ms, 3) if self.end_ns is not None else None,
+            "status": self.status,
+            "error": self.error,
+            "thread": self.thread,
+            "attributes": self.attributes
+        }
+
+
+def current_span() -> Optional[Span]:
+    return _current_span.get()
+
+
+def current_trace_id() -> Optional[str]:
+    span = _current_span.get()
+    return span.trace_id if span else None
+
+
+def start_span(name: str, **attributes) -> Span:
+    """
+    创建当前span的子span但不设为当前span，调用方负责 end()。
+    用于跨越 yield 的区间（流式调用等），生成器中不能切换上下文变量
+    """
+    parent = _current_span.get()
+    if parent is None:
+        return Span(name, _new_trace_id(), sampled=_sample(), attributes=attributes)
+    return Span(name, parent.trace_id, parent.span_id, parent.sampled, attributes)
+
+
+@contextmanager
+def use_span(span: Span) -> Generator[Span, None, None]:
+    """在代码块内把已有span设为当前span（不负责结束），块内创建的任务和线程池任务以它为父span"""
+    token = _current_span.set(span)
+    try:
+        yield span
+    finally:
+        _current_span.reset(token)
+
+
+@contextmanager
+def span(name: str, **attributes) -> Generator[Span, None, None]:
+    """在代码块内记录一个子span，块内抛出的异常记入span后继续抛出"""
+    current = start_span(name, **attributes)
+    token = _current_span.set(current)
+    try:
+        yield current
+    except BaseException as e:
+        current.record_error(e)
+        raise
+    finally:
+        _current_span.reset(token)
+        current.end()
+
+
+@contextmanager
+def trace(name: str, request_id: str = None, trace_id: str = None, **attributes) -> Generator[Span, None, None]:
+    """
+    开始一条新trace的根span
+
+    Args:
+        name: 根span名称
+        request_id: 请求ID；是32位十六进制时直接作为trace ID
+        trace_id: 延续已有trace（如后台任务沿用提交请求的trace）
+    """
+    if trace_id is None and request_id and _TRACE_ID.fullmatch(request_id.lower()):
+        trace_id = request_id.lower()
+    if request_id:
+        attributes["request_id"] = request_id
+    root = Span(name, trace_id or _new_trace_id(), sampled=_sample(), attributes=attributes)
+    span_token = _current_span.set(root)
+    request_token = current_request_id.set(request_id) if request_id else None
+    try:
+        yield root
+    except BaseException as e:
+        root.record_error(e)
+        raise
+    finally:
+        _current_span.reset(span_token)
+        if request_token is not None:
+            current_request_id.reset(request_token)
+        root.end()
+
+
+def record_span(name: str, start_ns: int, end_ns: int, **attributes) -> Optional[Span]:
+    """补记一个已经结束的子span（如子进程中提取的页面，只拿到了起止时间）"""
+    parent = _current_span.get()
+    if parent is None or not parent.sampled:
+        return None
+    recorded = Span(name, parent.trace_id, parent.span_id, True, attributes, start_ns)
+    recorded.end(end_ns)
+    return recorded
+
+
+_sample_rate = float(os.getenv("TRACE_SAMPLE_RATE", "1"))
+
+
+def _sample() -> bool:
+    """根span决定整条trace是否导出，子span沿用"""
+    return _sample_rate >= 1 or random.random() < _sample_rate
+
+
+class SpanExporter:
+    """
+    span导出器：export() 只把span放入有界队列，由后台线程批量写出，请求路径上不做IO；
+    队列满时丢弃并计数
+    """
+
+    def __init__(self, batch_size: int = 512, flush_interval: float = None, max_queue: int = None):
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval or float(os.getenv("TRACE_FLUSH_INTERVAL", "2"))
+        self._queue: "queue.Queue[Optional[Span]]" = queue.Queue(maxsize=max_queue or int(os.getenv("TRACE_QUEUE_MAX", "10000")))
+        self._thread: Optional[threading.Thread] = None
+        self._lock = threading.Lock()
+        self.exported = 0
+        self.dropped = 0
+        self.errors = 0
+
+    def export(self, span: Span):
+        if self._thread is None:
+            self._start()
+        try:
+            self._queue.put_nowait(span)
+        except queue.Full:
+            self.dropped += 1
+
+    def _start(self):
+        with self._lock:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name="span-exporter", daemon=True)
+                self._thread.start()
+
+    def _run(self):
+        while True:
+            batch: List[Span] = []
+            stop = False
+            try:
+                item = self._queue.get(timeout=self.flush_interval)
+                while True:
+                    if item is None:
+                        stop = True
+                        break
+                    batch.append(item)
+                    if len(batch) >= self.batch_size:
+                        break
+                    item = self._queue.get_nowait()
+            except queue.Empty:
+                pass
+            if batch:
+                try:
+                    self.write(batch)
+                    self.exported += len(batch)
+                except Exception as e:
+                    self.errors += 1
+                    print(f"⚠️ 导出trace失败: {str(e)}")
+            if stop:
+                return
+
+    def write(self, spans: List[Span]):
+        raise NotImplementedError
+
+    def close(self, timeout: float = 5):
+        """写出队列中剩余的span并停止后台线程"""
+        if self._thread is None:
+            return
+        try:
+            self._queue.put(None, timeout=timeout)
+        except queue.Full:
+            return
+        self._thread.join(timeout)
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "exporter": type(self).__name__,
+            "queued": self._queue.qsize(),
+            "exported": self.exported,
+            "dropped": self.dropped,
+            "errors": self.errors,
+            "sample_rate": _sample_rate
+        }
+
+
+class NullSpanExporter(SpanExporter):
+    """未配置导出时直接丢弃"""
+
+    def export(self, span: Span):
+        pass
+
+
+class JSONLSpanExporter(SpanExporter):
+    """每个span一行JSON追加写入本地文件，可用 jq 按 trace_id 过滤后还原时间线"""
+
+    def __init__(self, path: str = None, **kwargs):
+        super().__init__(**kwargs)
+        self.path = path or os.getenv("TRACE_JSONL_PATH", "traces/spans.jsonl")
+        directory = os.path.dirname(self.path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+
+    def write(self, spans: List[Span]):
+        with open(self.path, "a", encoding="utf-8") as f:
+            for span in spans:
+                f.write(json.dumps(span.to_dict(), ensure_ascii=False, default=str) + "\n")
+
+
+def _otlp_value(value: Any) -> Dict[str, Any]:
+    if isinstance(value, bool):
+        return {"boolValue": value}
+    if isinstance(value, int):
+        return {"intValue": str(value)}
+    if isinstance(value, float):
+        return {"doubleValue": value}
+    return {"stringValue": str(value)}
+
+
+class OTLPSpanExporter(SpanExporter):
+    """按 OTLP/HTTP JSON 格式发送到兼容的collector（如 OpenTelemetry Collector、Jaeger、Tempo 的 /v1/traces）"""
+
+    def __init__(self, endpoint: str = None, service_name: str = None, headers: Dict[str, str] = None, **kwargs):
+        super().__init__(**kwargs)
+        import requests
+
+        self.endpoint = endpoint or os.getenv("TRACE_OTLP_ENDPOINT", "http://localhost:4318/v1/traces")
+        self.service_name = service_name or os.getenv("TRACE_SERVICE_NAME", "gesp-ai-server")
+        self._session = requests.Session()
+        self._session.headers.update({"Content-Type": "application/json", **(headers or {})})
+
+    def _encode(self, span: Span) -> Dict[str, Any]:
+        encoded = {
+            "traceId": span.trace_id,
+            "spanId": span.span_id,
+            "name": span.name,
+            "kind": 1,
+            "startTimeUnixNano": str(span.start_ns),
+            "endTimeUnixNano": str(span.end_ns),
+            "attributes": [{"key": key, "value": _otlp_value(value)} for key, value in span.attributes.items()],
+            "status": {"code": 1}
+        }
+        if span.status == SPAN_ERROR:
+            encoded["status"] = {"code": 2, "message": span.error or ""}
+        elif span.status == SPAN_CANCELLED:
+            encoded["status"] = {"code": 0, "message": SPAN_CANCELLED}
+        if span.parent_id:
+            encoded["parentSpanId"] = span.parent_id
+        encoded["attributes"].append({"key": "thread.name", "value": {"stringValue": span.thread}})
+        return encoded
+
+    def write(self, spans: List[Span]):
+        body = {
+            "resourceSpans": [{
+                "resource": {"attributes": [{"key": "service.name", "value": {"stringValue": self.service_name}}]},
+                "scopeSpans": [{"scope": {"name": "gesp.tracing"}, "spans": [self._encode(span) for span in spans]}]
+            }]
+        }
+        response = self._session.post(self.endpoint, data=json.dumps(body, ensure_ascii=False, default=str).encode("utf-8"), timeout=5)
+        response.raise_for_status()
+
+
+def create_span_exporter(kind: str = None) -> SpanExporter:
+    """按 TRACE_EXPORTER 创建导出器：none（默认）、jsonl 或 otlp"""
+    kind = (kind or os.getenv("TRACE_EXPORTER", "none")).lower()
+    if kind == "none":
+        return NullSpanExporter()
+    if kind == "jsonl":
+        return JSONLSpanExporter()
+    if kind == "otlp":
+        return OTLPSpanExporter()
+    raise ValueError(f"不支持的trace导出方式: {kind}")
+
+
+_exporter: Optional[SpanExporter] = None
+_exporter_lock = threading.Lock()
+
+
+def get_span_exporter() -> SpanExporter:
+    """获取进程内共享的span导出器"""
+    global _exporter
+    if _exporter is None:
+        with _exporter_lock:
+            if _exporter is None:
+                _exporter = create_span_exporter()
+    return _exporter
+
+
+def shutdown_tracing():
+    """写出剩余的span"""
+    get_span_exporter().close()
+
+
+class TracingMiddleware:
+    """
+    为每个HTTP请求开始一条trace：请求ID取 X-Request-ID 请求头，没有时生成；
+    请求ID写入响应头 X-Request-ID，根span记录方法、路径和状态码
+    """
+
+    header = b"x-request-id"
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+        request_id = dict(scope.get("headers") or []).get(self.header, b"").decode("latin-1")
+        request_id = _REQUEST_ID_UNSAFE.sub("", request_id)[:128] or uuid.uuid4().hex
+
+        with trace(f"{scope['method']} {scope['path']}", request_id=request_id,
+                   **{"http.method": scope["method"], "http.target": scope["path"]}) as root:
+            async def send_with_request_id(message):
+                if message["type"] == "http.response.start":
+                    root.set_attribute("http.status_code", message["status"])
+                    if message["status"] >= 500:
+                        root.status = SPAN_ERROR
+                    headers = [(name, value) for name, value in message.get("headers", []) if name.lower() != self.header]
+                    message = {**message, "headers": headers + [(self.header, request_id.encode("latin-1"))]}
+                await send(message)
+
+            await self.app(scope, receive, send_with_request_id)
@@ -0,0 +1,151 @@
+import asyncio
+import hashlib
+import io
+import os
+import re
+import tempfile
+from typing import BinaryIO, Optional
+from fastapi import UploadFile
+from tracing import span
+
+# 每次从上传流读取的块大小
+UPLOAD_CHUNK_SIZE = 1024 * 1024
+
+
+def parse_size(value: str) -> int:
+    """把 "50MB"、"512KB"、"1048576" 这样的配置解析为字节数"""
+    match = re.fullmatch(r'\s*(\d+(?:\.\d+)?)\s*([KMG]?B?)\s*', value.upper())
+    if not match:
+        raise ValueError(f"无法解析的大小配置: {value}")
+    number, unit = match.groups()
+    multiplier = {"": 1, "B": 1, "K": 1024, "KB": 1024, "M": 1024 ** 2, "MB": 1024 ** 2, "G": 1024 ** 3, "GB": 1024 ** 3}[unit]
+    return int(float(number) * multiplier)
+
+
+def format_size(size: int) -> str:
+    """把字节数格式化为便于阅读的字符串"""
+    if size >= 1024 ** 2:
+        return f"{size / 1024 ** 2:.1f}MB"
+    return f"{size / 1024:.1f}KB"
+
+
+class UploadTooLargeError(ValueError):
+    """上传文件超过大小上限"""
+
+
+class UploadBuffer:
+    """
+    上传文件缓冲区：小文件留在内存中，超过阈值后整体转存到临时目录下的唯一临时文件，
+    内存占用始终不超过一份文件大小；同名文件并发上传也不会互相覆盖
+    """
+
+    def __init__(self, max_bytes: int, spool_bytes: int, temp_dir: str):
+        self.max_bytes = max_bytes
+        self.spool_bytes = spool_bytes
+        self.temp_dir = temp_dir
+        self.size = 0
+        self._hash = hashlib.sha256()
+        self._memory: Optional[io.BytesIO] = io.BytesIO()
+        self._disk: Optional[BinaryIO] = None
+
+    @property
+    def sha256(self) -> str:
+        """已写入内容的SHA-256，边读边算，不需要再读一遍文件"""
+        return self._hash.hexdigest()
+
+    @property
+    def path(self) -> Optional[str]:
+        """落盘后的文件路径，仍在内存中时为None"""
+        return self._disk.name if self._disk else None
+
+    def write(self, chunk: bytes):
+        """追加一块数据，超过上限时抛出UploadTooLargeError"""
+        self.size += len(chunk)
+        if self.size > self.max_bytes:
+            raise UploadTooLargeError(f"文件大小超过上限 {format_size(self.max_bytes)}")
+        self._hash.update(chunk)
+
+        if self._memory is not None and self.size > self.spool_bytes:
+            self.rollover()
+        (self._disk or self._memory).write(chunk)
+
+    def rollover(self):
+        """把内存中的数据转存到磁盘临时文件并释放内存"""
+        if self._disk is not None:
+            return
+        os.makedirs(self.temp_dir, exist_ok=True)
+        self._disk = tempfile.NamedTemporaryFile(
+            dir=self.temp_dir, prefix="upload_", suffix=".pdf", delete=False
+        )
+        self._disk.write(self._memory.getbuffer())
+        self._memory.close()
+        self._memory = None
+
+    def ensure_path(self) -> str:
+        """
+        返回可供子进程重新打开的文件路径，必要时先落盘
+
+        Returns:
+            str: 临时文件路径
+        """
+        self.rollover()
+        self._disk.flush()
+        return self._disk.name
+
+    def open_stream(self) -> BinaryIO:
+        """返回定位到开头的文件对象，可直接交给pdfplumber（同一时刻只能有一个读者）"""
+        stream = self._disk or self._memory
+        stream.flush()
+        stream.seek(0)
+        return stream
+
+    def close(self):
+        """释放内存并删除临时文件"""
+        if self._memory is not None:
+            self._memory.close()
+            self._memory = None
+        if self._disk is not None:
+            self._disk.close()
+            try:
+                os.remove(self._disk.name)
+            except OSError:
+                pass
+            self._disk = None
+
+
+async def read_upload(file: UploadFile, max_bytes: int = None, spool_bytes: int = None, temp_dir: str = None) -> UploadBuffer:
+    """
+    分块读取上传文件到UploadBuffer，不会一次性把整个文件读进内存
+
+    Args:
+        file: FastAPI上传文件
+        max_bytes: 大小上限，默认读取 MAX_FILE_SIZE
+        spool_bytes: 内存缓冲阈值，默认读取 UPLOAD_SPOOL_SIZE
+        temp_dir: 落盘目录，默认读取 TEMP_DIR
+
+    Returns:
+        UploadBuffer: 调用方负责在使用完后 close()
+    """
+    buffer = UploadBuffer(
+        max_bytes=max_bytes or parse_size(os.getenv("MAX_FILE_SIZE", "50MB")),
+        spool_bytes=spool_bytes or parse_size(os.getenv("UPLOAD_SPOOL_SIZE", "8MB")),
+        temp_dir=temp_dir or os.getenv("TEMP_DIR", "temp")
+    )
+    loop = asyncio.get_event_loop()
+    with span("upload.read", filename=file.filename) as read_span:
+        try:
+            while True:
+                chunk = await file.read(UPLOAD_CHUNK_SIZE)
+                if not chunk:
+                    break
+                if buffer.path is None and buffer.size + len(chunk) <= buffer.spool_bytes:
+                    buffer.write(chunk)
+                else:
+                    # 落盘（包括首次转存整个内存缓冲区）放到线程中，不阻塞事件循环
+                    with span("upload.temp_write", bytes=len(chunk), rollover=buffer.path is None):
+                        await loop.run_in_executor(None, buffer.write, chunk)
+        except Exception:
+            buffer.close()
+            raise
+        read_span.set_attributes(bytes=buffer.size, spooled=buffer.path is not None)
+    return buffer